@@ -0,0 +1,271 @@
+# End-to-end benchmarks of the pipeline stages on recorded pages.
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os.path import abspath, isfile, join
+
+import pandas as pd
+
+from collegedata_crawler import crawl, serve_saved_pages
+from collegedata_extractor import FIXTURES_DIR, load_saved_school
+from collegedata_imputation import impute
+from collegedata_matching import ACCEPTED, get_benchmark_frames, match_schools
+from collegedata_names import dirty_cols_extract_dict
+from collegedata_parse_pool import OK, parse_schools
+from collegedata_preprocessing import Preprocessor, get_synthetic_joined
+from collegedata_rules import (convert_percents, extract_all_numbers,
+                               extract_columns, get_benchmark_frame)
+from collegedata_usnews import (USNEWS_HTML_PATH, count_schools,
+                                write_repeated_page)
+
+
+# DEFINITIONS
+##############################################################################
+# Every stage from the crawl to imputation is run on the recorded pages (the
+# CollegeData schools saved under FIXTURES_DIR and the saved USNews page),
+# scaled up to `scale` times the real number of schools by repeating them
+# (varying their numbers where a stage would notice). Each stage runs in a
+# fresh process, so its time and peak memory are its own, and the results
+# are added to a JSON Lines file, one line per stage and scale, labelled
+# with the commit they were run on, to compare between commits.
+BENCHMARK_RESULTS_PATH = 'data/benchmarks.jsonl'
+BENCHMARK_SCALES = (1, 10, 100)
+# At 1x, about as many schools as CollegeData has (and one copy of the USNews
+# page, with its ~1,400 ranked schools):
+BASE_SCHOOLS = 2000
+# The crawl is replayed against a local server, so it isn't rate limited:
+REPLAY_RATE = 1e9
+
+
+# STAGES
+##############################################################################
+# Each stage's setup takes a scale and returns `(run, items, cleanup)`:
+# `run()` is what is timed (returning a dict of anything else worth keeping,
+# or None), and `items` how many schools it handles (or None, if `run()`
+# counts them as its `items`).
+def get_fixture_ids(directory = FIXTURES_DIR):
+    return sorted(int(name) for name in os.listdir(directory)
+                  if name.isdigit())
+
+def make_replay_dir(schools, directory = FIXTURES_DIR):
+    # A temporary directory laid out like FIXTURES_DIR with `schools` schools
+    # (ids from 1), each a link to one of the recorded schools.
+    fixture_ids = get_fixture_ids(directory)
+    replay_dir = tempfile.mkdtemp()
+    for school_id in range(1, schools + 1):
+        fixture_id = fixture_ids[school_id % len(fixture_ids)]
+        os.symlink(abspath(join(directory, str(fixture_id))),
+                   join(replay_dir, str(school_id)))
+    return replay_dir
+
+def setup_crawl(scale):
+    schools = BASE_SCHOOLS * scale
+    replay_dir = make_replay_dir(schools)
+    server, url_pt_1 = serve_saved_pages(replay_dir)
+    counts = {'failed': 0}
+
+    def callback(school):
+        if None in school.pages:
+            counts['failed'] += 1
+
+    def run():
+        crawl(callback, school_ids = range(1, schools + 1),
+              url_pt_1 = url_pt_1, rate = REPLAY_RATE)
+        return counts
+
+    def cleanup():
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(replay_dir)
+
+    return run, schools, cleanup
+
+def setup_parse(scale):
+    schools = BASE_SCHOOLS * scale
+    saved = [load_saved_school(school_id)
+             for school_id in get_fixture_ids()]
+
+    def run():
+        parsed = parse_schools((school_id, saved[school_id % len(saved)])
+                               for school_id in range(1, schools + 1))
+        return {'failed': sum(school.status != OK for school in parsed)}
+
+    return run, schools, lambda: None
+
+def setup_extract(scale):
+    df = get_benchmark_frame(tuple(get_fixture_ids()),
+                             rows = BASE_SCHOOLS * scale)
+    sources = list(dirty_cols_extract_dict)
+
+    def run():
+        dirty = convert_percents(df)[sources].astype(object)
+        extract_columns(dirty)
+        extract_all_numbers(dirty, sources)
+
+    return run, len(df), lambda: None
+
+def setup_usnews(scale):
+    path = write_repeated_page(scale, USNEWS_HTML_PATH)
+
+    def run():
+        return {'items': count_schools(path)}
+
+    return run, None, lambda: os.remove(path)
+
+def setup_match(scale):
+    usnews_df, collegedata_df = get_benchmark_frames(scale)
+
+    def run():
+        matches, _ = match_schools(usnews_df, collegedata_df)
+        return {'accepted': int((matches['Status'] == ACCEPTED).sum())}
+
+    return run, len(usnews_df), lambda: None
+
+def setup_preprocess(scale):
+    df = get_synthetic_joined(BASE_SCHOOLS * scale)
+
+    def run():
+        Preprocessor().fit_transform(df)
+
+    return run, len(df), lambda: None
+
+def setup_impute(scale):
+    df = Preprocessor().fit_transform(
+        get_synthetic_joined(BASE_SCHOOLS * scale))
+
+    def run():
+        _, cycles = impute(df)
+        return {'cycles': max(cycles)}
+
+    return run, len(df), lambda: None
+
+# In pipeline order:
+STAGES = {'crawl': setup_crawl,
+          'parse': setup_parse,
+          'extract': setup_extract,
+          'usnews': setup_usnews,
+          'match': setup_match,
+          'preprocess': setup_preprocess,
+          'impute': setup_impute}
+
+
+# RUNNING
+##############################################################################
+def get_max_rss():
+    # Peak resident memory in bytes of this process, and of its finished
+    # child processes (e.g. a pool's workers). Linux reports kilobytes.
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+def run_stage(stage, scale):
+    # Set up, time and clean up one stage. Runs in a fresh process.
+    run, items, cleanup = STAGES[stage](scale)
+    try:
+        before, workers_before = get_max_rss()
+        start = time.perf_counter()
+        extra = run() or {}
+        seconds = time.perf_counter() - start
+        peak, workers_peak = get_max_rss()
+    finally:
+        cleanup()
+    items = extra.pop('items', items)
+    return {'stage': stage,
+            'scale': scale,
+            'items': items,
+            'seconds': seconds,
+            'items_per_second': items / seconds,
+            'peak_rss_bytes': peak,
+            'setup_rss_bytes': before,
+            # (Only if a child process got bigger than any before it.)
+            'workers_peak_rss_bytes': (workers_peak
+                                       if workers_peak > workers_before
+                                       else None),
+            **extra}
+
+def get_revision():
+    # The commit checked out (with "-dirty" if there are local changes).
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output = True, text = True,
+                              check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(stages = None, scales = BENCHMARK_SCALES,
+                   path = BENCHMARK_RESULTS_PATH):
+    # Run `stages` (all of them by default) at each of `scales`, adding each
+    # result to `path` as soon as it is in. Returns this run's results.
+    if stages is None:
+        stages = list(STAGES)
+    run_info = {'revision': get_revision(),
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'machine': platform.machine(),
+                'cpus': os.cpu_count()}
+    results = []
+    for scale in scales:
+        for stage in stages:
+            context = get_context('spawn')
+            with ProcessPoolExecutor(1, mp_context = context) as pool:
+                result = {**run_info,
+                          **pool.submit(run_stage, stage, scale).result()}
+            with open(path, 'a') as file:
+                file.write(json.dumps(result) + '\n')
+            results.append(result)
+    return pd.DataFrame(results)
+
+
+# COMPARING
+##############################################################################
+def load_benchmarks(path = BENCHMARK_RESULTS_PATH):
+    if not isfile(path):
+        return pd.DataFrame()
+    return pd.read_json(path, lines = True, convert_dates = False)
+
+def get_latest(results, revision):
+    # The latest result for each stage and scale on a commit (a prefix of
+    # its hash, as `git describe --always` gives it, will do).
+    # (Runs outside git have no revision, and never match.)
+    revisions = results['revision'].astype('string')
+    results = results[revisions.str.startswith(revision, na = False)]
+    results = results.sort_values('started', kind = 'stable')
+    return results.groupby(['stage', 'scale']).last()
+
+def compare_benchmarks(base, head, path = BENCHMARK_RESULTS_PATH):
+    # Seconds and peak memory of every stage and scale run on both commits,
+    # with the ratio of `head` to `base` (over 1 is slower or bigger).
+    results = load_benchmarks(path)
+    cols = ['seconds', 'peak_rss_bytes']
+    compared = get_latest(results, base)[cols].join(
+        get_latest(results, head)[cols], how = 'inner',
+        lsuffix = ' (base)', rsuffix = ' (head)')
+    for col in cols:
+        compared[col + ' ratio'] = (compared[col + ' (head)']
+                                    / compared[col + ' (base)'])
+    return compared
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description = "Benchmark the pipeline stages on recorded pages.")
+    parser.add_argument('--stages', nargs = '+', choices = list(STAGES))
+    parser.add_argument('--scales', nargs = '+', type = int,
+                        default = list(BENCHMARK_SCALES))
+    parser.add_argument('--out', default = BENCHMARK_RESULTS_PATH)
+    parser.add_argument('--compare', nargs = 2,
+                        metavar = ('BASE', 'HEAD'))
+    args = parser.parse_args()
+    if args.compare:
+        print(compare_benchmarks(*args.compare, args.out).to_string())
+    else:
+        print(run_benchmarks(args.stages, args.scales, args.out)
+              .to_string())
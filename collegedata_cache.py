@@ -0,0 +1,170 @@
+# CollegeData raw page cache.
+import gzip
+import hashlib
+import os
+import sqlite3
+import time
+from os.path import isdir, isfile, join
+
+from collegedata_scraper import PAGE_IDS, parse_collegedata_page
+
+
+# DEFINITIONS
+##############################################################################
+# Every page we fetch is kept on disk, so changing the parsing code never
+# means re-crawling. The raw HTML is gzipped and stored under the SHA-1 of its
+# contents (so the thousands of identical "no school" pages are only stored
+# once), and a small SQLite index maps each `(school_id, page_id)` to its
+# content hash plus what we learned fetching it:
+PAGE_CACHE_DIR = "data/pages"
+PAGE_CACHE_INDEX = "index.sqlite"
+PAGE_CACHE_OBJECTS = "objects"
+GZIP_LEVEL = 6
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS pages (
+    school_id INTEGER NOT NULL,
+    page_id INTEGER NOT NULL,
+    sha1 TEXT,
+    status INTEGER,
+    fetched REAL NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    PRIMARY KEY (school_id, page_id)
+)
+"""
+META_COLS = ['school_id', 'page_id', 'sha1', 'status', 'fetched',
+             'etag', 'last_modified']
+
+
+# PAGE CACHE
+##############################################################################
+class PageCache:
+    def __init__(self, root = PAGE_CACHE_DIR):
+        self.root = root
+        self.objects = join(root, PAGE_CACHE_OBJECTS)
+        os.makedirs(self.objects, exist_ok = True)
+        self.db = sqlite3.connect(join(root, PAGE_CACHE_INDEX))
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute(CREATE_TABLE)
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    # Raw HTML blobs, addressed by content hash.
+    def object_path(self, sha1):
+        return join(self.objects, sha1[:2], sha1[2:] + '.html.gz')
+
+    def put_object(self, html):
+        data = html.encode('utf-8')
+        sha1 = hashlib.sha1(data).hexdigest()
+        path = self.object_path(sha1)
+        if not isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            # Write then rename, so a crash never leaves a truncated blob.
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(gzip.compress(data, GZIP_LEVEL))
+            os.replace(tmp_path, path)
+        return sha1
+
+    def get_object(self, sha1):
+        with open(self.object_path(sha1), 'rb') as file:
+            return gzip.decompress(file.read()).decode('utf-8')
+
+    # Per-page metadata.
+    def get_meta(self, school_id, page_id):
+        row = self.db.execute(
+            "SELECT * FROM pages WHERE school_id = ? AND page_id = ?",
+            (school_id, page_id)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(META_COLS, row))
+
+    def put(self, school_id, page_id, html, status = 200, etag = None,
+            last_modified = None):
+        # Record a fetch. A page that failed (`html` of None) is recorded
+        # too, with just its status, so we know it was tried.
+        sha1 = self.put_object(html) if html is not None else None
+        self.db.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (school_id, page_id, sha1, status, time.time(), etag,
+             last_modified))
+
+    def touch(self, school_id, page_id):
+        # A conditional re-fetch came back 304 Not Modified.
+        self.db.execute(
+            "UPDATE pages SET fetched = ? WHERE school_id = ? AND page_id = ?",
+            (time.time(), school_id, page_id))
+
+    def get(self, school_id, page_id):
+        # Raw HTML of a cached page, or None if it isn't cached (or its
+        # fetch failed).
+        meta = self.get_meta(school_id, page_id)
+        if meta is None or meta['sha1'] is None:
+            return None
+        return self.get_object(meta['sha1'])
+
+    def has_school(self, school_id, page_ids = PAGE_IDS):
+        # Whether every one of `page_ids` is cached (other pages don't count).
+        page_ids = set(page_ids)
+        count = self.db.execute(
+            "SELECT COUNT(*) FROM pages WHERE school_id = ? "
+            "AND sha1 IS NOT NULL AND page_id IN ({})".format(
+                ', '.join('?' * len(page_ids))),
+            (school_id, *page_ids)).fetchone()[0]
+        return count == len(page_ids)
+
+    def get_school(self, school_id, page_ids = PAGE_IDS):
+        return [self.get(school_id, page_id) for page_id in page_ids]
+
+    def school_ids(self):
+        # Ids of every school with all of its pages cached.
+        rows = self.db.execute(
+            "SELECT school_id FROM pages WHERE sha1 IS NOT NULL "
+            "GROUP BY school_id HAVING COUNT(*) = ? ORDER BY school_id",
+            (len(PAGE_IDS),))
+        return [row[0] for row in rows]
+
+    def conditional_headers(self, school_id, page_id):
+        # Headers for a conditional re-fetch, so an unchanged page costs a
+        # 304 with no body instead of a full download.
+        meta = self.get_meta(school_id, page_id)
+        headers = {}
+        if meta and meta['sha1']:
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+
+# PARSING FROM THE CACHE
+##############################################################################
+def get_cached_school_pages(cache, school_id):
+    # The parsed pages of a cached school, ready for
+    # `collegedata_scraper.extract_school`. Never touches the network.
+    htmls = cache.get_school(school_id)
+    if None in htmls:
+        return None
+    return [parse_collegedata_page(html) for html in htmls]
+
+def iter_cached_schools(root = PAGE_CACHE_DIR):
+    # Yield `(school_id, pages)` for every fully cached school.
+    if not isdir(root):
+        return
+    with PageCache(root) as cache:
+        for school_id in cache.school_ids():
+            yield school_id, get_cached_school_pages(cache, school_id)
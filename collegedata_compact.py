@@ -0,0 +1,475 @@
+# Compact in-memory representation of the wide school table.
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from scipy import sparse
+
+from collegedata_extractor import (CAPTION_STRINGS, SPORTS_LABELS,
+                                   extract_record, load_saved_school)
+from collegedata_names import num_col_ranges
+from collegedata_preprocessing import get_synthetic_joined
+from collegedata_storage import COMPRESSION, STAGE_PATHS
+
+
+# DEFINITIONS
+##############################################################################
+# Loaded as it is, the school table is hundreds of float64 columns (most of
+# them percentages or small counts), strings as Python objects (so each
+# `State` is its own object), and the majors, programs and sports as a Python
+# list of strings in every cell. A `CompactFrame` holds the same table in the
+# narrowest dtypes that keep every value:
+# - whole-number columns as plain numpy integers (`int8` to `int64`), wide
+#   enough for the range in `num_col_ranges` and for every value seen (some
+#   scraped values are out of range, and part 4 only masks them later), with
+#   missing values stored as 0 and a boolean validity mask kept beside the
+#   column. Pandas' nullable integers hold the same two arrays, but scans
+#   over them go through its slower extension-array code, which made
+#   summing the compact table slower than summing the float64 one; a
+#   column is handed out as a nullable integer Series (a view of the two
+#   arrays) when asked for, and `CompactFrame.sum` scans the plain arrays;
+# - other float columns as float32 (about 7 significant digits, plenty for
+#   percentages and dollar amounts);
+# - string columns with many repeats (`State`, `City`, `Entrance
+#   Difficulty`, the Factor ratings...) as categories, and the rest as Arrow
+#   strings;
+# - list columns as a `ListColumn`: every school's items as codes into one
+#   sorted vocabulary, with the offset of each school's first item. That is
+#   exactly a CSR sparse matrix (`indptr`, `indices`), so the same arrays are
+#   also the schools x terms multi-hot matrix, with no copy.
+# Strings with fewer unique values than this fraction of their known values
+# are stored as categories:
+CATEGORY_MAX_FRACTION = 0.5
+INT_DTYPES = [('Int8', np.int8), ('Int16', np.int16), ('Int32', np.int32),
+              ('Int64', np.int64)]
+STRING_DTYPE = 'string[pyarrow]'
+# The list-valued columns `collegedata_extractor.extract_record` produces:
+LIST_COLS = CAPTION_STRINGS + SPORTS_LABELS
+# Saved compact frames keep their column order in the Parquet metadata:
+COMPACT_METADATA_KEY = b'collegedata_compact'
+
+
+# DTYPES
+##############################################################################
+def get_int_dtype(low, high):
+    # The narrowest nullable integer dtype holding `low` to `high`.
+    for name, dtype in INT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return name
+    return None
+
+def get_compact_dtype(s, ranges = num_col_ranges):
+    # The dtype `s` is stored as in a `CompactFrame`, 'list' for a
+    # `ListColumn`, or None to leave it as it is.
+    if pd.api.types.is_bool_dtype(s):
+        return None
+    if pd.api.types.is_numeric_dtype(s):
+        values = s.dropna().to_numpy(dtype = float)
+        if len(values) and not np.array_equal(values, np.round(values)):
+            return 'float32'
+        low, high = ranges.get(s.name, (0, 0))
+        if len(values):
+            low = min(low, values.min())
+            high = max(high, values.max())
+        return get_int_dtype(low, high) or 'float64'
+    if pd.api.types.is_categorical_dtype(s):
+        return 'category'
+    values = s.dropna()
+    if not len(values):
+        return None
+    kinds = set(values.map(type))
+    if kinds <= {list, tuple}:
+        return 'list'
+    if kinds == {str}:
+        if values.nunique() < CATEGORY_MAX_FRACTION * len(values):
+            return 'category'
+        return STRING_DTYPE
+    return None
+
+def compact_series(s, dtype):
+    if dtype == 'category' and pd.api.types.is_categorical_dtype(s):
+        return s.cat.remove_unused_categories()
+    return s.astype(dtype)
+
+
+# LIST COLUMNS
+##############################################################################
+class ListColumn:
+    # A list-valued column: `terms`, the sorted vocabulary, and `matrix`, a
+    # schools x terms CSR matrix whose `indptr` is the offset of each row's
+    # first item and `indices` each item's term code, in the order they were
+    # in the list. `valid` is False for rows that had no list at all (as
+    # opposed to an empty one).
+    def __init__(self, matrix, terms, valid, index = None, name = None):
+        self.matrix = matrix
+        self.terms = terms
+        self.valid = valid
+        self.index = index
+        self.name = name
+
+    @classmethod
+    def from_offsets(cls, offsets, items, valid, index = None, name = None):
+        # From the offset of each row's first item (plus the end) and all
+        # the items (strings) in order.
+        terms, codes = np.unique(np.asarray(items, dtype = object),
+                                 return_inverse = True)
+        n = len(offsets) - 1
+        matrix = sparse.csr_matrix(
+            (np.ones(len(codes), dtype = bool), codes.astype(np.int32),
+             np.asarray(offsets, dtype = np.int32)),
+            shape = (n, len(terms)))
+        return cls(matrix, terms, np.asarray(valid, dtype = bool), index,
+                   name)
+
+    @classmethod
+    def from_series(cls, s):
+        valid = np.array([isinstance(value, (list, tuple)) for value in s])
+        lengths = [len(value) if ok else 0 for value, ok in zip(s, valid)]
+        offsets = np.zeros(len(s) + 1, dtype = np.int64)
+        np.cumsum(lengths, out = offsets[1:])
+        items = [item for value, ok in zip(s, valid) if ok for item in value]
+        return cls.from_offsets(offsets, items, valid, s.index, s.name)
+
+    @classmethod
+    def from_arrow(cls, array, index = None, name = None):
+        # From an Arrow list array (as `collegedata_storage` writes lists),
+        # without going through Python lists.
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        offsets = array.offsets.to_numpy().astype(np.int64)
+        values = array.values.slice(offsets[0], offsets[-1] - offsets[0])
+        offsets -= offsets[0]
+        valid = array.is_valid().to_numpy(zero_copy_only = False)
+        if values.null_count or np.diff(offsets)[~valid].any():
+            # Missing items, or a missing list spanning items (Arrow allows
+            # both): take the slow way.
+            return cls.from_series(pd.Series(array.to_pylist(),
+                                             index = index, name = name))
+        encoded = pc.dictionary_encode(values)
+        terms = encoded.dictionary.to_numpy(zero_copy_only = False)
+        order = np.argsort(terms)
+        ranks = np.empty(len(order), dtype = np.int32)
+        ranks[order] = np.arange(len(order), dtype = np.int32)
+        codes = ranks[encoded.indices.to_numpy()]
+        matrix = sparse.csr_matrix(
+            (np.ones(len(codes), dtype = bool), codes,
+             offsets.astype(np.int32)),
+            shape = (len(array), len(terms)))
+        return cls(matrix, terms[order], valid, index, name)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def lengths(self):
+        return np.diff(self.matrix.indptr)
+
+    def to_lists(self):
+        indptr = self.matrix.indptr
+        items = self.terms[self.matrix.indices].tolist()
+        return [items[indptr[i]:indptr[i + 1]] if self.valid[i] else np.nan
+                for i in range(len(self))]
+
+    def to_series(self):
+        return pd.Series(self.to_lists(), index = self.index,
+                         name = self.name, dtype = object)
+
+    def to_arrow(self):
+        return pa.ListArray.from_arrays(
+            pa.array(self.matrix.indptr, type = pa.int32()),
+            pa.array(self.terms[self.matrix.indices], type = pa.string()),
+            mask = pa.array(~self.valid))
+
+    def code(self, term):
+        # The code of `term`, or None if no school has it.
+        i = np.searchsorted(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def contains(self, term):
+        # A boolean mask of the rows whose list has `term`.
+        mask = np.zeros(len(self), dtype = bool)
+        code = self.code(term)
+        if code is not None:
+            positions = np.flatnonzero(self.matrix.indices == code)
+            mask[np.searchsorted(self.matrix.indptr, positions,
+                                 side = 'right') - 1] = True
+        return mask
+
+    def term_counts(self):
+        # How many rows have each term.
+        return pd.Series(np.bincount(self.matrix.indices,
+                                     minlength = len(self.terms)),
+                         index = self.terms)
+
+    def memory_usage(self):
+        return (self.matrix.indptr.nbytes + self.matrix.indices.nbytes
+                + self.matrix.data.nbytes + self.valid.nbytes
+                + pd.Series(self.terms).memory_usage(deep = True))
+
+
+# COMPACT FRAMES
+##############################################################################
+class CompactFrame:
+    # A school table with its scalar columns in compact dtypes and its list
+    # columns as `ListColumn`s (`lists`), keeping the original column order
+    # in `columns`. `valid` has the validity mask of each integer column with
+    # missing values. The scalar columns are stored as they are in `_data`,
+    # where those missing values are 0, so they are read through `[col]`,
+    # `frame` or `sum`, which take the masks into account.
+    def __init__(self, data, lists, columns, valid = None):
+        self._data = data
+        self.lists = lists
+        self.columns = columns
+        self.valid = valid or {}
+
+    @classmethod
+    def from_frame(cls, df, ranges = num_col_ranges):
+        scalars = {}
+        lists = {}
+        valid = {}
+        int_names = {name for name, _ in INT_DTYPES}
+        for col in df.columns:
+            dtype = get_compact_dtype(df[col], ranges)
+            if dtype == 'list':
+                lists[col] = ListColumn.from_series(df[col])
+            elif dtype is None:
+                scalars[col] = df[col]
+            elif dtype in int_names:
+                s = compact_series(df[col], dtype)
+                if s.hasnans:
+                    valid[col] = s.notna().to_numpy()
+                scalars[col] = s.to_numpy(s.dtype.numpy_dtype,
+                                          na_value = 0)
+            else:
+                scalars[col] = compact_series(df[col], dtype)
+        frame = pd.DataFrame(scalars, index = df.index)
+        return cls(frame, lists, list(df.columns), valid)
+
+    @property
+    def index(self):
+        return self._data.index
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, col):
+        # A Series (integer columns with missing values as nullable
+        # integers), or a `ListColumn` for a list column.
+        if col in self.lists:
+            return self.lists[col]
+        if col in self.valid:
+            values = pd.arrays.IntegerArray(self._data[col].to_numpy(),
+                                            ~self.valid[col])
+            return pd.Series(values, index = self.index, name = col)
+        return self._data[col]
+
+    @property
+    def frame(self):
+        # The scalar columns as an ordinary frame (integer columns with
+        # missing values as nullable integers).
+        return pd.DataFrame({col: self[col] for col in self._data.columns},
+                            index = self.index)
+
+    def sum(self, cols = None):
+        # The sum of each numeric column (or of `cols`), skipping missing
+        # values, scanning each column's plain array.
+        if cols is None:
+            cols = self._data.select_dtypes('number').columns
+        sums = {}
+        for col in cols:
+            values = self._data[col].to_numpy()
+            if values.dtype.kind == 'f':
+                sums[col] = np.nansum(values, dtype = np.float64)
+            else:
+                # Missing integers are stored as 0.
+                sums[col] = np.add.reduce(values, dtype = np.float64)
+        return pd.Series(sums, dtype = np.float64)
+
+    def to_frame(self):
+        # Back to an ordinary frame, with lists as Python lists again (the
+        # compact dtypes are kept).
+        cols = {col: (self.lists[col].to_series() if col in self.lists
+                      else self[col])
+                for col in self.columns}
+        return pd.DataFrame(cols, index = self.index)
+
+    def memory_usage(self):
+        # Bytes used, by column.
+        usage = self._data.memory_usage(deep = True, index = False)
+        for col, mask in self.valid.items():
+            usage[col] += mask.nbytes
+        for col, column in self.lists.items():
+            usage[col] = column.memory_usage()
+        return usage[self.columns]
+
+    # Saving.
+    def save(self, path):
+        table = pa.Table.from_pandas(self.frame,
+                                     preserve_index = True)
+        for col, column in self.lists.items():
+            table = table.append_column(col, column.to_arrow())
+        metadata = {**table.schema.metadata,
+                    COMPACT_METADATA_KEY: json.dumps(self.columns)}
+        table = table.replace_schema_metadata(metadata)
+        tmp_path = path + '.tmp'
+        pq.write_table(table, tmp_path, compression = COMPRESSION)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, columns = None, ranges = num_col_ranges):
+        # Load a saved `CompactFrame`, or any Parquet file of the school
+        # table (e.g. a `collegedata_storage` stage), or just `columns` of
+        # it. List columns go straight from Arrow into `ListColumn`s.
+        table = pq.read_table(path, columns = columns,
+                              use_pandas_metadata = True)
+        metadata = table.schema.metadata or {}
+        list_cols = [field.name for field in table.schema
+                     if pa.types.is_list(field.type)]
+        lists = {col: table.column(col) for col in list_cols}
+        frame = table.drop(list_cols).to_pandas()
+        lists = {col: ListColumn.from_arrow(array, frame.index, col)
+                 for col, array in lists.items()}
+        if COMPACT_METADATA_KEY in metadata:
+            order = json.loads(metadata[COMPACT_METADATA_KEY])
+        else:
+            order = [field.name for field in table.schema]
+        present = set(frame.columns) | set(lists)
+        order = [col for col in order if col in present]
+        compact = cls.from_frame(frame, ranges)
+        return cls(compact._data, lists, order, compact.valid)
+
+def load_compact(stage, columns = None, path = None):
+    # `collegedata_storage.load_stage`, into a `CompactFrame`.
+    if path is None:
+        path = STAGE_PATHS[stage]
+    return CompactFrame.load(path, columns)
+
+
+# BENCHMARK
+##############################################################################
+def get_benchmark_frame(rows = 2000, seed = 0, terms = 400):
+    # A made-up joined frame (`get_synthetic_joined`, with the columns that
+    # are whole numbers on CollegeData rounded, and a `City`) plus the list
+    # columns, drawn from the saved school's lists and `terms` made-up ones.
+    rng = np.random.default_rng(seed)
+    df = get_synthetic_joined(rows, seed).copy()
+    for col, (low, high) in num_col_ranges.items():
+        if col in df and high - low > 30:
+            df[col] = df[col].round()
+    cities = np.array(['City {}'.format(i) for i in range(rows // 4)],
+                      dtype = object)
+    df['City'] = cities[rng.integers(0, len(cities), rows)]
+    saved = extract_record(load_saved_school(59), 59)
+    for col in LIST_COLS:
+        vocabulary = np.array(saved.get(col, []) + ['{} {}'.format(col, i)
+                                                    for i in range(terms)],
+                              dtype = object)
+        counts = rng.poisson(40 if col in CAPTION_STRINGS else 8, rows)
+        df[col] = [sorted(set(vocabulary[rng.integers(0, len(vocabulary),
+                                                      count)]))
+                   if rng.random() > 0.05 else np.nan
+                   for count in counts]
+    return df
+
+def get_list_memory(s):
+    # Deep size of a column of Python lists (`memory_usage(deep = True)`
+    # only counts the lists themselves).
+    usage = s.memory_usage(deep = True, index = False)
+    items = [item for value in s if isinstance(value, list)
+             for item in value]
+    return usage + pd.Series(items, dtype = object).memory_usage(
+        deep = True, index = False)
+
+def time_scans(df, num_cols, state_col, list_col, term, repeat):
+    # Seconds for a scan of each kind: summing every numeric column,
+    # filtering on a string column and on a list column's items.
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if isinstance(df, CompactFrame):
+            df.sum(num_cols)
+        else:
+            df[num_cols].sum()
+    num_seconds = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        (df[state_col] == 'PA').to_numpy()
+    state_seconds = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if isinstance(df, CompactFrame):
+            df[list_col].contains(term)
+        else:
+            df[list_col].map(lambda value: isinstance(value, list)
+                             and term in value).to_numpy()
+    list_seconds = (time.perf_counter() - start) / repeat
+    return num_seconds, state_seconds, list_seconds
+
+def frames_match(df, loaded):
+    # Whether `loaded` has every value of `df`, floats to float32 precision.
+    if list(loaded.columns) != list(df.columns):
+        return False
+    for col in df.columns:
+        a = df[col]
+        b = loaded[col]
+        if col in LIST_COLS:
+            same = all((x == y) if isinstance(x, list) else
+                       (not isinstance(y, list))
+                       for x, y in zip(a, b))
+        elif pd.api.types.is_numeric_dtype(a):
+            x = a.to_numpy(dtype = float)
+            y = b.to_numpy(dtype = float, na_value = np.nan)
+            same = np.allclose(x, y, rtol = 1e-6, atol = 0, equal_nan = True)
+        else:
+            same = (a.astype(object).fillna('').tolist()
+                    == b.astype(object).fillna('').tolist())
+        if not same:
+            return False
+    return True
+
+def benchmark_compact(rows = (2000, 20000), seed = 0, repeat = 5):
+    # Memory and scan times of the plain frame against its `CompactFrame`,
+    # checking a save and load gives back every value (floats to float32
+    # precision).
+    results = []
+    for n in rows:
+        df = get_benchmark_frame(n, seed)
+        start = time.perf_counter()
+        compact = CompactFrame.from_frame(df)
+        compact_seconds = time.perf_counter() - start
+        num_cols = list(df.select_dtypes('number').columns)
+        list_col = 'Sports, Women, Offered'
+        term = 'Basketball'
+        plain_bytes = (df.drop(columns = LIST_COLS)
+                       .memory_usage(deep = True, index = False).sum()
+                       + sum(get_list_memory(df[col]) for col in LIST_COLS))
+        compact_bytes = compact.memory_usage().sum()
+        plain_times = time_scans(df, num_cols, 'State', list_col, term,
+                                 repeat)
+        compact_times = time_scans(compact, num_cols, 'State', list_col,
+                                   term, repeat)
+
+        fd, path = tempfile.mkstemp(suffix = '.parquet')
+        os.close(fd)
+        try:
+            compact.save(path)
+            loaded = CompactFrame.load(path).to_frame()
+        finally:
+            os.remove(path)
+        results.append({'rows': n,
+                        'plain_mb': plain_bytes / 1e6,
+                        'compact_mb': compact_bytes / 1e6,
+                        'shrink': plain_bytes / compact_bytes,
+                        'compact_seconds': compact_seconds,
+                        'sum_speedup': plain_times[0] / compact_times[0],
+                        'state_speedup': plain_times[1] / compact_times[1],
+                        'list_speedup': plain_times[2] / compact_times[2],
+                        'round_trip': frames_match(df, loaded)})
+    return pd.DataFrame(results)
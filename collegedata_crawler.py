@@ -0,0 +1,301 @@
+# CollegeData async crawler.
+import asyncio
+import hashlib
+import random
+import time
+from collections import namedtuple
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os.path import isfile, join
+from threading import Thread
+from urllib.parse import urlsplit, parse_qs
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from collegedata_scraper import (HEADERS, PAGE_IDS, SCHOOL_ID_END,
+                                 SCHOOL_ID_START, URL_PT_1,
+                                 get_collegedata_url)
+
+
+# DEFINITIONS
+##############################################################################
+# Fetching the six pages of a school one after the other with a blocking
+# `requests.get` means a full sweep is ~30,000 sequential round-trips. Instead
+# we keep many requests in flight over a single pooled session. This caps the
+# number of requests in flight at any moment:
+MAX_CONCURRENCY = 24
+# Each school's six pages are requested together, and this many schools are
+# kept in flight at once (so up to 6 * MAX_SCHOOLS_IN_FLIGHT pages queued):
+MAX_SCHOOLS_IN_FLIGHT = 16
+# Be polite to CollegeData - no more than this many requests per second are
+# started against any single host:
+RATE_LIMIT = 10.0
+# A failed request (connection error, timeout, or one of these statuses) is
+# retried with exponential backoff plus jitter, instead of giving up:
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# Seconds before a single request is abandoned (and maybe retried):
+REQUEST_TIMEOUT = 30
+
+# Everything fetched for a school. `pages` holds the raw HTML of each page in
+# `PAGE_IDS` order, `statuses` the matching HTTP status codes. A page that
+# could not be fetched even after retrying has a `None` page, and a status of
+# `None` if no response was ever received.
+SchoolPages = namedtuple('SchoolPages', ['school_id', 'pages', 'statuses'])
+
+
+# RATE LIMITING
+##############################################################################
+class RateLimiter:
+    # Token bucket: `rate` request starts per second, allowing short bursts
+    # of up to `burst` requests.
+    def __init__(self, rate = RATE_LIMIT, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.tokens = min(self.burst,
+                                  self.tokens + elapsed * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+    # Keep a separate `RateLimiter` for every host we talk to.
+    def __init__(self, rate = RATE_LIMIT, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.limiters = {}
+
+    async def wait(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.limiters:
+            self.limiters[host] = RateLimiter(self.rate, self.burst)
+        await self.limiters[host].wait()
+
+
+# FETCHING
+##############################################################################
+def get_backoff(attempt, base = BACKOFF_BASE, cap = BACKOFF_MAX):
+    # "Full jitter" exponential backoff.
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+async def fetch_page(session, url, limiter, semaphore, retries = MAX_RETRIES,
+                     headers = None, metrics = None):
+    # Returns `(status, text, response_headers)`. Unlike
+    # `collegedata_scraper.get_soup`, an unusual status code doesn't raise a
+    # `PageRequestError` - transient failures are retried, and anything else
+    # is handed back to the caller with a `None` text so it can be recorded.
+    # A 304 Not Modified (from a conditional request) also has no text.
+    # Every attempt is recorded in `metrics` (a
+    # `collegedata_metrics.Metrics`), if given.
+    status = None
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(get_backoff(attempt - 1))
+        await limiter.wait(url)
+        try:
+            async with semaphore:
+                if metrics is not None:
+                    metrics.request_started(retry = attempt > 0)
+                start = time.monotonic()
+                status = None
+                size = 0
+                try:
+                    async with session.get(url,
+                                           headers = headers) as response:
+                        status = response.status
+                        if status == 200:
+                            body = await response.read()
+                            size = len(body)
+                            # A stray byte in the wrong encoding mustn't
+                            # stop the crawl.
+                            text = body.decode(response.get_encoding(),
+                                               errors = 'replace')
+                            return status, text, response.headers
+                        if status == 304:
+                            return status, None, response.headers
+                finally:
+                    if metrics is not None:
+                        metrics.request_finished(
+                            status, time.monotonic() - start, size)
+        except (ClientError, asyncio.TimeoutError):
+            status = None
+            continue
+        if status not in RETRY_STATUSES:
+            break
+    return status, None, {}
+
+async def fetch_school(session, school_id, limiter, semaphore,
+                       url_pt_1 = URL_PT_1, page_ids = PAGE_IDS,
+                       cache = None, refresh = False, metrics = None):
+    # Request all of a school's pages at the same time.
+    #
+    # With a `collegedata_cache.PageCache`, pages already in the cache are
+    # read from disk and never requested, and everything fetched is stored.
+    # In `refresh` mode cached pages are re-requested conditionally instead
+    # (If-None-Match / If-Modified-Since); an unchanged page comes back as a
+    # bodiless 304, is read from the cache, and keeps the 304 status. A
+    # re-request that fails (no response, an error status) leaves the cached
+    # copy as it was, and its text is used, with the failed status.
+    # Requests (and pages read from the cache) are recorded in `metrics`.
+    statuses = {}
+    pages = {}
+    requests = {}
+    cached_pages = {}
+    for page_id in page_ids:
+        cached = cache.get(school_id, page_id) if cache is not None else None
+        cached_pages[page_id] = cached
+        if cached is not None and not refresh:
+            statuses[page_id] = 200
+            pages[page_id] = cached
+            if metrics is not None:
+                metrics.page_cached()
+            continue
+        headers = None
+        if cached is not None:
+            headers = cache.conditional_headers(school_id, page_id)
+        url = get_collegedata_url(school_id, page_id, url_pt_1)
+        requests[page_id] = fetch_page(session, url, limiter, semaphore,
+                                       headers = headers, metrics = metrics)
+
+    results = await asyncio.gather(*requests.values())
+    for page_id, (status, text, headers) in zip(requests, results):
+        if status == 304:
+            cache.touch(school_id, page_id)
+            text = cached_pages[page_id]
+        elif cache is not None and (status == 200
+                                    or cached_pages[page_id] is None):
+            cache.put(school_id, page_id, text, status,
+                      headers.get('ETag'), headers.get('Last-Modified'))
+        elif cache is not None:
+            text = cached_pages[page_id]
+        statuses[page_id] = status
+        pages[page_id] = text
+    if cache is not None and requests:
+        cache.commit()
+
+    return SchoolPages(school_id, [pages[page_id] for page_id in page_ids],
+                       [statuses[page_id] for page_id in page_ids])
+
+
+# CRAWLING
+##############################################################################
+def open_session(concurrency = MAX_CONCURRENCY, timeout = REQUEST_TIMEOUT):
+    # A single session pools and reuses connections (keep-alive) across all
+    # requests, rather than a new connection for each page.
+    connector = TCPConnector(limit = concurrency, limit_per_host = concurrency,
+                             ttl_dns_cache = 300)
+    return ClientSession(connector = connector, headers = HEADERS,
+                         timeout = ClientTimeout(total = timeout))
+
+async def crawl_schools(school_ids, url_pt_1 = URL_PT_1,
+                        concurrency = MAX_CONCURRENCY,
+                        schools_in_flight = MAX_SCHOOLS_IN_FLIGHT,
+                        rate = RATE_LIMIT, session = None, cache = None,
+                        refresh = False, metrics = None):
+    # Async generator yielding a `SchoolPages` for every id in `school_ids`,
+    # in order of completion (not necessarily the order of `school_ids`).
+    # See `fetch_school` for `cache`, `refresh` and `metrics`.
+    own_session = session is None
+    if own_session:
+        session = open_session(concurrency)
+    limiter = HostRateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    school_ids = iter(school_ids)
+    pending = set()
+    try:
+        while True:
+            # Top up the schools in flight from the remaining ids.
+            while len(pending) < schools_in_flight:
+                school_id = next(school_ids, None)
+                if school_id is None:
+                    break
+                pending.add(asyncio.ensure_future(fetch_school(
+                    session, school_id, limiter, semaphore, url_pt_1,
+                    cache = cache, refresh = refresh, metrics = metrics)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(
+                pending, return_when = asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if own_session:
+            await session.close()
+
+def crawl(callback, start = SCHOOL_ID_START, stop = SCHOOL_ID_END,
+          school_ids = None, **kwargs):
+    # Blocking entry point for scripts and notebooks: crawl every school id
+    # from `start` to `stop` inclusive (or just `school_ids`), calling
+    # `callback` with each `SchoolPages` as it completes.
+    if school_ids is None:
+        school_ids = range(start, stop + 1)
+
+    async def run():
+        async for school in crawl_schools(school_ids, **kwargs):
+            callback(school)
+
+    asyncio.run(run())
+
+
+# LOCAL STAND-IN SERVER
+##############################################################################
+# To test the crawler without hitting CollegeData, saved pages can be served
+# from a local directory laid out as `{directory}/{school_id}/{page_id}.html`.
+# Ids with no saved page get a 404.
+class SavedPageHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            page_id = int(url.path.split('college_pg0')[1].split('_')[0])
+            school_id = int(parse_qs(url.query)['schoolId'][0])
+        except (IndexError, KeyError, ValueError):
+            self.send_error(400)
+            return
+        path = join(self.directory, str(school_id), str(page_id) + '.html')
+        if not isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as file:
+            body = file.read()
+        # Validators, so conditional re-fetches can be tested too.
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_saved_pages(directory, port = 0):
+    # Start serving in a background thread. Returns the server (call its
+    # `shutdown()` when finished) and the `url_pt_1` to hand to the crawler.
+    handler = partial(SavedPageHandler, directory = directory)
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    Thread(target = server.serve_forever, daemon = True).start()
+    host, port = server.server_address
+    url_pt_1 = "http://{}:{}{}".format(host, port, urlsplit(URL_PT_1).path)
+    return server, url_pt_1
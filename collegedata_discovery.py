@@ -0,0 +1,198 @@
+# CollegeData school id discovery.
+import asyncio
+import json
+import os
+import re
+from os.path import isfile
+
+from aiohttp import ClientError
+
+from collegedata_crawler import (MAX_CONCURRENCY, MAX_RETRIES, RATE_LIMIT,
+                                 RETRY_STATUSES, HostRateLimiter, get_backoff,
+                                 open_session)
+from collegedata_scraper import (EMPTY_H1_HEADING, SCHOOL_ID_START, URL_PT_1,
+                                 get_collegedata_url)
+
+
+# DEFINITIONS
+##############################################################################
+# Finding out an id has no school used to cost a full page download (or six).
+# Instead, each id is probed once: request a single page, read only until its
+# <h1> heading shows up, and hang up. We ask for just the first
+# PROBE_MAX_BYTES with a Range header, and stop reading there either way (if
+# the server sends back less than that without the <h1>, the page is asked
+# for again without the Range header):
+PROBE_PAGE_ID = 1
+PROBE_CHUNK_BYTES = 4096
+PROBE_MAX_BYTES = 65536
+H1_RE = re.compile(rb'<h1[^>]*>(.*?)</h1>', re.IGNORECASE | re.DOTALL)
+# What we learn about an id from probing it:
+VALID = 'valid'
+EMPTY = 'empty'
+FAILED = 'failed'
+# Ids up to here are mostly schools and are all probed. Above it, most ids are
+# empty, so we probe sparsely: after every batch with no schools the stride
+# between probes doubles (up to MAX_STRIDE), and when a school turns up the
+# ids skipped on either side of it are filled in and the stride drops to 1.
+DENSE_UNTIL = 1000
+MAX_STRIDE = 8
+PROBE_BATCH = 32
+# I'm fairly confident there are no schools over 5000.
+DISCOVERY_ID_END = 5000
+# The probe results are kept between sweeps, so known ids are never probed
+# twice (failed probes are retried):
+SCHOOL_ID_INDEX_PATH = "data/school_id_index.json"
+
+
+# ID INDEX
+##############################################################################
+def load_id_index(path = SCHOOL_ID_INDEX_PATH):
+    # Returns `{school_id: {'state': ..., 'name': ...}}`.
+    if not isfile(path):
+        return {}
+    with open(path) as file:
+        index = json.load(file)
+    return {int(school_id): entry for school_id, entry in index.items()}
+
+def save_id_index(index, path = SCHOOL_ID_INDEX_PATH):
+    # Write then rename, so a crash mid-write keeps the previous index.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({str(school_id): index[school_id]
+                   for school_id in sorted(index)}, file, indent = 1)
+    os.replace(tmp_path, path)
+
+def get_valid_ids(index = None, path = SCHOOL_ID_INDEX_PATH):
+    # The known-good ids to hand to the full six-page crawl.
+    if index is None:
+        index = load_id_index(path)
+    return sorted(school_id for school_id, entry in index.items()
+                  if entry['state'] == VALID)
+
+
+# PROBING
+##############################################################################
+def read_h1(head):
+    # The decoded <h1> text in the start of a page, or None if not there yet.
+    match = H1_RE.search(head)
+    if not match:
+        return None
+    text = re.sub(rb'<[^>]+>', b'', match.group(1))
+    return text.decode('utf-8', errors = 'replace').strip()
+
+async def get_h1(session, url, limiter, semaphore, headers = None):
+    # `(status, h1)` for one request, reading no more than PROBE_MAX_BYTES of
+    # the page (`h1` is None if it wasn't found, or the status isn't 2xx).
+    await limiter.wait(url)
+    async with semaphore:
+        async with session.get(url, headers = headers) as response:
+            status = response.status
+            h1 = None
+            if status in (200, 206):
+                head = b''
+                while h1 is None and len(head) < PROBE_MAX_BYTES:
+                    chunk = await response.content.read(PROBE_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    head += chunk
+                    h1 = read_h1(head)
+            return status, h1
+
+async def probe_school(session, school_id, limiter, semaphore,
+                       url_pt_1 = URL_PT_1, retries = MAX_RETRIES):
+    # Returns `(state, name)` for a single id.
+    url = get_collegedata_url(school_id, PROBE_PAGE_ID, url_pt_1)
+    headers = {'Range': 'bytes=0-{}'.format(PROBE_MAX_BYTES - 1)}
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(get_backoff(attempt - 1))
+        try:
+            status, h1 = await get_h1(session, url, limiter, semaphore,
+                                      headers)
+            if status == 206 and h1 is None:
+                # The range came back short of the <h1>.
+                status, h1 = await get_h1(session, url, limiter, semaphore)
+        except (ClientError, asyncio.TimeoutError):
+            continue
+        if status in (200, 206):
+            if h1 is None:
+                # Not a normal CollegeData page.
+                return FAILED, None
+            if h1 == EMPTY_H1_HEADING:
+                return EMPTY, None
+            return VALID, h1
+        if status == 404:
+            return EMPTY, None
+        if status not in RETRY_STATUSES:
+            break
+    return FAILED, None
+
+async def probe_ids(session, school_ids, index, limiter, semaphore,
+                    url_pt_1 = URL_PT_1, reprobe = False):
+    # Probe `school_ids` concurrently, recording results into `index`, and
+    # return the ids found to be valid. Ids already in the index are skipped
+    # unless their probe failed (or `reprobe` is set).
+    to_probe = [school_id for school_id in school_ids
+                if reprobe or school_id not in index
+                or index[school_id]['state'] == FAILED]
+    results = await asyncio.gather(
+        *[probe_school(session, school_id, limiter, semaphore, url_pt_1)
+          for school_id in to_probe])
+    for school_id, (state, name) in zip(to_probe, results):
+        index[school_id] = {'state': state, 'name': name}
+    return [school_id for school_id in school_ids
+            if school_id in index and index[school_id]['state'] == VALID]
+
+
+# DISCOVERY
+##############################################################################
+async def discover_ids(start = SCHOOL_ID_START, stop = DISCOVERY_ID_END,
+                       url_pt_1 = URL_PT_1, path = SCHOOL_ID_INDEX_PATH,
+                       concurrency = MAX_CONCURRENCY, rate = RATE_LIMIT,
+                       reprobe = False):
+    index = load_id_index(path)
+    limiter = HostRateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    session = open_session(concurrency)
+    try:
+        # Probe every id in the dense range, a batch at a time so the index
+        # can be saved as we go.
+        dense_ids = list(range(start, min(stop, DENSE_UNTIL) + 1))
+        for i in range(0, len(dense_ids), PROBE_BATCH * 4):
+            batch = dense_ids[i:i + PROBE_BATCH * 4]
+            await probe_ids(session, batch, index, limiter, semaphore,
+                            url_pt_1, reprobe)
+            save_id_index(index, path)
+
+        # Probe the sparse range with an adaptive stride.
+        school_id = max(start, DENSE_UNTIL + 1)
+        stride = 1
+        while school_id <= stop:
+            batch = list(range(school_id, stop + 1, stride))[:PROBE_BATCH]
+            hits = await probe_ids(session, batch, index, limiter, semaphore,
+                                   url_pt_1, reprobe)
+            if hits:
+                # Schools cluster, so fill in the ids skipped over on either
+                # side of each hit.
+                if stride > 1:
+                    gaps = []
+                    for hit in hits:
+                        gaps += range(max(school_id, hit - stride + 1), hit)
+                        gaps += range(hit + 1, min(hit + stride, stop + 1))
+                    await probe_ids(session, gaps, index, limiter, semaphore,
+                                    url_pt_1, reprobe)
+                school_id = batch[-1] + 1
+                stride = 1
+            else:
+                school_id = batch[-1] + stride
+                stride = min(stride * 2, MAX_STRIDE)
+            save_id_index(index, path)
+    finally:
+        await session.close()
+        save_id_index(index, path)
+    return get_valid_ids(index)
+
+def discover(start = SCHOOL_ID_START, stop = DISCOVERY_ID_END, **kwargs):
+    # Blocking entry point; returns the sorted valid ids, e.g. to pass as
+    # `collegedata_crawler.crawl(callback, school_ids = discover())`.
+    return asyncio.run(discover_ids(start, stop, **kwargs))
@@ -0,0 +1,377 @@
+# CollegeData single-pass page extractor.
+import re
+import time
+import tracemalloc
+from os.path import join
+
+from lxml.html import fromstring
+
+from collegedata_scraper import (PAGE_IDS, extract_school,
+                                 parse_collegedata_page)
+
+
+# DEFINITIONS
+##############################################################################
+# `collegedata_scraper.extract_school` re-serializes every parsed page and
+# hands it to `pd.read_html`, which parses the HTML a second time and builds
+# a DataFrame for every little table. Here each page is parsed once with lxml
+# and the tables under `tabcontwrap` are walked directly into a flat record,
+# following the same rules `pd.read_html` uses (so the same keys and values
+# come out):
+# - header rows are the <thead> rows, or else the leading all-<th> rows,
+# - cell text has runs of whitespace collapsed, and a <br> counts as a break,
+# - the first column is the row label, rows without a label are dropped,
+# - thousands separators are dropped from numbers, and a column is numeric
+#   only if every value in it is.
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+             '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN',
+             'n/a', 'nan', 'null', 'Not reported', 'Not Reported'}
+NAN = float('nan')
+WHITESPACE_RE = re.compile(r'[\r\n]+|\s{2,}')
+THOUSANDS_RE = re.compile(r'^[\-\+]?([0-9]+,|[0-9])*(\.[0-9]*)?'
+                          r'([0-9]?(E|e)\-?[0-9]+)?$')
+INT_RE = re.compile(r'^[\-\+]?[0-9]+$')
+FLOAT_RE = re.compile(r'^[\-\+]?([0-9]+\.?[0-9]*|\.[0-9]+)'
+                      r'([eE][\-\+]?[0-9]+)?$')
+# The three single-cell tables, in page order:
+NOCOL_LABELS = ['Entrance Difficulty',
+                "Master's Degrees Offered",
+                "Doctoral Degrees Offered"]
+SPORTS_LABELS = ['Sports, Women, Scholarships Given',
+                 'Sports, Women, Offered',
+                 'Sports, Men, Scholarships Given',
+                 'Sports, Men, Offered']
+CAPTION_STRINGS = ['Undergraduate Majors',
+                   "Master's Programs of Study",
+                   'Doctoral Programs of Study']
+# Saved pages used to compare the two extractors, laid out the way
+# `collegedata_crawler.serve_saved_pages` serves them:
+FIXTURES_DIR = "data/fixtures/collegedata"
+
+
+# TABLES
+##############################################################################
+def is_na(value):
+    return value != value
+
+def cell_text(cell):
+    return WHITESPACE_RE.sub(' ', cell.text_content().strip())
+
+def expand_rows(rows):
+    # Text of each row, with colspan/rowspan cells repeated.
+    all_texts = []
+    remainder = []
+    for tr in rows:
+        texts = []
+        next_remainder = []
+        index = 0
+        for td in tr.xpath('./td|./th'):
+            while remainder and remainder[0][0] <= index:
+                prev_i, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append(
+                        (prev_i, prev_text, prev_rowspan - 1))
+                index += 1
+            text = cell_text(td)
+            rowspan = int(td.get('rowspan') or 1)
+            colspan = int(td.get('colspan') or 1)
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    next_remainder.append((index, text, rowspan - 1))
+                index += 1
+        for prev_i, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_i, prev_text, prev_rowspan - 1))
+        all_texts.append(texts)
+        remainder = next_remainder
+    while remainder:
+        next_remainder = []
+        texts = []
+        for prev_i, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_i, prev_text, prev_rowspan - 1))
+        all_texts.append(texts)
+        remainder = next_remainder
+    return all_texts
+
+def convert_column(values):
+    # Mimic pandas' type inference for one column of cell strings.
+    values = [NAN if value in NA_VALUES else value for value in values]
+    for i, value in enumerate(values):
+        if not is_na(value) and ',' in value and THOUSANDS_RE.match(value):
+            values[i] = value.replace(',', '')
+    present = [value for value in values if not is_na(value)]
+    if all(INT_RE.match(value) for value in present):
+        if len(present) == len(values):
+            return [int(value) for value in values]
+        return [NAN if is_na(value) else float(value) for value in values]
+    if all(FLOAT_RE.match(value) for value in present):
+        return [NAN if is_na(value) else float(value) for value in values]
+    return values
+
+def mangle(labels):
+    # Duplicate column labels get '.1', '.2', ... suffixes, like pandas.
+    seen = {}
+    mangled = []
+    for label in labels:
+        if label in seen:
+            seen[label] += 1
+            label = '{}.{}'.format(label, seen[label])
+        else:
+            seen[label] = 0
+        mangled.append(label)
+    return mangled
+
+def read_table(table):
+    # Returns `(index_names, columns, index, cols)` for a <table>, where
+    # `cols` holds each column's converted values (the index is column 0),
+    # or None for a table `pd.read_html` would skip.
+    if not any(text.strip() for text in table.xpath('.//*/text()')):
+        return None
+    for element in table.xpath('.//*[@style]'):
+        if 'display:none' in element.get('style', '').replace(' ', ''):
+            element.getparent().remove(element)
+
+    head_rows = []
+    for thead in table.xpath('.//thead'):
+        head_rows += thead.xpath('./tr')
+    body_rows = table.xpath('.//tbody//tr') + table.xpath('./tr')
+    if not head_rows:
+        while body_rows and all(td.tag == 'th'
+                                for td in body_rows[0].xpath('./td|./th')):
+            head_rows.append(body_rows.pop(0))
+    head = expand_rows(head_rows)
+    body = expand_rows(body_rows) + expand_rows(table.xpath('.//tfoot//tr'))
+    if len(head) > 1:
+        head = [row for row in head if any(row)]
+    rows = head + body
+    if not rows:
+        return None
+    width = max(len(row) for row in rows)
+    rows = [row + [''] * (width - len(row)) for row in rows]
+    head, body = rows[:len(head)], rows[len(head):]
+
+    if not head:
+        index_names = [None]
+        columns = [str(j) for j in range(1, width)]
+    elif len(head) == 1:
+        index_names = [head[0][0] or None]
+        columns = mangle([label or 'Unnamed: {}'.format(j)
+                          for j, label in enumerate(head[0]) if j])
+    else:
+        index_names = [row[0] or None for row in head]
+        columns = list(zip(*[row[1:] for row in head]))
+    cols = [convert_column([row[j] for row in body]) for j in range(width)]
+
+    # Drop rows with no label.
+    keep = [i for i, label in enumerate(cols[0]) if not is_na(label)]
+    index = [cols[0][i] for i in keep]
+    cols = [[col[i] for i in keep] for col in cols[1:]]
+    return index_names, columns, index, cols
+
+
+# EXTRACTION
+##############################################################################
+def single_string(element):
+    # Like BeautifulSoup's `.string`: the text of an element with a single
+    # child (descending through single-child elements), else None.
+    while True:
+        children = list(element)
+        if not children:
+            return element.text
+        if len(children) > 1 or element.text or children[0].tail:
+            return None
+        element = children[0]
+
+def stripped_strings(element):
+    strings = [text.strip() for text in element.xpath('.//text()')]
+    return [text for text in strings if text]
+
+def parse_page(html):
+    # Parse a raw page, returning its root and its `tabcontwrap` content.
+    root = fromstring(html)
+    content = root.find(".//div[@id='tabcontwrap']")
+    return root, content
+
+def extract_record(htmls, school_id = None, parsed = None):
+    # The lxml version of `collegedata_scraper.extract_school`: takes the raw
+    # HTML of a school's six pages and returns a dict with the same keys and
+    # values as that function's Series (`school_s.to_dict()`). The pages can
+    # be passed already `parsed` (by `parse_page`, and not used since).
+    if parsed is None:
+        parsed = [parse_page(html) for html in htmls]
+    contents = [content for _, content in parsed]
+    pairs = []
+
+    # Name and Description from the first page.
+    root, content = parsed[0]
+    pairs.append(('Name', root.find('.//h1').text_content()))
+    p = content.find('.//p') if content is not None else None
+    if p is not None:
+        pairs.append(('Description', p.text_content()))
+
+    # Read every table on every page in one walk of each page's content.
+    nocol = []
+    onecol = []
+    subject_tables = []
+    factor_tables = []
+    sports_tables = []
+    for content in contents:
+        if content is None:
+            continue
+        # Treat <br> as a line break in cell text, as `pd.read_html` does.
+        for br in content.iter('br'):
+            br.tail = '\n' + (br.tail or '')
+        for table in content.iter('table'):
+            result = read_table(table)
+            if result is None:
+                continue
+            index_names, columns, index, cols = result
+            if not cols:
+                if index:
+                    nocol.append(index[0])
+            elif len(cols) == 1:
+                if len(index) > 1:
+                    onecol += zip(index, cols[0])
+            elif index_names in [['Subject'], ['Exam']]:
+                subject_tables.append((columns, index, cols))
+            elif index_names == ['Factor']:
+                factor_tables.append((index, columns, cols))
+            elif index_names == ['Sport', 'Offered']:
+                sports_tables.append((index, cols))
+
+    pairs += zip(NOCOL_LABELS, nocol)
+    pairs += onecol
+
+    # Subject/Exam tables: one value per cell, labeled 'row, column'.
+    for columns, index, cols in subject_tables:
+        for column, col in zip(columns, cols):
+            pairs += [(label + ', ' + column, value)
+                      for label, value in zip(index, col)]
+
+    # Use the second, full 'Selection of Students' table: each row is
+    # labeled by its one marked column.
+    if len(factor_tables) > 1:
+        index, columns, cols = factor_tables[1]
+        for i, label in enumerate(index):
+            marked = [column for column, col in zip(columns, cols)
+                      if not is_na(col[i])]
+            pairs.append((label, marked[0] if marked else NAN))
+
+    # 'Intercollegiate Sports Offered': the marked rows of each column.
+    if sports_tables:
+        index, cols = sports_tables[0]
+        for label, col in zip(SPORTS_LABELS, cols):
+            pairs.append((label, [row for row, value in zip(index, col)
+                                  if not is_na(value)]))
+
+    # FAFSA code.
+    if len(contents) > 2 and contents[2] is not None:
+        div = contents[2].find(".//div[@id='section10']")
+        if div is not None:
+            tables = list(div.iter('table'))
+            if len(tables) == 3:
+                tbody = tables[2].find('.//tbody')
+                if tbody is not None and tbody.find('.//th') is not None:
+                    text = tbody.find('.//th').text_content()
+                    pairs.append(('FAFSA Code', text.replace('\n', '')[-6:]))
+
+    # Majors and programs of study.
+    if len(contents) > 3 and contents[3] is not None:
+        for caption_string in CAPTION_STRINGS:
+            regex = re.compile(caption_string)
+            for caption in contents[3].iter('caption'):
+                string = single_string(caption)
+                if string is not None and regex.search(string):
+                    th = caption.xpath('following::th[1]')
+                    td = caption.xpath('following::td[1]')
+                    if th and td:
+                        vals = stripped_strings(th[0]) or ['']
+                        vals += stripped_strings(td[0]) or ['']
+                        pairs.append((caption_string, vals))
+                    break
+
+    # Fix the city Population label, drop the map widget.
+    labels = [label for label, _ in pairs]
+    population = [label for label in labels
+                  if isinstance(label, str) and 'Population' in label]
+    if population:
+        value = pairs[labels.index(population[0])][1]
+        pairs = [pair for pair in pairs if pair[0] != population[0]]
+        pairs.append(('City Population', value))
+    widget = [label for label in labels
+              if isinstance(label, str) and 'View Larger Map' in label]
+    if widget:
+        pairs = [pair for pair in pairs if pair[0] != widget[0]]
+
+    record = {}
+    for label, value in pairs:
+        record[label] = value
+    return record
+
+
+# BENCHMARK
+##############################################################################
+def load_saved_school(school_id, directory = FIXTURES_DIR):
+    htmls = []
+    for page_id in PAGE_IDS:
+        path = join(directory, str(school_id), str(page_id) + '.html')
+        with open(path, encoding = 'utf-8') as file:
+            htmls.append(file.read())
+    return htmls
+
+def extract_with_read_html(htmls, school_id = None):
+    pages = [parse_collegedata_page(html) for html in htmls]
+    return extract_school(pages, school_id).to_dict()
+
+def compare_records(old, new):
+    # Labels whose values differ between two records (NaN equals NaN).
+    def same(a, b):
+        if isinstance(a, float) and isinstance(b, float):
+            if is_na(a) and is_na(b):
+                return True
+        return a == b
+    labels = list(old) + [label for label in new if label not in old]
+    return [label for label in labels if label not in old
+            or label not in new or not same(old[label], new[label])]
+
+def time_extractor(extractor, schools, repeat):
+    # Seconds per school, and peak traced memory per school in bytes.
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for school_id, htmls in schools:
+            extractor(htmls, school_id)
+    seconds = (time.perf_counter() - start) / (repeat * len(schools))
+    tracemalloc.start()
+    for school_id, htmls in schools:
+        extractor(htmls, school_id)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / len(schools)
+
+def benchmark_extractors(school_ids = (59,), directory = FIXTURES_DIR,
+                         repeat = 5):
+    # Compare `extract_school` (BeautifulSoup + `pd.read_html`) against
+    # `extract_record` on saved pages, checking they agree.
+    schools = [(school_id, load_saved_school(school_id, directory))
+               for school_id in school_ids]
+    mismatches = {}
+    for school_id, htmls in schools:
+        diff = compare_records(extract_with_read_html(htmls, school_id),
+                               extract_record(htmls, school_id))
+        if diff:
+            mismatches[school_id] = diff
+    old_seconds, old_peak = time_extractor(extract_with_read_html, schools,
+                                           repeat)
+    new_seconds, new_peak = time_extractor(extract_record, schools, repeat)
+    return {'schools': len(schools),
+            'read_html_seconds': old_seconds,
+            'read_html_peak_bytes': old_peak,
+            'lxml_seconds': new_seconds,
+            'lxml_peak_bytes': new_peak,
+            'speedup': old_seconds / new_seconds,
+            'mismatches': mismatches}
@@ -0,0 +1,512 @@
+# Versioned store of yearly CollegeData scrapes, keeping only what changed.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from os.path import getsize, isfile, join
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from collegedata_compact import get_benchmark_frame
+from collegedata_record_log import RECORD_LOG_PATH, get_records_frame
+from collegedata_scraper import PAGE_IDS
+from collegedata_storage import COMPRESSION
+
+
+# DEFINITIONS
+##############################################################################
+# Each scrape used to overwrite `collegedata_raw.csv`, so following the yield
+# gap from year to year meant keeping whole copies and loading them side by
+# side. The history store instead keeps, for every scrape (a snapshot, named
+# by its date), only the values that differ from the snapshot before: one
+# entry per changed cell, as `(SchoolId, column, value)`, with a null value
+# for a cell that has gone missing. The first snapshot is all entries; later
+# ones are usually a small fraction of the table.
+#
+# On disk, each snapshot's entries are one Parquet file, and a manifest lists
+# the snapshots (in date order) and every column name seen (entries refer to
+# columns by their position in it). In memory, all the entries are sorted by
+# school, column and snapshot, so the value of every cell as of any snapshot
+# is the last of its entries up to that snapshot, found for the whole table
+# in a few vectorized passes.
+HISTORY_DIR = 'data/history'
+HISTORY_MANIFEST = 'manifest.json'
+# Values are stored as strings tagged with their type, so that the string
+# '1', the number 1 and the list ['1'] stay apart: 's' for strings, 'i' for
+# ints, 'f' for floats, 'b' for booleans and 'j' for JSON (lists). Whole
+# floats are stored as ints, since a column of ints becomes a float column as
+# soon as any school is missing it, and its other values haven't changed.
+STRING_TAG = 's'
+INT_TAG = 'i'
+FLOAT_TAG = 'f'
+BOOL_TAG = 'b'
+JSON_TAG = 'j'
+# With a `collegedata_cache.PageCache`, a hash of each school's six cached
+# pages is kept in the store as this column too (left out of `as_of` unless
+# asked for), so it can tell which schools' pages changed, even where none of
+# the extracted values did:
+PAGE_HASH_COL = '*page hash*'
+HIDDEN_COLS = {PAGE_HASH_COL}
+
+
+# VALUES
+##############################################################################
+def encode_value(value):
+    # The stored string for a cell, or None if it's missing.
+    if isinstance(value, str):
+        return STRING_TAG + value
+    if isinstance(value, (bool, np.bool_)):
+        return BOOL_TAG + str(int(value))
+    if isinstance(value, (int, np.integer)):
+        return INT_TAG + str(int(value))
+    if isinstance(value, (float, np.floating)):
+        if value != value:
+            return None
+        if float(value).is_integer():
+            return INT_TAG + str(int(value))
+        return FLOAT_TAG + repr(float(value))
+    if value is None or value is pd.NA:
+        return None
+    if isinstance(value, (tuple, np.ndarray)):
+        value = list(value)
+    return JSON_TAG + json.dumps(value)
+
+def decode_value(string):
+    tag, text = string[0], string[1:]
+    if tag == STRING_TAG:
+        return text
+    if tag == FLOAT_TAG:
+        return float(text)
+    if tag == INT_TAG:
+        return int(text)
+    if tag == BOOL_TAG:
+        return text == '1'
+    return json.loads(text)
+
+def get_page_hash(cache, school_id, page_ids = PAGE_IDS):
+    # A hash of the content hashes of a school's cached pages (None if any
+    # isn't cached).
+    hashes = []
+    for page_id in page_ids:
+        meta = cache.get_meta(school_id, page_id)
+        if meta is None or meta['sha1'] is None:
+            return None
+        hashes.append(meta['sha1'])
+    return hashlib.sha1(' '.join(hashes).encode('ascii')).hexdigest()
+
+def get_last_entries(keys):
+    # Positions of the last entry of each run of equal `keys` (sorted).
+    if not len(keys):
+        return np.zeros(0, dtype = np.int64)
+    return np.flatnonzero(np.append(keys[1:] != keys[:-1], True))
+
+
+# HISTORY STORE
+##############################################################################
+class HistoryStore:
+    def __init__(self, root = HISTORY_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok = True)
+        self.manifest_path = join(root, HISTORY_MANIFEST)
+        self.manifest = {'snapshots': [], 'columns': []}
+        if isfile(self.manifest_path):
+            with open(self.manifest_path) as file:
+                self.manifest = json.load(file)
+        self.entries = None
+
+    @property
+    def snapshots(self):
+        # The snapshot dates, oldest first.
+        return [snapshot['date'] for snapshot in self.manifest['snapshots']]
+
+    @property
+    def columns(self):
+        return self.manifest['columns']
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.manifest, file, indent = 1)
+        os.replace(tmp_path, self.manifest_path)
+
+    # Entries.
+    def load_entries(self):
+        # Every entry, as parallel arrays sorted by school, column and
+        # snapshot: `school`, `col` (code), `snap` (position in
+        # `snapshots`) and `value` (code into `values`, or -1 for missing).
+        if self.entries is not None:
+            return self.entries
+        parts = []
+        for snap, snapshot in enumerate(self.manifest['snapshots']):
+            table = pq.read_table(join(self.root, snapshot['file']))
+            parts.append((table.column('school').to_numpy(),
+                          table.column('col').to_numpy(),
+                          np.full(table.num_rows, snap, dtype = np.int16),
+                          table.column('value').to_numpy(
+                              zero_copy_only = False)))
+        if parts:
+            school, col, snap, value = (np.concatenate(arrays)
+                                        for arrays in zip(*parts))
+        else:
+            school = np.zeros(0, dtype = np.int64)
+            col = np.zeros(0, dtype = np.int32)
+            snap = np.zeros(0, dtype = np.int16)
+            value = np.zeros(0, dtype = object)
+        order = np.lexsort((snap, col, school))
+        codes, values = pd.factorize(value[order], use_na_sentinel = True)
+        self.entries = {'school': school[order],
+                        'col': col[order],
+                        'snap': snap[order],
+                        'value': codes.astype(np.int32),
+                        'values': np.asarray(values, dtype = object),
+                        'decoded': {}}
+        return self.entries
+
+    def decode(self, codes):
+        # Values for value codes (NaN for -1), decoding each distinct value
+        # once.
+        entries = self.load_entries()
+        decoded = entries['decoded']
+        present = codes >= 0
+        unique, inverse = np.unique(codes[present], return_inverse = True)
+        # (Filled one by one, so list values aren't taken as more axes.)
+        lookup = np.empty(len(unique), dtype = object)
+        for i, code in enumerate(unique):
+            if code not in decoded:
+                decoded[code] = decode_value(entries['values'][code])
+            lookup[i] = decoded[code]
+        out = np.full(len(codes), np.nan, dtype = object)
+        out[present] = lookup[inverse]
+        return out
+
+    def get_snap(self, date):
+        # The position of the last snapshot on or before `date` (the latest
+        # if None), or -1 if there is none.
+        if date is None:
+            return len(self.snapshots) - 1
+        return int(np.searchsorted(self.snapshots, str(date),
+                                   side = 'right')) - 1
+
+    def get_col_codes(self, columns):
+        index = {col: i for i, col in enumerate(self.columns)}
+        return np.array([index[col] for col in columns if col in index],
+                        dtype = np.int32)
+
+    def current_state(self, snap):
+        # Positions (in the loaded entries) of every cell's last entry up to
+        # `snap`, for cells that aren't missing.
+        entries = self.load_entries()
+        at = np.flatnonzero(entries['snap'] <= snap)
+        keys = (entries['school'][at].astype(np.int64) * len(self.columns)
+                + entries['col'][at])
+        at = at[get_last_entries(keys)]
+        return at[entries['value'][at] >= 0]
+
+    # Writing.
+    def add_snapshot(self, df, date, partial = False, cache = None):
+        # Add a scrape (a frame indexed by SchoolId) as of `date`, which must
+        # come after every snapshot so far. Normally a school missing from
+        # `df` has gone (all its values become missing); with `partial`,
+        # only the schools in `df` were re-scraped and the rest carry over.
+        # With `cache` (a `collegedata_cache.PageCache`), each school's page
+        # hash is stored too. Returns what changed.
+        date = str(date)
+        if self.snapshots and date <= self.snapshots[-1]:
+            raise ValueError('Snapshot {} is not after {}'.format(
+                date, self.snapshots[-1]))
+        df = df.drop(columns = [col for col in HIDDEN_COLS if col in df])
+        if cache is not None:
+            df = df.assign(**{PAGE_HASH_COL: [get_page_hash(cache, school_id)
+                                              for school_id in df.index]})
+        for col in df.columns:
+            if col not in self.columns:
+                self.columns.append(col)
+        n_cols = len(self.columns)
+        school_ids = df.index.to_numpy(dtype = np.int64)
+
+        # The new values, as sorted keys (school, then column) and strings.
+        new_keys = []
+        new_values = []
+        for code, col in zip(self.get_col_codes(df.columns), df.columns):
+            encoded = [encode_value(value) for value in df[col]]
+            present = np.array([value is not None for value in encoded],
+                               dtype = bool)
+            new_keys.append(school_ids[present] * n_cols + code)
+            new_values.append(np.array(encoded, dtype = object)[present])
+        new_keys = np.concatenate(new_keys) if new_keys else \
+            np.zeros(0, dtype = np.int64)
+        new_values = np.concatenate(new_values) if new_values else \
+            np.zeros(0, dtype = object)
+        order = np.argsort(new_keys, kind = 'stable')
+        new_keys = new_keys[order]
+        new_values = new_values[order]
+
+        # The current values, the same way.
+        entries = self.load_entries()
+        at = self.current_state(len(self.snapshots) - 1)
+        old_keys = entries['school'][at].astype(np.int64) * n_cols \
+            + entries['col'][at]
+        old_values = entries['values'][entries['value'][at]]
+        if partial:
+            keep = np.isin(entries['school'][at], school_ids)
+            old_keys = old_keys[keep]
+            old_values = old_values[keep]
+
+        pos = np.minimum(np.searchsorted(old_keys, new_keys),
+                         max(len(old_keys) - 1, 0))
+        found = (old_keys[pos] == new_keys) if len(old_keys) else \
+            np.zeros(len(new_keys), dtype = bool)
+        changed = ~found
+        changed[found] = old_values[pos[found]] != new_values[found]
+        removed = ~np.isin(old_keys, new_keys)
+        keys = np.concatenate([new_keys[changed], old_keys[removed]])
+        values = np.concatenate([new_values[changed],
+                                 np.full(removed.sum(), None, dtype = object)])
+
+        file = 'snapshot-{}.parquet'.format(date)
+        table = pa.table({'school': pa.array(keys // n_cols,
+                                             type = pa.int64()),
+                          'col': pa.array(keys % n_cols, type = pa.int32()),
+                          'value': pa.array(values, type = pa.string())})
+        tmp_path = join(self.root, file + '.tmp')
+        pq.write_table(table, tmp_path, compression = COMPRESSION)
+        os.replace(tmp_path, join(self.root, file))
+        summary = {'date': date,
+                   'file': file,
+                   'schools': len(df),
+                   'changed_schools': len(np.unique(keys // n_cols)),
+                   'changes': int(changed.sum()),
+                   'removed': int(removed.sum())}
+        self.manifest['snapshots'].append(summary)
+        self.save_manifest()
+        self.entries = None
+        return summary
+
+    # Reading.
+    def as_of(self, date = None, columns = None):
+        # The table as it was at the last snapshot on or before `date` (the
+        # latest by default), or just `columns` of it: one row per school
+        # with any value then, columns in the order first seen.
+        entries = self.load_entries()
+        if columns is None:
+            columns = [col for col in self.columns if col not in HIDDEN_COLS]
+        codes = self.get_col_codes(columns)
+        at = self.current_state(self.get_snap(date))
+        at = at[np.isin(entries['col'][at], codes)]
+        schools, rows = np.unique(entries['school'][at], return_inverse = True)
+        position = np.full(len(self.columns), -1)
+        position[codes] = np.arange(len(codes))
+        values = np.full((len(schools), len(codes)), np.nan, dtype = object)
+        values[rows, position[entries['col'][at]]] = \
+            self.decode(entries['value'][at])
+        df = pd.DataFrame(values, columns = [self.columns[code]
+                                             for code in codes],
+                          index = pd.Index(schools, name = 'SchoolId'))
+        return df.infer_objects()
+
+    def column_history(self, col):
+        # One column's value for every school at every snapshot (a column
+        # per snapshot date).
+        if col not in self.columns:
+            raise KeyError(col)
+        entries = self.load_entries()
+        at = np.flatnonzero(entries['col'] == self.columns.index(col))
+        schools, rows = np.unique(entries['school'][at], return_inverse = True)
+        # The value code of each school's latest entry at each snapshot:
+        # -2 where it has none, carried forward from the last it had.
+        codes = np.full((len(schools), len(self.snapshots)), -2)
+        codes[rows, entries['snap'][at]] = entries['value'][at]
+        last = np.where(codes != -2, np.arange(len(self.snapshots)), 0)
+        np.maximum.accumulate(last, axis = 1, out = last)
+        codes = np.take_along_axis(codes, last, axis = 1)
+        values = self.decode(codes.ravel()).reshape(codes.shape)
+        df = pd.DataFrame(values, columns = self.snapshots,
+                          index = pd.Index(schools, name = 'SchoolId'))
+        return df.infer_objects()
+
+    def school_history(self, school_id):
+        # Every change to a school: the date, column and new value (NaN if
+        # it went missing).
+        entries = self.load_entries()
+        at = np.flatnonzero(entries['school'] == school_id)
+        at = at[np.lexsort((entries['col'][at], entries['snap'][at]))]
+        return pd.DataFrame({
+            'date': np.array(self.snapshots)[entries['snap'][at]],
+            'column': np.array(self.columns, dtype = object)[
+                entries['col'][at]],
+            'value': self.decode(entries['value'][at])})
+
+    # Hints for the crawler.
+    def changed_schools(self, since = None, until = None, columns = None):
+        # Schools with a value changed in a snapshot after `since` and up to
+        # `until` (by default, in the latest snapshot), or only in `columns`.
+        entries = self.load_entries()
+        if since is None:
+            start = len(self.snapshots) - 2
+        else:
+            start = self.get_snap(since)
+        stop = self.get_snap(until)
+        picked = (entries['snap'] > start) & (entries['snap'] <= stop)
+        if columns is not None:
+            picked &= np.isin(entries['col'], self.get_col_codes(columns))
+        return np.unique(entries['school'][picked])
+
+    def changed_pages(self, since = None, until = None):
+        # Schools whose cached pages changed (see `add_snapshot`'s `cache`).
+        return self.changed_schools(since, until, [PAGE_HASH_COL])
+
+    def get_recrawl_ids(self, school_ids = None):
+        # `school_ids` (every school ever seen, by default) in the order to
+        # re-scrape them: ids the store has never seen, then schools by the
+        # share of snapshots they changed in (after the first they were in),
+        # the most recently changed first among equals. Crawl the front of
+        # this list (e.g. with `add_snapshot(..., partial = True)`) to catch
+        # most changes early.
+        if not self.snapshots:
+            return [] if school_ids is None else list(school_ids)
+        entries = self.load_entries()
+        keys = entries['school'].astype(np.int64) * len(self.snapshots) \
+            + entries['snap']
+        first = np.unique(keys)
+        schools, starts, counts = np.unique(first // len(self.snapshots),
+                                            return_index = True,
+                                            return_counts = True)
+        first_snap = first[starts] % len(self.snapshots)
+        last_snap = first[starts + counts - 1] % len(self.snapshots)
+        possible = np.maximum(len(self.snapshots) - 1 - first_snap, 1)
+        rate = (counts - 1) / possible
+        order = np.lexsort((-last_snap, -rate))
+        ranked = schools[order].tolist()
+        if school_ids is None:
+            return ranked
+        wanted = set(school_ids)
+        known = set(ranked)
+        return ([school_id for school_id in school_ids
+                 if school_id not in known]
+                + [school_id for school_id in ranked if school_id in wanted])
+
+    def disk_bytes(self):
+        return sum(getsize(join(self.root, snapshot['file']))
+                   for snapshot in self.manifest['snapshots'])
+
+def add_scrape(date, store = None, path = RECORD_LOG_PATH, cache = None,
+               partial = False):
+    # Add a finished scrape's record log to the store (the default one, if
+    # not given) as the snapshot `date`.
+    if store is None:
+        store = HistoryStore()
+    return store.add_snapshot(get_records_frame(path), date, partial, cache)
+
+
+# BENCHMARK
+##############################################################################
+def get_yearly_frames(years = 5, rows = 5000, seed = 0, changed = 0.3,
+                      cells = 0.05, turnover = 0.02):
+    # Made-up yearly scrapes: `get_benchmark_frame`, then each year a
+    # fraction `changed` of the schools change a fraction `cells` of their
+    # numbers, and a fraction `turnover` of schools go and new ones come.
+    rng = np.random.default_rng(seed)
+    df = get_benchmark_frame(rows, seed)
+    num_cols = list(df.select_dtypes('number').columns)
+    frames = [df]
+    for _ in range(years - 1):
+        df = df.copy()
+        schools = rng.random(len(df)) < changed
+        for col in num_cols:
+            hit = schools & (rng.random(len(df)) < cells)
+            df.loc[hit, col] = df.loc[hit, col] * rng.uniform(
+                0.9, 1.1, hit.sum())
+        gone = rng.random(len(df)) < turnover
+        new = df[gone].copy()
+        new.index = pd.RangeIndex(df.index.max() + 1,
+                                  df.index.max() + 1 + len(new),
+                                  name = 'SchoolId')
+        df = pd.concat([df[~gone], new])
+        frames.append(df)
+    return frames
+
+def frames_equal(df, expected):
+    # Whether `df` (from the store) has exactly `expected`'s values.
+    expected = expected.sort_index()
+    if not df.index.equals(expected.index):
+        return False
+    for col in expected.columns:
+        a = [encode_value(value) for value in expected[col]]
+        b = ([encode_value(value) for value in df[col]] if col in df
+             else [None] * len(a))
+        if a != b:
+            return False
+    return True
+
+def benchmark_history(years = 5, rows = 5000, seed = 0):
+    # Disk use and query times of the store against keeping every year's
+    # full Parquet snapshot, checking the store gives back every year.
+    frames = get_yearly_frames(years, rows, seed)
+    dates = ['{}-07-01'.format(2019 + year) for year in range(years)]
+    root = tempfile.mkdtemp()
+    try:
+        store = HistoryStore(join(root, 'history'))
+        start = time.perf_counter()
+        for df, date in zip(frames, dates):
+            store.add_snapshot(df, date)
+        add_seconds = (time.perf_counter() - start) / years
+        full_bytes = 0
+        for df, date in zip(frames, dates):
+            path = join(root, date + '.parquet')
+            pq.write_table(pa.Table.from_pandas(df), path,
+                           compression = COMPRESSION)
+            full_bytes += getsize(path)
+
+        store = HistoryStore(join(root, 'history'))
+        start = time.perf_counter()
+        store.load_entries()
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        middle = store.as_of(dates[years // 2])
+        as_of_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        history = store.column_history('Applications (all)')
+        history_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = [pd.read_parquet(join(root, date + '.parquet'),
+                                  columns = ['Applications (all)'])
+                  for date in dates]
+        full_history_seconds = time.perf_counter() - start
+
+        # A value going missing turns a column of ints into floats; only
+        # that school has changed.
+        missing_store = HistoryStore(join(root, 'missing'))
+        for values, date in zip(([100, 200, 300], [100, 200, np.nan]),
+                                dates):
+            missing_store.add_snapshot(
+                pd.DataFrame({'Applications (all)': values},
+                             index = pd.Index([1, 2, 3], name = 'SchoolId')),
+                date)
+        missing_changed = missing_store.changed_schools().tolist()
+        identical = (frames_equal(middle, frames[years // 2])
+                     and all(frames_equal(store.as_of(date), df)
+                             for date, df in zip(dates, frames))
+                     and all(history[date].dropna().sort_index().equals(
+                                 df['Applications (all)'].dropna()
+                                 .sort_index().astype(float))
+                             for date, df in zip(dates, loaded)))
+        return {'years': years,
+                'rows': rows,
+                'store_mb': store.disk_bytes() / 1e6,
+                'full_snapshots_mb': full_bytes / 1e6,
+                'entries': len(store.load_entries()['school']),
+                'add_seconds': add_seconds,
+                'load_seconds': load_seconds,
+                'as_of_seconds': as_of_seconds,
+                'column_history_seconds': history_seconds,
+                'full_column_history_seconds': full_history_seconds,
+                'changed_last_year': len(store.changed_schools()),
+                'missing_value_changed': missing_changed == [3],
+                'identical': identical}
+    finally:
+        shutil.rmtree(root)
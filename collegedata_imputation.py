@@ -0,0 +1,250 @@
+# Multiple imputation by chained equations (MICE) of missing values.
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn import linear_model
+
+
+# DEFINITIONS
+##############################################################################
+# The old part 4 imputed by chained equations: fill in column means, then,
+# for each column in turn, fit a `LinearRegression` of its known values on
+# all the other columns, and replace its missing values by the predictions
+# plus residuals drawn at random, clipped to the column's range. It went
+# through pandas and sklearn for every column of every cycle, which is too
+# slow to run on the joined frame. Here the same regressions are solved in
+# numpy on standardized columns: each cycle starts from the cross products
+# of all the columns (with an intercept), each column's regression takes out
+# only the rows it is missing, and the cross products are updated in place
+# when its values change. Each of the m imputations is an independent chain
+# with its own random draws, run in a pool of processes. A chain stops early
+# once it has settled, going by how far the mean prediction for each column's
+# missing values moves from one cycle to the next (the root mean square over
+# the columns, in standard deviations): while the chain is still drifting
+# away from the column means this moves, and once the chain is down to the
+# noise of the random draws it holds steady. The change is noisy itself, so
+# it is averaged over the last MICE_WINDOW cycles, and after MICE_MIN_CYCLES
+# a chain stops as soon as that average is under MICE_TOLERANCE, or within
+# MICE_RELATIVE_TOLERANCE of the average over the MICE_WINDOW cycles before.
+# A chain can also be warm started from an earlier imputation (say, before a
+# few schools were added) instead of column means; its values then start
+# near where they end up, but it isn't held to fewer cycles than a cold start
+# (which `benchmark_imputation` reports for both).
+MICE_CYCLES = 20
+MICE_MIN_CYCLES = 5
+MICE_WINDOW = 2
+MICE_TOLERANCE = 1e-3
+MICE_RELATIVE_TOLERANCE = 0.1
+IMPUTATIONS = 5
+IMPUTE_WORKERS = os.cpu_count() or 1
+# A small ridge keeps the regressions solvable when columns are collinear
+# (relative to the number of known values):
+RIDGE = 1e-8
+
+
+# CHAINS
+##############################################################################
+def get_imputed_cols(df):
+    # The float columns, which are the ones imputed (as part 4 does).
+    return df.select_dtypes('float').columns
+
+def standardize(X, missing):
+    # `X` in standard deviations from the mean of its known values, with
+    # missing values at 0 (the mean), and the means and deviations used.
+    # Columns with no known values stay missing.
+    counts = np.maximum((~missing).sum(axis = 0), 1)
+    known = np.where(missing, 0, X)
+    means = known.sum(axis = 0) / counts
+    stds = np.sqrt((np.where(missing, 0, X - means) ** 2).sum(axis = 0)
+                   / counts)
+    stds[~(stds > 0)] = 1
+    Z = (known - means) / stds
+    Z[missing] = 0
+    means[missing.all(axis = 0)] = np.nan
+    return Z, means, stds
+
+def has_settled(changes, window = MICE_WINDOW, tol = MICE_TOLERANCE,
+                rel_tol = MICE_RELATIVE_TOLERANCE):
+    # Whether a chain with these changes from cycle to cycle has settled: the
+    # average of the last `window` is under `tol`, or within `rel_tol` of the
+    # average of the `window` before.
+    if len(changes) < window:
+        return False
+    recent = np.mean(changes[-window:])
+    if recent < tol:
+        return True
+    if len(changes) < 2 * window:
+        return False
+    earlier = np.mean(changes[-2 * window:-window])
+    return abs(recent - earlier) <= rel_tol * earlier
+
+def run_chain(Z, missing, limits, seed, cycles = MICE_CYCLES,
+              min_cycles = MICE_MIN_CYCLES, tol = MICE_TOLERANCE,
+              rel_tol = MICE_RELATIVE_TOLERANCE, window = MICE_WINDOW):
+    # One chain of chained-equation imputation of the standardized `Z` (its
+    # missing values filled in), from the random state `seed`. Returns the
+    # imputed `Z` and how many cycles it ran. Runs in a worker.
+    rng = np.random.default_rng(seed)
+    n, p = Z.shape
+    # The design matrix: an intercept and every column.
+    A = np.empty((n, p + 1))
+    A[:, 0] = 1
+    A[:, 1:] = Z
+    low, high = limits
+    rows = [np.flatnonzero(missing[:, j]) for j in range(p)]
+    cols = [j for j in range(p)
+            if 0 < len(rows[j]) and n - len(rows[j]) > 1]
+    last = None
+    changes = []
+    cycle = 0
+    for cycle in range(1, cycles + 1):
+        G = A.T @ A
+        means = np.zeros(p)
+        for j in cols:
+            k = j + 1
+            # Regress column k on the rest: its own row and column of the
+            # normal equations are set so that its coefficient comes out 0.
+            A_mis = A[rows[j]]
+            lhs = G - A_mis.T @ A_mis
+            rhs = lhs[:, k].copy()
+            rhs[k] = 0
+            lhs[k, :] = 0
+            lhs[:, k] = 0
+            lhs[k, k] = 1
+            lhs[np.diag_indices(p + 1)] += RIDGE * (n - len(rows[j]))
+            beta = np.linalg.solve(lhs, rhs)
+            predicted = A @ beta
+            y = A[:, k]
+            errors = (predicted - y)[~missing[:, j]]
+            values = predicted[rows[j]] + rng.choice(errors, len(rows[j]))
+            A[rows[j], k] = np.clip(values, low[j], high[j])
+            means[j] = predicted[rows[j]].mean()
+            column = A.T @ A[:, k]
+            G[:, k] = column
+            G[k, :] = column
+        if last is not None:
+            changes.append(np.sqrt(np.mean((means - last) ** 2)))
+            if cycle >= min_cycles and has_settled(changes, window, tol,
+                                                   rel_tol):
+                break
+        last = means
+    return A[:, 1:], cycle
+
+def impute(df, m = IMPUTATIONS, seed = 0, start = None,
+           workers = IMPUTE_WORKERS, cycles = MICE_CYCLES,
+           min_cycles = MICE_MIN_CYCLES, tol = MICE_TOLERANCE,
+           rel_tol = MICE_RELATIVE_TOLERANCE, window = MICE_WINDOW):
+    # `m` imputations of the missing values in the float columns of `df`.
+    # Returns `(imputations, cycles)`: a list of `m` copies of `df` with its
+    # float columns filled in, and the cycles each chain ran. With `start`
+    # (an earlier imputation of `df`'s schools), the chains start from its
+    # values instead of column means. The result depends on `seed` and not
+    # on the number of `workers`.
+    cols = get_imputed_cols(df)
+    X = df[cols].to_numpy(dtype = float)
+    missing = np.isnan(X)
+    Z, means, stds = standardize(X, missing)
+    limits = (np.where(missing, np.inf, Z).min(axis = 0),
+              np.where(missing, -np.inf, Z).max(axis = 0))
+    if start is not None:
+        previous = start.reindex(index = df.index, columns = cols)
+        previous = (previous.to_numpy(dtype = float) - means) / stds
+        warm = missing & ~np.isnan(previous)
+        Z[warm] = previous[warm]
+    seeds = np.random.SeedSequence(seed).spawn(m)
+    args = [(Z, missing, limits, chain_seed, cycles, min_cycles, tol, rel_tol,
+             window) for chain_seed in seeds]
+    if workers > 1 and m > 1:
+        with ProcessPoolExecutor(min(workers, m)) as pool:
+            chains = list(pool.map(run_chain, *zip(*args)))
+    else:
+        chains = [run_chain(*chain_args) for chain_args in args]
+
+    imputations = []
+    for imputed, _ in chains:
+        imputed_df = df.copy()
+        imputed_df[cols] = imputed * stds + means
+        imputations.append(imputed_df)
+    return imputations, [cycles_run for _, cycles_run in chains]
+
+def combine(imputations):
+    # The mean of several imputations (for a single filled-in frame).
+    cols = get_imputed_cols(imputations[0])
+    combined = imputations[0].copy()
+    combined[cols] = sum(df[cols] for df in imputations) / len(imputations)
+    return combined
+
+
+# BENCHMARK
+##############################################################################
+# The old part 4's cycles, as they are in the notebook, to check against.
+def loop_impute(reduced_df, cycles = MICE_CYCLES, seed = 0):
+    np.random.seed(seed)
+    missing_df = reduced_df.isna()
+    reduced_df = reduced_df.fillna(reduced_df.mean())
+    reduced_limits = {}
+    for col in reduced_df.columns:
+        reduced_limits[col] = (reduced_df[col].min(), reduced_df[col].max())
+    for i in range(0, cycles):
+        for col in reduced_df.columns:
+            Y = reduced_df[col].mask(missing_df[col])
+            X = reduced_df.drop(columns=col)
+            myRegressor = linear_model.LinearRegression()
+            myRegressor.fit(X[Y.notna()], Y[Y.notna()])
+            err = myRegressor.predict(X[Y.notna()]) - Y[Y.notna()]
+            random_err = np.random.choice(err, Y.isna().sum())
+            if Y.isna().sum() > 0:
+                Y.loc[Y.isna()] = myRegressor.predict(X[Y.isna()]) + random_err
+                if col in reduced_limits.keys():
+                    low, high = reduced_limits[col]
+                    Y.clip(low, high, inplace=True)
+            reduced_df.loc[:,col] = Y
+    return reduced_df
+
+def hide_values(df, frac = 0.1, seed = 0):
+    # `df`'s float columns with a further `frac` of their known values
+    # hidden, and a mask of the hidden values.
+    rng = np.random.default_rng(seed)
+    df = df[get_imputed_cols(df)]
+    hidden = df.notna().to_numpy() & (rng.random(df.shape) < frac)
+    return df.mask(hidden), hidden
+
+def get_imputation_error(imputations, truth, hidden):
+    # Root mean squared error of the mean imputation on the `hidden` values,
+    # in standard deviations of each column.
+    cols = get_imputed_cols(truth)
+    combined = sum(df[cols].to_numpy() for df in imputations) \
+        / len(imputations)
+    scaled = (combined - truth[cols].to_numpy()) / truth[cols].std().values
+    return float(np.sqrt(np.mean(scaled[hidden] ** 2)))
+
+def benchmark_imputation(df, m = IMPUTATIONS, seed = 0, frac = 0.1,
+                         workers = IMPUTE_WORKERS, loop_cycles = MICE_CYCLES):
+    # On the float columns of `df` (e.g. a preprocessed joined frame) with a
+    # further `frac` of values hidden: the time for `m` imputations with the
+    # notebook's cycles and with `impute` (cold, then warm started from the
+    # cold run), and how close each gets to the hidden values.
+    truth = df[get_imputed_cols(df)]
+    masked, hidden = hide_values(truth, frac, seed)
+    results = []
+
+    start = time.perf_counter()
+    loop = [loop_impute(masked, loop_cycles, seed + i) for i in range(m)]
+    results.append({'engine': 'loop',
+                    'seconds': time.perf_counter() - start,
+                    'cycles': loop_cycles,
+                    'error': get_imputation_error(loop, truth, hidden)})
+    warm_start = None
+    for engine in ('cold', 'warm'):
+        start = time.perf_counter()
+        imputations, cycles = impute(masked, m, seed, warm_start, workers)
+        results.append({'engine': engine,
+                        'seconds': time.perf_counter() - start,
+                        'cycles': max(cycles),
+                        'error': get_imputation_error(imputations, truth,
+                                                      hidden)})
+        warm_start = combine(imputations)
+    return pd.DataFrame(results)
@@ -0,0 +1,314 @@
+# Inverted index over the schools' programs, sports and categorical fields.
+import os
+import pickle
+import re
+import time
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from collegedata_compact import LIST_COLS, CompactFrame, get_benchmark_frame
+from collegedata_extractor import CAPTION_STRINGS, SPORTS_LABELS
+
+
+# DEFINITIONS
+##############################################################################
+# Finding the schools that offer some major and some sport means looking
+# through every school's lists. Instead, for every field (each list column,
+# and each categorical column such as `State` or `Entrance Difficulty`) and
+# every term in it, the index keeps the set of schools that have it as a
+# bitmap: a Python int whose bit i is set if the i-th school does. A query is
+# then a few `&`, `|` and `~` on ints of one bit per school (a few hundred
+# bytes for all of CollegeData), which take well under a microsecond each,
+# and only the final answer is turned back into SchoolIds.
+#
+# Terms are looked up by a normalized key, so 'cross-country' finds
+# 'Cross-Country' and 'Arts & Sciences' finds 'Arts and Sciences' (keys of
+# recent lookups are remembered, so a query doesn't spend its time on this):
+NON_WORD_RE = re.compile(r'[\W_]+')
+NORMALIZE_CACHE_SIZE = 65536
+# Query a group of fields at once (a school matches if any field has the
+# term) by these names:
+FIELD_GROUPS = {'programs': CAPTION_STRINGS,
+                'sports': SPORTS_LABELS}
+INDEX_PATH = 'data/collegedata_index.pickle'
+
+
+# TERMS
+##############################################################################
+@lru_cache(NORMALIZE_CACHE_SIZE)
+def normalize(term):
+    # The lookup key for a term (or field name): accents stripped, case
+    # folded, '&' read as 'and', and any run of punctuation or spaces as
+    # one space.
+    term = unicodedata.normalize('NFKD', str(term))
+    term = ''.join(c for c in term if not unicodedata.combining(c))
+    term = term.casefold().replace('&', ' and ')
+    return NON_WORD_RE.sub(' ', term).strip()
+
+def get_bitmaps(rows, codes, terms, n):
+    # One bitmap per term code: the `rows` (of `n`) that have it, given as
+    # parallel arrays of row positions and term codes.
+    bits = np.zeros((terms, (n + 7) // 8), dtype = np.uint8)
+    np.bitwise_or.at(bits, (codes, rows >> 3),
+                     np.left_shift(1, rows & 7).astype(np.uint8))
+    return [int.from_bytes(row.tobytes(), 'little') for row in bits]
+
+
+# BITMAPS
+##############################################################################
+class Bitmap:
+    # A set of schools in an `InvertedIndex`. `&`, `|`, `~` and `-` (and
+    # not) give new bitmaps; `ids()` the SchoolIds in it, `positions()` their
+    # rows in the indexed table.
+    __slots__ = ('bits', 'index')
+
+    def __init__(self, bits, index):
+        self.bits = bits
+        self.index = index
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits, self.index)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits, self.index)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits, self.index)
+
+    def __invert__(self):
+        return Bitmap(self.bits ^ self.index.all_bits, self.index)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.bits == other.bits
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __repr__(self):
+        return 'Bitmap({} schools)'.format(len(self))
+
+    def positions(self):
+        n = len(self.index.school_ids)
+        packed = np.frombuffer(self.bits.to_bytes((n + 7) // 8, 'little'),
+                               dtype = np.uint8)
+        return np.flatnonzero(np.unpackbits(packed, count = n,
+                                            bitorder = 'little'))
+
+    def ids(self):
+        return self.index.school_ids[self.positions()]
+
+    def mask(self):
+        # A boolean mask over the indexed table's rows.
+        mask = np.zeros(len(self.index.school_ids), dtype = bool)
+        mask[self.positions()] = True
+        return mask
+
+
+# INDEX
+##############################################################################
+class InvertedIndex:
+    # `fields` maps each field's normalized name to `(name, {normalized
+    # term: bits})`, and `terms` each field's original spellings of its
+    # terms; `school_ids` is the indexed table's index, in order.
+    def __init__(self, school_ids, fields, terms):
+        self.school_ids = school_ids
+        self.fields = fields
+        self.terms = terms
+        n = len(school_ids)
+        self.all_bits = (1 << n) - 1
+
+    @classmethod
+    def from_compact(cls, compact):
+        # Index every list column and categorical column of a
+        # `collegedata_compact.CompactFrame`.
+        n = len(compact)
+        fields = {}
+        terms = {}
+        for col, column in compact.lists.items():
+            rows = np.repeat(np.arange(n), column.lengths())
+            fields[normalize(col)] = (col, cls.get_term_bits(
+                column.terms, rows, column.matrix.indices, n))
+            terms[col] = list(column.terms)
+        categorical = [col for col in compact.columns
+                       if col not in compact.lists
+                       and pd.api.types.is_categorical_dtype(compact[col])]
+        for col in categorical:
+            codes = compact[col].cat.codes.to_numpy()
+            rows = np.flatnonzero(codes >= 0)
+            levels = compact[col].cat.categories
+            fields[normalize(col)] = (col, cls.get_term_bits(
+                levels, rows, codes[rows], n))
+            terms[col] = list(levels)
+        return cls(compact.index.to_numpy(), fields, terms)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls.from_compact(CompactFrame.from_frame(df))
+
+    @staticmethod
+    def get_term_bits(terms, rows, codes, n):
+        # `{normalized term: bits}`. Terms that normalize the same are
+        # merged.
+        bitmaps = get_bitmaps(rows, codes, len(terms), n)
+        term_bits = {}
+        for term, bits in zip(terms, bitmaps):
+            key = normalize(term)
+            term_bits[key] = term_bits.get(key, 0) | bits
+        return term_bits
+
+    # Querying.
+    def get_fields(self, field):
+        # The normalized names of `field`, or of the fields in its group.
+        key = normalize(field)
+        if key in FIELD_GROUPS:
+            return [normalize(name) for name in FIELD_GROUPS[key]
+                    if normalize(name) in self.fields]
+        if key not in self.fields:
+            raise KeyError(field)
+        return [key]
+
+    def get(self, field, term):
+        # The schools whose `field` (or any field in a group from
+        # FIELD_GROUPS) has `term`. An unknown term has no schools.
+        key = normalize(term)
+        bits = 0
+        for name in self.get_fields(field):
+            bits |= self.fields[name][1].get(key, 0)
+        return Bitmap(bits, self)
+
+    def __getitem__(self, field_term):
+        # `index[field, term]`.
+        return self.get(*field_term)
+
+    def all(self):
+        return Bitmap(self.all_bits, self)
+
+    def any_of(self, field, terms):
+        bits = 0
+        for term in terms:
+            bits |= self.get(field, term).bits
+        return Bitmap(bits, self)
+
+    def all_of(self, field, terms):
+        bits = self.all_bits
+        for term in terms:
+            bits &= self.get(field, term).bits
+        return Bitmap(bits, self)
+
+    def query(self, all_terms = (), any_terms = (), no_terms = ()):
+        # The schools matching every `(field, term)` in `all_terms`, at
+        # least one in `any_terms` (if given), and none in `no_terms`.
+        bits = self.all_bits
+        for field, term in all_terms:
+            bits &= self.get(field, term).bits
+        if any_terms:
+            either = 0
+            for field, term in any_terms:
+                either |= self.get(field, term).bits
+            bits &= either
+        for field, term in no_terms:
+            bits &= ~self.get(field, term).bits
+        return Bitmap(bits, self)
+
+    def count(self, field):
+        # How many schools have each term of a field, by normalized term.
+        name, term_bits = self.fields[self.get_fields(field)[0]]
+        return pd.Series({term: bits.bit_count()
+                          for term, bits in term_bits.items()}, name = name)
+
+    def filter(self, df, bitmap):
+        # The rows of `df` (the indexed table, or any frame in the same
+        # order) in `bitmap`.
+        return df.iloc[bitmap.positions()]
+
+    # Saving.
+    def save(self, path = INDEX_PATH):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump((self.school_ids, self.fields, self.terms), file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path = INDEX_PATH):
+        with open(path, 'rb') as file:
+            return cls(*pickle.load(file))
+
+
+# BENCHMARK
+##############################################################################
+def scan_query(df, all_terms = (), any_terms = (), no_terms = ()):
+    # `InvertedIndex.query` by looking through every row, to check against.
+    def matches(value, key):
+        if isinstance(value, list):
+            return key in {normalize(item) for item in value}
+        return isinstance(value, str) and normalize(value) == key
+
+    def has(field, term):
+        key = normalize(term)
+        found = np.zeros(len(df), dtype = bool)
+        for name in FIELD_GROUPS.get(normalize(field), [field]):
+            found |= np.array([matches(value, key) for value in df[name]])
+        return found
+
+    mask = np.ones(len(df), dtype = bool)
+    for field, term in all_terms:
+        mask &= has(field, term)
+    if any_terms:
+        either = np.zeros(len(df), dtype = bool)
+        for field, term in any_terms:
+            either |= has(field, term)
+        mask &= either
+    for field, term in no_terms:
+        mask &= ~has(field, term)
+    return df.index[mask].to_numpy()
+
+def get_benchmark_queries(df, queries = 20, seed = 0):
+    # Made-up queries on `df`: a term or two that are there in list columns
+    # (or a group of them), with a state to leave out.
+    rng = np.random.default_rng(seed)
+    fields = LIST_COLS + list(FIELD_GROUPS)
+    for _ in range(queries):
+        picks = []
+        for _ in range(2):
+            field = fields[rng.integers(len(fields))]
+            col = FIELD_GROUPS.get(field, [field])[0]
+            values = [value for value in df[col].iloc[:50]
+                      if isinstance(value, list) and value]
+            value = values[rng.integers(len(values))]
+            picks.append((field, value[rng.integers(len(value))]))
+        state = df['State'].iloc[rng.integers(len(df))]
+        yield {'all_terms': picks[:1], 'any_terms': picks[1:],
+               'no_terms': [('State', state)]}
+
+def benchmark_index(rows = 5000, seed = 0, queries = 20, repeat = 100):
+    # Time to build the index and to answer made-up queries (down to the
+    # SchoolIds) against looking through the lists, checking both agree.
+    df = get_benchmark_frame(rows, seed)
+    compact = CompactFrame.from_frame(df)
+    start = time.perf_counter()
+    index = InvertedIndex.from_compact(compact)
+    build_seconds = time.perf_counter() - start
+    query_list = list(get_benchmark_queries(df, queries, seed))
+
+    start = time.perf_counter()
+    expected = [scan_query(df, **query) for query in query_list]
+    scan_seconds = (time.perf_counter() - start) / len(query_list)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        found = [index.query(**query).ids() for query in query_list]
+    index_seconds = (time.perf_counter() - start) / repeat / len(query_list)
+    return {'rows': rows,
+            'terms': sum(len(term_bits)
+                         for _, term_bits in index.fields.values()),
+            'build_seconds': build_seconds,
+            'scan_seconds': scan_seconds,
+            'index_microseconds': index_seconds * 1e6,
+            'speedup': scan_seconds / index_seconds,
+            'identical': all(np.array_equal(a, b)
+                             for a, b in zip(found, expected))}
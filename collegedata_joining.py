@@ -0,0 +1,212 @@
+# Incremental join of the USNews rankings onto the CollegeData schools.
+import os
+from os.path import isfile
+
+import numpy as np
+import pandas as pd
+
+from collegedata_matching import (ACCEPTED, MATCH_THRESHOLD, NAME_COLS,
+                                  NameMatcher, get_name_frame)
+from collegedata_names import usnews_rename_cities, usnews_rename_names
+
+
+# DEFINITIONS
+##############################################################################
+COLLEGEDATA_CLEAN_CSV_PATH = 'data/collegedata_clean.csv'
+USNEWS_CLEAN_CSV_PATH = 'data/usnews_clean.csv'
+JOINED_CSV_PATH = 'data/joined.csv'
+# Part 3 works out which CollegeData school every USNews school is from
+# scratch on every run. Instead, the answer is kept in a match table, one row
+# per USNews school (by Name, State and City) with its SchoolId, how it was
+# matched and the score. Next to it we keep the Name, State and City of every
+# CollegeData school as of the last run. A re-run only matches the USNews
+# schools that are new, or whose CollegeData school is gone or has changed
+# (plus unmatched ones, if any CollegeData school is new or changed). A
+# missing Name, State or City is keyed as '' on both sides, so that it
+# compares equal to itself from run to run (NaN never does):
+MATCH_TABLE_PATH = 'data/match_table.csv'
+MATCH_COLLEGEDATA_PATH = 'data/match_collegedata.csv'
+MATCH_COLS = NAME_COLS + ['SchoolId', 'Method', 'Score', 'Ambiguous']
+# How a USNews school was matched, tried in this order:
+EXACT = 'exact'          # same Name, State and City.
+RENAMED = 'renamed'      # same, after `usnews_rename_names`/`_cities`.
+NAME_ONLY = 'name'       # same Name (CollegeData's City/State were off).
+FUZZY = 'fuzzy'          # `collegedata_matching.NameMatcher`.
+USNEWS_COLS = ['Rank', 'Rank Type']
+
+
+# KEYS
+##############################################################################
+def get_collegedata_keys(collegedata_df):
+    # Name, State and City of each school, indexed by SchoolId.
+    keys = get_name_frame(collegedata_df).fillna('')
+    if 'SchoolId' in collegedata_df.columns:
+        keys = keys.set_index(collegedata_df['SchoolId'])
+    else:
+        keys = keys.set_index(
+            collegedata_df.index.get_level_values('SchoolId'))
+    return keys
+
+def get_usnews_keys(usnews_df):
+    return list(get_name_frame(usnews_df).fillna('').itertuples(
+        index = False, name = None))
+
+def get_unique_lookup(keys, columns):
+    # `{key: SchoolId}` for the values of `columns` that only one school has.
+    values = list(keys[columns].itertuples(index = False, name = None))
+    counts = pd.Series(values, dtype = object).value_counts()
+    return {value: school_id for value, school_id in zip(values, keys.index)
+            if counts[value] == 1}
+
+
+# MATCHING
+##############################################################################
+def match_keys(usnews_keys, collegedata_keys, threshold = MATCH_THRESHOLD):
+    # Match a list of USNews `(Name, State, City)` keys to CollegeData
+    # schools (`get_collegedata_keys`), at most one each, like part 3's
+    # cascade. Returns a match table for the keys.
+    rows = {}
+    available = collegedata_keys
+
+    def add(key, school_id, method, score, ambiguous = False):
+        rows[key] = (*key, school_id, method, score, ambiguous)
+
+    def remaining():
+        return [key for key in usnews_keys if key not in rows]
+
+    exact = get_unique_lookup(available, NAME_COLS)
+    for key in remaining():
+        if key in exact:
+            add(key, exact[key], EXACT, 100.0)
+    available = available.drop([row[3] for row in rows.values()])
+
+    exact = get_unique_lookup(available, NAME_COLS)
+    for name, state, city in remaining():
+        renamed = (usnews_rename_names.get(name, name), state,
+                   usnews_rename_cities.get(city, city))
+        if renamed != (name, state, city) and renamed in exact:
+            add((name, state, city), exact[renamed], RENAMED, 100.0)
+            available = available.drop(exact.pop(renamed))
+
+    names = get_unique_lookup(available, ['Name'])
+    for key in remaining():
+        if (key[0],) in names:
+            add(key, names.pop((key[0],)), NAME_ONLY, 100.0)
+    available = available.drop([row[3] for row in rows.values()
+                                if row[3] in available.index])
+
+    left = remaining()
+    if left and len(available):
+        usnews_df = pd.DataFrame(left, columns = NAME_COLS)
+        matches, _ = NameMatcher(available).match(usnews_df, threshold)
+        for key, match in zip(left, matches.itertuples(index = False)):
+            if match.Status == ACCEPTED:
+                add(key, match.collegedata, FUZZY, match.Score,
+                    match.Ambiguous)
+
+    for key in remaining():
+        add(key, None, None, np.nan)
+    table = pd.DataFrame([rows[key] for key in usnews_keys],
+                         columns = MATCH_COLS)
+    table['SchoolId'] = pd.array(list(table['SchoolId']), dtype = 'Int64')
+    return table
+
+
+# MATCH TABLE
+##############################################################################
+def load_match_table(path = MATCH_TABLE_PATH):
+    if not isfile(path):
+        return pd.DataFrame(columns = MATCH_COLS)
+    return pd.read_csv(path, dtype = {'SchoolId': 'Int64', 'Method': object},
+                       keep_default_na = False, na_values = [''])
+
+def load_collegedata_snapshot(path = MATCH_COLLEGEDATA_PATH):
+    if not isfile(path):
+        return pd.DataFrame(columns = NAME_COLS,
+                            index = pd.Index([], name = 'SchoolId'))
+    return pd.read_csv(path, index_col = 'SchoolId', keep_default_na = False,
+                       na_values = ['']).fillna('')
+
+def save_csv(df, path, **kwargs):
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, **kwargs)
+    os.replace(tmp_path, path)
+
+def update_match_table(usnews_df, collegedata_df, path = MATCH_TABLE_PATH,
+                       collegedata_path = MATCH_COLLEGEDATA_PATH,
+                       threshold = MATCH_THRESHOLD):
+    # Bring the saved match table up to date with the current data, matching
+    # as little as possible. Returns `(table, counts)`, `counts` saying how
+    # many USNews schools kept their match, were matched, or were dropped.
+    table = load_match_table(path)
+    old_keys = load_collegedata_snapshot(collegedata_path)
+    new_keys = get_collegedata_keys(collegedata_df)
+
+    # CollegeData schools that are gone, new, or have a new Name/State/City.
+    common = old_keys.index.intersection(new_keys.index)
+    same = (old_keys.loc[common, NAME_COLS]
+            == new_keys.loc[common, NAME_COLS]).all(axis = 1)
+    changed = set(common[~same])
+    changed |= set(old_keys.index.difference(new_keys.index))
+    added = set(new_keys.index.difference(old_keys.index))
+
+    usnews_keys = get_usnews_keys(usnews_df)
+    table_keys = list(table[NAME_COLS].fillna('').itertuples(
+        index = False, name = None))
+    current = set(usnews_keys)
+    in_usnews = np.array([key in current for key in table_keys],
+                         dtype = bool)
+    matched = table['SchoolId'].notna().to_numpy(dtype = bool)
+    stale = table['SchoolId'].isin(changed).to_numpy(dtype = bool)
+    keep = in_usnews & ~stale & (matched | (not added and not changed))
+    kept = table[keep]
+
+    kept_keys = set(table_keys[i] for i in np.flatnonzero(keep))
+    todo = [key for key in usnews_keys if key not in kept_keys]
+    available = new_keys.drop(kept['SchoolId'].dropna(), errors = 'ignore')
+    matched_now = match_keys(todo, available, threshold)
+
+    table = pd.concat([kept, matched_now], ignore_index = True)
+    table = table.sort_values(NAME_COLS, ignore_index = True)
+    save_csv(table, path, index = False)
+    save_csv(new_keys, collegedata_path)
+    counts = {'kept': len(kept),
+              'matched': len(todo),
+              'dropped': int((~in_usnews).sum())}
+    return table, counts
+
+
+# JOINING
+##############################################################################
+def build_joined(collegedata_df, usnews_df, table):
+    # Every CollegeData school with its USNews Rank and Rank Type (if
+    # matched; unmatched schools are 'Unranked School'), indexed by SchoolId.
+    joined = collegedata_df.copy()
+    if 'SchoolId' in joined.columns:
+        joined = joined.set_index('SchoolId')
+    elif joined.index.names != ['SchoolId']:
+        joined = joined.reset_index().set_index('SchoolId')
+    if 'Name' not in usnews_df.columns:
+        usnews_df = usnews_df.reset_index()
+    ranks = usnews_df[NAME_COLS + USNEWS_COLS].copy()
+    ranks[NAME_COLS] = ranks[NAME_COLS].fillna('')
+    matches = table[NAME_COLS + ['SchoolId']].dropna(subset = ['SchoolId'])
+    matches[NAME_COLS] = matches[NAME_COLS].fillna('')
+    ranks = ranks.merge(matches, on = NAME_COLS)
+    ranks = ranks.set_index('SchoolId')[USNEWS_COLS]
+    joined = joined.drop(columns = USNEWS_COLS, errors = 'ignore')
+    joined = joined.join(ranks)
+    joined['Rank Type'] = joined['Rank Type'].fillna('Unranked School')
+    return joined
+
+def rejoin(collegedata_path = COLLEGEDATA_CLEAN_CSV_PATH,
+           usnews_path = USNEWS_CLEAN_CSV_PATH, out_path = JOINED_CSV_PATH,
+           **kwargs):
+    # Update the match table and write `joined.csv`. Keyword arguments go on
+    # to `update_match_table`.
+    collegedata_df = pd.read_csv(collegedata_path)
+    usnews_df = pd.read_csv(usnews_path)
+    table, counts = update_match_table(usnews_df, collegedata_df, **kwargs)
+    joined = build_joined(collegedata_df, usnews_df, table)
+    save_csv(joined, out_path)
+    return counts
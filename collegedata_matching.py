@@ -0,0 +1,281 @@
+# Fuzzy matching of USNews school names to CollegeData schools.
+import random
+import re
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz, process, utils
+
+
+# DEFINITIONS
+##############################################################################
+# Part 3 gave every unmatched USNews school to `fuzzywuzzy.process.extract`
+# against every CollegeData name, one school at a time, and never looked at
+# the state, so the best match was sometimes a school in another state and
+# two USNews schools could land on the same CollegeData school (fixed by hand
+# with `usnews_df.loc[43, ...]`). Here the CollegeData names are simplified
+# and indexed once: by state, and by state and word. Each USNews name is
+# scored (with rapidfuzz's WRatio, the scorer `process.extract` uses by
+# default) against only the schools in its state sharing a word with it.
+# Names with no good match that way are scored against their whole state in
+# bulk, and the ones still left over against every state. Then each
+# CollegeData school is given to at most one USNews school.
+NAME_COLS = ['Name', 'State', 'City']
+SIMPLIFY_RULES = [(re.compile(pattern), repl) for pattern, repl in [
+    ('SUNY', 'State University of New York'),
+    ('CUNY', 'City University of New York'),
+    ('A&M', 'Agricultural and Mechanical'),
+    ('\'s', 's'),
+    ('College|University|of|\'', ''),
+    (r'Ste?\.? ', 'Saint'),
+    (r'-|\.', ' '),
+    (r'\s+', ' ')]]
+# Words in more names than this (e.g. "State", "Community") don't narrow
+# down the candidates much, so they are only used when a name has no rarer
+# word:
+COMMON_TOKEN_SCHOOLS = 20
+# A match is accepted at or over this score (out of 100):
+MATCH_THRESHOLD = 85
+# How many ranked candidates to keep for each USNews school. When two USNews
+# schools want the same CollegeData school, the loser falls back to its next
+# candidate.
+MATCH_LIMIT = 3
+# A match is reported as ambiguous when the runner-up is this close to it, or
+# when it was some other USNews school's best candidate too:
+AMBIGUOUS_MARGIN = 2
+# Match status:
+ACCEPTED = 'accepted'
+REJECTED = 'rejected'    # best score under the threshold (or no candidates).
+# How a candidate was found:
+STATE_BLOCK = 'state'
+ALL_BLOCK = 'all'        # no good match in its own state; searched them all.
+
+
+# NAMES
+##############################################################################
+def simplify_name(name):
+    # Part 3's `simplify`, for a single name.
+    for regex, repl in SIMPLIFY_RULES:
+        name = regex.sub(repl, name)
+    return name.strip()
+
+def simplify(s):
+    return s.map(simplify_name)
+
+def get_name_frame(df):
+    # `df`'s Name, State and City, whether they are columns or index levels.
+    if all(col in df.columns for col in NAME_COLS):
+        return df[NAME_COLS]
+    names = df.index.to_frame(index = False)[NAME_COLS]
+    names.index = df.index
+    return names
+
+def get_tokens(name):
+    return set(name.split())
+
+
+# MATCHER
+##############################################################################
+class NameMatcher:
+    # Holds the CollegeData side of the match: its simplified names, blocked
+    # by state, and inverted indexes from each word to the schools whose
+    # names contain it (within each state, and overall).
+    def __init__(self, collegedata_df):
+        names = get_name_frame(collegedata_df)
+        self.labels = names.index
+        self.names = [utils.default_process(simplify_name(name))
+                      for name in names['Name']]
+        self.states = defaultdict(list)
+        self.state_tokens = defaultdict(set)
+        self.tokens = defaultdict(set)
+        for i, (name, state) in enumerate(zip(self.names, names['State'])):
+            self.states[state].append(i)
+            for token in get_tokens(name):
+                self.state_tokens[state, token].add(i)
+                self.tokens[token].add(i)
+
+    def token_candidates(self, name, state = None):
+        # Positions of the schools (in `state`) sharing a word with `name`,
+        # leaving out common words unless `name` has nothing rarer.
+        if state is None:
+            hits = [self.tokens.get(token, set())
+                    for token in get_tokens(name)]
+        else:
+            hits = [self.state_tokens.get((state, token), set())
+                    for token in get_tokens(name)]
+        hits = [positions for positions in hits if positions]
+        if not hits:
+            return []
+        rare = [positions for positions in hits
+                if len(positions) <= COMMON_TOKEN_SCHOOLS]
+        return sorted(set().union(*rare) if rare else min(hits, key = len))
+
+    def score(self, query, positions, limit):
+        # Top `limit` `(position, score)` among `positions`.
+        found = process.extract(query, [self.names[i] for i in positions],
+                                scorer = fuzz.WRatio, processor = None,
+                                limit = limit)
+        return [(positions[j], score) for _, score, j in found]
+
+    def score_block(self, queries, positions, limit):
+        # `score` for many queries against the same `positions` at once.
+        if not positions:
+            return [[] for _ in queries]
+        scores = process.cdist(queries, [self.names[i] for i in positions],
+                               scorer = fuzz.WRatio, dtype = np.float32)
+        limit = min(limit, len(positions))
+        top = np.argsort(-scores, axis = 1, kind = 'stable')[:, :limit]
+        return [[(positions[j], float(row[j])) for j in order]
+                for row, order in zip(scores, top)]
+
+    def rank(self, usnews_df, limit = MATCH_LIMIT,
+             threshold = MATCH_THRESHOLD):
+        # DataFrame of up to `limit` ranked candidates for every USNews
+        # school: `usnews` and `collegedata` labels, `Score`, `Rank` (from 1)
+        # and `Block`.
+        names = get_name_frame(usnews_df)
+        queries = [utils.default_process(simplify_name(name))
+                   for name in names['Name']]
+        states = list(names['State'])
+        ranked = [[] for _ in queries]
+
+        def unmatched():
+            return [i for i, candidates in enumerate(ranked)
+                    if not candidates or candidates[0][1] < threshold]
+
+        def update(i, found, block):
+            if found and (not ranked[i] or found[0][1] > ranked[i][0][1]):
+                ranked[i] = [(j, score, block) for j, score in found]
+
+        # Schools in the same state sharing a word.
+        for i, (query, state) in enumerate(zip(queries, states)):
+            positions = self.token_candidates(query, state)
+            if positions:
+                update(i, self.score(query, positions, limit), STATE_BLOCK)
+        # The rest against their whole state.
+        by_state = defaultdict(list)
+        for i in unmatched():
+            by_state[states[i]].append(i)
+        for state, rows in by_state.items():
+            found = self.score_block([queries[i] for i in rows],
+                                     self.states.get(state, []), limit)
+            for i, candidates in zip(rows, found):
+                update(i, candidates, STATE_BLOCK)
+        # The rest against schools sharing a word in any state.
+        for i in unmatched():
+            positions = self.token_candidates(queries[i])
+            if positions:
+                update(i, self.score(queries[i], positions, limit),
+                       ALL_BLOCK)
+
+        usnews_labels = list(names.index)
+        labels = list(self.labels)
+        rows = [(usnews_labels[i], labels[j], score, rank, block)
+                for i, candidates in enumerate(ranked)
+                for rank, (j, score, block) in enumerate(candidates, 1)]
+        return pd.DataFrame(rows, columns = ['usnews', 'collegedata',
+                                             'Score', 'Rank', 'Block'])
+
+    def match(self, usnews_df, threshold = MATCH_THRESHOLD,
+              limit = MATCH_LIMIT, margin = AMBIGUOUS_MARGIN):
+        # One row per USNews school: its `collegedata` match (or None),
+        # `Score`, `Block`, `Status` and whether it is `Ambiguous`, plus the
+        # ranked candidates of every ambiguous school for review.
+        ranked = self.rank(usnews_df, limit, threshold)
+        return assign_matches(ranked, get_name_frame(usnews_df).index,
+                              threshold, margin)
+
+
+# ASSIGNMENT
+##############################################################################
+def assign_matches(ranked, usnews_labels, threshold = MATCH_THRESHOLD,
+                   margin = AMBIGUOUS_MARGIN):
+    # Greedily give each CollegeData school to the USNews school that scores
+    # highest against it, taking candidates from best to worst, so nothing is
+    # matched twice. Returns `(matches, ambiguous)`.
+    candidates = ranked[ranked['Score'] >= threshold]
+    candidates = candidates.sort_values(['Score', 'Rank'],
+                                        ascending = [False, True],
+                                        kind = 'stable')
+    taken = {}
+    wanted = defaultdict(set)
+    assigned = {}
+    for row in candidates.itertuples(index = False):
+        if row.Rank == 1:
+            wanted[row.collegedata].add(row.usnews)
+        if row.usnews in assigned or row.collegedata in taken:
+            continue
+        taken[row.collegedata] = row.usnews
+        assigned[row.usnews] = row
+
+    best = dict(ranked.loc[ranked['Rank'] == 1, ['usnews', 'Score']].values)
+    runner_up = dict(
+        ranked.loc[ranked['Rank'] == 2, ['usnews', 'Score']].values)
+    records = []
+    for label in usnews_labels:
+        row = assigned.get(label)
+        if row is None:
+            records.append((label, None, best.get(label, np.nan), None,
+                            REJECTED, False))
+            continue
+        contested = (len(wanted[row.collegedata]) > 1 or row.Rank > 1)
+        close = (label in runner_up
+                 and best[label] - runner_up[label] < margin)
+        records.append((label, row.collegedata, row.Score, row.Block,
+                        ACCEPTED, contested or close))
+    matches = pd.DataFrame(records, columns = ['usnews', 'collegedata',
+                                               'Score', 'Block', 'Status',
+                                               'Ambiguous'])
+    ambiguous = ranked[ranked['usnews'].isin(
+        matches.loc[matches['Ambiguous'], 'usnews'])]
+    return matches, ambiguous.reset_index(drop = True)
+
+def match_schools(usnews_df, collegedata_df, threshold = MATCH_THRESHOLD,
+                  limit = MATCH_LIMIT, margin = AMBIGUOUS_MARGIN):
+    # `(matches, ambiguous)` for two frames with Name, State and City (as
+    # columns or index levels).
+    matcher = NameMatcher(collegedata_df)
+    return matcher.match(usnews_df, threshold, limit, margin)
+
+
+# BENCHMARK
+##############################################################################
+USNEWS_CLEAN_CSV_PATH = 'data/usnews_clean.csv'
+
+def vary_name(name, rng):
+    # `name` with one letter dropped or doubled, or unchanged.
+    i = rng.randrange(len(name))
+    return rng.choice([name, name[:i] + name[i + 1:],
+                       name[:i] + name[i] + name[i:]])
+
+def get_benchmark_frames(scale = 10, seed = 0, path = USNEWS_CLEAN_CSV_PATH):
+    # Made-up CollegeData and USNews sides: `scale` copies of the USNews
+    # schools, each copy past the first with a city name tacked on to make
+    # the names distinct, and the USNews side with a typo in some names.
+    rng = random.Random(seed)
+    schools = pd.read_csv(path)[NAME_COLS]
+    cities = list(schools['City'].unique())
+    copies = [schools] + [schools.assign(Name = [
+        name + ' ' + rng.choice(cities) for name in schools['Name']])
+        for _ in range(scale - 1)]
+    collegedata_df = pd.concat(copies, ignore_index = True)
+    usnews_df = collegedata_df.copy()
+    usnews_df['Name'] = [vary_name(name, rng) for name in usnews_df['Name']]
+    usnews_df = usnews_df.sample(frac = 1, random_state = seed)
+    return usnews_df, collegedata_df
+
+def benchmark_matcher(scale = 10, seed = 0):
+    # Time `match_schools` on `scale` times the USNews schools, and how many
+    # came back matched to the school they were made from.
+    usnews_df, collegedata_df = get_benchmark_frames(scale, seed)
+    start = time.perf_counter()
+    matches, ambiguous = match_schools(usnews_df, collegedata_df)
+    seconds = time.perf_counter() - start
+    correct = (matches['usnews'] == matches['collegedata']).sum()
+    return {'schools': len(usnews_df),
+            'seconds': seconds,
+            'accepted': int((matches['Status'] == ACCEPTED).sum()),
+            'correct': int(correct),
+            'ambiguous': int(matches['Ambiguous'].sum())}
@@ -0,0 +1,257 @@
+# Metrics for long scrapes: where the time goes, and how far along we are.
+import json
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+# DEFINITIONS
+##############################################################################
+# The old scraper printed each URL and cleared it again, and a page that went
+# wrong was dropped with a "TO DO". A `Metrics` object can instead be handed
+# to the crawler, the parse pool and the record log, and each stage records
+# into it as it goes: every request's latency, status and size; the time to
+# parse each school's pages and to extract its record; the time to commit it
+# to the log; and what became of each school. A snapshot of everything can be
+# taken at any time (the stages run in the event loop's thread, and the
+# snapshot can be read from another, so updates take a lock), and served as
+# JSON from a local HTTP endpoint while the job runs.
+#
+# Histogram buckets (upper bounds, in seconds):
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                 0.5, 1.0, 2.5)
+# The current rate (and so the ETA) is over the schools finished in about the
+# last this many seconds, so it follows changes in speed during a long run:
+RATE_WINDOW = 60.0
+# The HTTP status recorded for a request that never got a response:
+NO_RESPONSE = 'none'
+
+
+# HISTOGRAMS
+##############################################################################
+class Histogram:
+    # Counts of observations in fixed buckets, with their total.
+    def __init__(self, bounds = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # The upper bound of the bucket holding the `q` quantile (the largest
+        # value seen, past the last bound).
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        labels = [str(bound) for bound in self.bounds] + ['+Inf']
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'buckets': dict(zip(labels, self.counts))}
+
+
+# METRICS
+##############################################################################
+class Metrics:
+    # Everything recorded during one run. `total` is how many schools the
+    # run is to finish (for the ETA), if known.
+    def __init__(self, total = None, window = RATE_WINDOW):
+        self.lock = Lock()
+        self.total = total
+        self.window = window
+        self.started = time.monotonic()
+        # Fetching.
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statuses = Counter()
+        self.bytes = 0
+        self.retries = 0
+        self.cached_pages = 0
+        self.in_flight = 0
+        # Parsing, extracting and saving.
+        self.parse = Histogram(STAGE_BUCKETS)
+        self.extract = Histogram(STAGE_BUCKETS)
+        self.save = Histogram(STAGE_BUCKETS)
+        self.saved_bytes = 0
+        # Schools.
+        self.schools = Counter()
+        self.errors = Counter()
+        self.finished = deque()
+        self.gauges = {}
+
+    def start(self, total = None):
+        # (Re)start the clock, e.g. once the ids left to scrape are known.
+        with self.lock:
+            self.started = time.monotonic()
+            if total is not None:
+                self.total = total
+
+    # Fetching.
+    def request_started(self, retry = False):
+        with self.lock:
+            self.in_flight += 1
+            self.retries += retry
+
+    def request_finished(self, status, seconds, size = 0):
+        # `status` is None if no response was received.
+        with self.lock:
+            self.in_flight -= 1
+            self.latency.observe(seconds)
+            self.statuses[NO_RESPONSE if status is None else status] += 1
+            self.bytes += size
+
+    def page_cached(self, pages = 1):
+        with self.lock:
+            self.cached_pages += pages
+
+    # Parsing, extracting and saving.
+    def school_parsed(self, parsed):
+        # Record a `collegedata_parse_pool.ParsedSchool`: its time to parse
+        # each page, to extract its record, and its status.
+        now = time.monotonic()
+        with self.lock:
+            for seconds in parsed.parse_seconds or ():
+                self.parse.observe(seconds)
+            if parsed.extract_seconds is not None:
+                self.extract.observe(parsed.extract_seconds)
+            self.schools[parsed.status] += 1
+            if parsed.error is not None:
+                # Errors by kind, e.g. "ValueError" from "ValueError('...')".
+                self.errors[parsed.error.split('(')[0]] += 1
+            self.finished.append(now)
+            self.drop_finished(now)
+
+    def school_saved(self, seconds, size):
+        with self.lock:
+            self.save.observe(seconds)
+            self.saved_bytes += size
+
+    def set_gauge(self, name, value):
+        # Any other current value worth watching (e.g. a queue's length).
+        with self.lock:
+            self.gauges[name] = value
+
+    # Reading.
+    def drop_finished(self, now):
+        while self.finished and self.finished[0] < now - self.window:
+            self.finished.popleft()
+
+    def get_rates(self, now):
+        # Schools per second over the whole run and over the last `window`
+        # seconds (or since the start, if sooner).
+        self.drop_finished(now)
+        elapsed = now - self.started
+        done = sum(self.schools.values())
+        overall = done / elapsed if elapsed > 0 else None
+        span = min(self.window, elapsed)
+        recent = len(self.finished) / span if span > 0 else None
+        return overall, recent
+
+    def snapshot(self):
+        # A JSON-serializable copy of everything recorded so far.
+        now = time.monotonic()
+        with self.lock:
+            overall, recent = self.get_rates(now)
+            done = sum(self.schools.values())
+            remaining = None
+            eta = None
+            if self.total is not None:
+                remaining = max(self.total - done, 0)
+                if recent:
+                    eta = remaining / recent
+            return {'elapsed_seconds': now - self.started,
+                    'schools': {'done': done,
+                                'total': self.total,
+                                'remaining': remaining,
+                                'by_status': dict(self.schools),
+                                'errors': dict(self.errors),
+                                'rate': recent,
+                                'overall_rate': overall,
+                                'eta_seconds': eta},
+                    'fetch': {'requests': self.latency.count,
+                              'in_flight': self.in_flight,
+                              'retries': self.retries,
+                              'cached_pages': self.cached_pages,
+                              'by_status': {str(status): count
+                                            for status, count
+                                            in self.statuses.items()},
+                              'bytes': self.bytes,
+                              'latency_seconds': self.latency.snapshot()},
+                    'parse': {'seconds_per_page': self.parse.snapshot()},
+                    'extract': {'seconds_per_school':
+                                self.extract.snapshot()},
+                    'save': {'seconds_per_school': self.save.snapshot(),
+                             'bytes': self.saved_bytes},
+                    'gauges': dict(self.gauges)}
+
+def format_progress(snapshot):
+    # A one-line summary of a snapshot, to print in place of the old
+    # "Scraping {url}".
+    schools = snapshot['schools']
+    fetch = snapshot['fetch']
+    parts = ['{} schools'.format(schools['done'])]
+    if schools['total'] is not None:
+        parts[0] += ' of {}'.format(schools['total'])
+    parts.append(', '.join('{} {}'.format(count, status) for status, count
+                           in sorted(schools['by_status'].items())))
+    if schools['rate'] is not None:
+        parts.append('{:.1f}/s'.format(schools['rate']))
+    if schools['eta_seconds'] is not None:
+        parts.append('ETA {:.0f}s'.format(schools['eta_seconds']))
+    parts.append('{} requests ({:.1f} MB, p90 {}s)'.format(
+        fetch['requests'], fetch['bytes'] / 1e6,
+        fetch['latency_seconds']['p90']))
+    return ' | '.join(part for part in parts if part)
+
+
+# HTTP ENDPOINT
+##############################################################################
+# `GET /metrics` (or any path) returns the current snapshot as JSON, so a run
+# can be watched from a browser or `curl` while it goes.
+class MetricsHandler(BaseHTTPRequestHandler):
+    def __init__(self, *args, metrics = None, **kwargs):
+        self.metrics = metrics
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        body = json.dumps(self.metrics.snapshot(), indent = 1).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(metrics, port = 0):
+    # Serve `metrics` on localhost in a background thread. Returns the server
+    # (call its `shutdown()` when finished) and the endpoint's URL.
+    handler = partial(MetricsHandler, metrics = metrics)
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    Thread(target = server.serve_forever, daemon = True).start()
+    host, port = server.server_address
+    return server, "http://{}:{}/metrics".format(host, port)
@@ -0,0 +1,205 @@
+# CollegeData multi-process parsing.
+import asyncio
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from collegedata_cache import PAGE_CACHE_DIR, PageCache
+from collegedata_crawler import crawl_schools
+from collegedata_extractor import extract_record, parse_page
+from collegedata_scraper import EMPTY_H1_HEADING
+
+
+# DEFINITIONS
+##############################################################################
+# Parsing with BeautifulSoup and extracting the tables is CPU-bound, so once
+# fetching is fast it caps throughput on a single core. Fetched pages are
+# instead queued up for a pool of parser processes:
+PARSE_WORKERS = os.cpu_count() or 1
+# Backpressure: no more than this many schools per worker are waiting to be
+# parsed at once. When the queue is full, whatever feeds it (e.g. the crawler)
+# waits for a parser to catch up rather than piling up raw pages in memory:
+PENDING_PER_WORKER = 4
+# What became of a school:
+OK = 'ok'
+EMPTY = 'empty'      # id with no school ("Retrieve a Saved Search", or a
+                     # 404 for the first page, as discovery takes it).
+FAILED = 'failed'    # some page never fetched.
+ERROR = 'error'      # pages fetched, but parsing or extracting raised.
+
+# The result for a school. `record` is a dict of everything extracted (the
+# same keys as `collegedata_extractor.extract_record`, plus SchoolId)
+# when `status` is OK, and `error` describes what went wrong on ERROR.
+# `parse_seconds` lists the time taken to parse each page into a tree (only
+# the first, if that was enough to tell), and `extract_seconds` is the time
+# to extract the record from them (None if it didn't get that far).
+ParsedSchool = namedtuple('ParsedSchool',
+                          ['school_id', 'status', 'record', 'error',
+                           'parse_seconds', 'extract_seconds'],
+                          defaults = (None, None))
+
+
+# WORKERS
+##############################################################################
+def parse_school(school_id, htmls, statuses = None):
+    # Turn a school's raw page HTML into a `ParsedSchool`, given the HTTP
+    # `statuses` of its pages, if known. Runs in a worker.
+    if not htmls or None in htmls:
+        if statuses and htmls and htmls[0] is None and statuses[0] == 404:
+            return ParsedSchool(school_id, EMPTY, None, None)
+        return ParsedSchool(school_id, FAILED, None, None)
+    parse_seconds = []
+
+    def parse(html):
+        start = time.perf_counter()
+        page = parse_page(html)
+        parse_seconds.append(time.perf_counter() - start)
+        return page
+
+    try:
+        parsed = [parse(htmls[0])]
+        h1 = parsed[0][0].find('.//h1')
+        if h1 is None:
+            return ParsedSchool(school_id, ERROR, None, 'page has no <h1>',
+                                parse_seconds)
+        if h1.text_content().strip() == EMPTY_H1_HEADING:
+            return ParsedSchool(school_id, EMPTY, None, None, parse_seconds)
+        parsed += [parse(html) for html in htmls[1:]]
+        start = time.perf_counter()
+        record = extract_record(htmls, school_id, parsed)
+        extract_seconds = time.perf_counter() - start
+    except Exception as e:
+        return ParsedSchool(school_id, ERROR, None, repr(e), parse_seconds)
+    record['SchoolId'] = school_id
+    return ParsedSchool(school_id, OK, record, None, parse_seconds,
+                        extract_seconds)
+
+# Each worker process opens the page cache once and reads pages itself, so
+# only school ids (not whole pages) are sent between processes.
+worker_cache = None
+
+def init_cache_worker(root):
+    global worker_cache
+    worker_cache = PageCache(root)
+
+def parse_cached_school(school_id):
+    return parse_school(school_id, worker_cache.get_school(school_id))
+
+
+# POOLS
+##############################################################################
+def run_pool(function, args_iter, workers = PARSE_WORKERS, ordered = False,
+             max_pending = None, initializer = None, initargs = ()):
+    # Generator mapping `function` over `args_iter` in a process pool.
+    # Submission stops while `max_pending` tasks are unfinished, so
+    # `args_iter` is only consumed as fast as the workers keep up. With
+    # `ordered`, results come back in input order; otherwise each is yielded
+    # as soon as it is ready.
+    if max_pending is None:
+        max_pending = workers * PENDING_PER_WORKER
+    args_iter = iter(args_iter)
+    with ProcessPoolExecutor(workers, initializer = initializer,
+                             initargs = initargs) as pool:
+        pending = deque() if ordered else set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                args = next(args_iter, None)
+                if args is None:
+                    exhausted = True
+                    break
+                future = pool.submit(function, *args)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+            if not pending:
+                break
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+def parse_schools(school_pages, workers = PARSE_WORKERS, ordered = False,
+                  max_pending = None):
+    # Parse an iterable of `(school_id, htmls)`, `(school_id, htmls,
+    # statuses)` or the crawler's `SchoolPages` into `ParsedSchool`s.
+    args_iter = ((school[0], school[1],
+                  school[2] if len(school) > 2 else None)
+                 for school in school_pages)
+    return run_pool(parse_school, args_iter, workers, ordered, max_pending)
+
+def parse_cached_schools(root = PAGE_CACHE_DIR, school_ids = None,
+                         workers = PARSE_WORKERS, ordered = False,
+                         max_pending = None):
+    # Parse schools straight out of the page cache (every fully cached
+    # school by default).
+    if school_ids is None:
+        with PageCache(root) as cache:
+            school_ids = cache.school_ids()
+    args_iter = ((school_id,) for school_id in school_ids)
+    return run_pool(parse_cached_school, args_iter, workers, ordered,
+                    max_pending, init_cache_worker, (root,))
+
+
+# CRAWL + PARSE
+##############################################################################
+async def crawl_and_parse_schools(callback, school_ids,
+                                  workers = PARSE_WORKERS,
+                                  max_pending = None, metrics = None,
+                                  **crawl_kwargs):
+    # Crawl `school_ids` and parse them as they arrive, calling `callback`
+    # with each `ParsedSchool` (unordered). Fetched schools wait on a bounded
+    # queue, so a slow parse stage slows the crawl down instead of buffering
+    # raw pages without limit. Fetching, parsing and each school's outcome
+    # are recorded in `metrics` (a `collegedata_metrics.Metrics`), if given,
+    # along with how full the queue is (always full: parsing is the
+    # bottleneck; always empty: fetching is). If a parser fails (`callback`
+    # raised, or the pool broke), the crawl is cancelled rather than left
+    # waiting on a queue no one empties, and the error is raised.
+    if max_pending is None:
+        max_pending = workers * PENDING_PER_WORKER
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(max_pending)
+
+    async def parse(pool):
+        while True:
+            school = await queue.get()
+            if school is None:
+                return
+            parsed = await loop.run_in_executor(
+                pool, parse_school, school.school_id, school.pages,
+                school.statuses)
+            if metrics is not None:
+                metrics.school_parsed(parsed)
+                metrics.set_gauge('parse_queue', queue.qsize())
+            callback(parsed)
+
+    async def produce():
+        async for school in crawl_schools(school_ids, metrics = metrics,
+                                          **crawl_kwargs):
+            await queue.put(school)
+            if metrics is not None:
+                metrics.set_gauge('parse_queue', queue.qsize())
+        for _ in range(workers):
+            await queue.put(None)
+
+    with ProcessPoolExecutor(workers) as pool:
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(parse(pool)) for _ in range(workers)]
+        try:
+            done, _ = await asyncio.wait(
+                tasks, return_when = asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+
+def crawl_and_parse(callback, school_ids, **kwargs):
+    # Blocking entry point for `crawl_and_parse_schools`.
+    asyncio.run(crawl_and_parse_schools(callback, school_ids, **kwargs))
@@ -0,0 +1,494 @@
+# Fitted preprocessing of the joined CollegeData/USNews frame (part 4).
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler, PowerTransformer
+
+from collegedata_names import dirty_cols_extract_dict, num_col_ranges
+
+
+# DEFINITIONS
+##############################################################################
+JOINED_CSV_PATH = 'data/joined.csv'
+NULL_THRESHOLD = 0.7
+VARIANCE_THRESHOLD = 0.01
+CORRELATION_THRESHOLD = 0.9
+CATEGORY_THRESHOLD = 10
+# Part 4 runs its steps as notebook cells on a copy of the frame each, and
+# refits everything every time. A `Preprocessor` is fit once, in the same
+# order and with the same rules, and keeps what it decided: the columns kept,
+# the bounds each column is masked to, the Yeo-Johnson, standardizing and
+# min-max parameters, and the category levels. It can be saved, and then
+# `transform` applies all of that to a new batch of schools in one go,
+# straight from the batch's own columns into the output, without refitting.
+PREPROCESSOR_PATH = 'data/preprocessor.json'
+# Columns part 4 derives, in order: `(name, op, a, b)` for `a op b`.
+DERIVED_COLS = [
+    ('Applications (women pct of all)', '/', 'Applications (women)',
+     'Applications (all)'),
+    ('Offers (women pct of all)', '/', 'Offers (women)', 'Offers (all)'),
+    ('Freshmen Enrolled (women pct of all)', '/', 'Freshmen Enrolled (women)',
+     'Freshmen Enrolled (all)'),
+    ('Students (all)', '+', 'All Undergraduates', 'All Graduate Students'),
+    ('Students (undergraduate pct of all)', '/', 'All Undergraduates',
+     'Students (all)'),
+    ('Students (full-time pct of all undergrads)', '/',
+     'Full-Time Undergraduates', 'All Undergraduates')]
+# ... and the columns they replace.
+DERIVED_DROP_COLS = [
+    'Applications (women)', 'Applications (men)', 'Offers (all)',
+    'Offers (women)', 'Offers (men)', 'Freshmen Enrolled (all)',
+    'Freshmen Enrolled (women)', 'Freshmen Enrolled (men)',
+    'Offer Rate (men)', 'Offer Rate (women)', 'Yield Rate (men)',
+    'Yield Rate (women)', 'Undergraduates (women)', 'Undergraduates (men)',
+    'Undergraduates (men pct of all)', 'All Undergraduates',
+    'All Graduate Students', 'Full-Time Undergraduates']
+# Part 4 drops correlated columns by finding every correlated pair in the
+# full `df.corr()` matrix and walking the pairs with list lookups, which is
+# quadratic in the number of columns in memory and worse in time. Walking the
+# pairs in that order, a column is dropped exactly when it is correlated with
+# some later column (the later one of a pair can't have been dropped yet), so
+# `get_correlated_cols` only looks for the first such column of each one.
+# Correlations are screened in blocks of columns, in float32, and pairs within
+# CORRELATION_MARGIN of the threshold are checked again exactly; columns
+# already known to be dropped are left out of later blocks.
+CORRELATION_BLOCK_COLS = 1024
+CORRELATION_MARGIN = 1e-3
+# Fill for missing categories, before one-hot encoding:
+NO_CATEGORY = 'None'
+
+
+# FEATURE SELECTION
+##############################################################################
+def standardize(X):
+    # `X`'s columns as float32 z-scores (0 where missing or constant), and
+    # which values are present.
+    present = ~np.isnan(X)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        Z = (X - np.nanmean(X, axis = 0)) / np.nanstd(X, axis = 0)
+    Z[~np.isfinite(Z)] = 0
+    return Z.astype(np.float32), present
+
+def block_corr(Z, present, rows, cols):
+    # Correlations of columns `rows` with columns `cols` over the values
+    # both have, as `DataFrame.corr` pairs them, in float32.
+    A = Z[:, rows]
+    B = Z[:, cols]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        if present[:, rows].all() and present[:, cols].all():
+            return A.T @ B / len(Z)
+        Ma = present[:, rows].astype(np.float32)
+        Mb = present[:, cols].astype(np.float32)
+        n = Ma.T @ Mb
+        sa = A.T @ Mb
+        sb = Ma.T @ B
+        cov = A.T @ B - sa * sb / n
+        var_a = (A * A).T @ Mb - sa * sa / n
+        var_b = Ma.T @ (B * B) - sb * sb / n
+        return cov / np.sqrt(var_a * var_b)
+
+def exact_corr(X, present, r, c):
+    # `DataFrame.corr`'s correlation of columns `r` and `c`, in float64.
+    both = present[:, r] & present[:, c]
+    x = X[both, r] - X[both, r].mean()
+    y = X[both, c] - X[both, c].mean()
+    divisor = np.sqrt((x @ x) * (y @ y))
+    return (x @ y) / divisor if divisor else np.nan
+
+def get_correlated_cols(df, threshold = CORRELATION_THRESHOLD,
+                        block_cols = CORRELATION_BLOCK_COLS):
+    # Columns of `df` to drop so no two left are correlated over `threshold`
+    # (part 4's rule), in the order part 4 drops them.
+    X = df.to_numpy(dtype = float)
+    Z, present = standardize(X)
+    k = X.shape[1]
+    # For each column, the first later column it is correlated with.
+    first = np.full(k, -1)
+    for start in range(0, k, block_cols):
+        rows = np.arange(start, min(start + block_cols, k))
+        cols = np.flatnonzero(first[:rows[-1]] < 0)
+        if not len(cols):
+            continue
+        with np.errstate(invalid = 'ignore'):
+            near = np.abs(block_corr(Z, present, rows, cols)) \
+                > threshold - CORRELATION_MARGIN
+        near &= rows[:, None] > cols[None, :]
+        for j in np.flatnonzero(near.any(axis = 0)):
+            for r in rows[near[:, j]]:
+                if abs(exact_corr(X, present, r, cols[j])) > threshold:
+                    first[cols[j]] = r
+                    break
+    dropped = np.flatnonzero(first >= 0)
+    dropped = dropped[np.lexsort((dropped, first[dropped]))]
+    return list(df.columns[dropped])
+
+
+# TRANSFORMS
+##############################################################################
+def add_derived_cols(values):
+    # Add DERIVED_COLS to `values`, a dict of column arrays.
+    for name, op, a, b in DERIVED_COLS:
+        if op == '/':
+            values[name] = values[a] / values[b]
+        else:
+            values[name] = values[a] + values[b]
+    return values
+
+def yeo_johnson(X, lambdas):
+    # `PowerTransformer`'s Yeo-Johnson transform of each column of `X` by its
+    # lambda, in place. NaNs stay NaN.
+    eps = np.spacing(1.)
+    for j, lmbda in enumerate(lambdas):
+        x = X[:, j]
+        pos = x >= 0
+        neg = x < 0
+        if abs(lmbda) < eps:
+            x[pos] = np.log1p(x[pos])
+        else:
+            x[pos] = (np.power(x[pos] + 1, lmbda) - 1) / lmbda
+        if abs(lmbda - 2) > eps:
+            x[neg] = -(np.power(-x[neg] + 1, 2 - lmbda) - 1) / (2 - lmbda)
+        else:
+            x[neg] = -np.log1p(-x[neg])
+    return X
+
+
+# PREPROCESSOR
+##############################################################################
+class Preprocessor:
+    # Part 4's preprocessing, fit once and then applied to any batch.
+    # Fitted state (all plain lists and dicts, so it saves as JSON):
+    # - `columns`: the output columns, in order, each `[kind, ...]`: `['num',
+    #   i]` for column i of the numeric block, `['pass', col]` for a column
+    #   passed through as is, and `['dummy', col, level]`;
+    # - `num_cols`: the numeric block's columns and, for each, its `bounds`
+    #   (or None), `lambdas`, `means` and `scales` (standardizing), and
+    #   `mins` and `ranges` (the min-max scaler's `min_` and `scale_`);
+    # - `categories`: `{col: levels}` for the one-hot encoded columns.
+    # Categorical columns (e.g. from `collegedata_storage`) are handled like
+    # the object columns they are in the CSV.
+    def __init__(self, null_threshold = NULL_THRESHOLD,
+                 variance_threshold = VARIANCE_THRESHOLD,
+                 correlation_threshold = CORRELATION_THRESHOLD,
+                 category_threshold = CATEGORY_THRESHOLD):
+        self.params = {'null_threshold': null_threshold,
+                       'variance_threshold': variance_threshold,
+                       'correlation_threshold': correlation_threshold,
+                       'category_threshold': category_threshold}
+        self.state = None
+
+    # Fitting.
+    def fit(self, df):
+        params = self.params
+        df = df.copy()
+
+        # Drop mostly empty numeric columns, then derive the ratio columns.
+        num_cols = df.select_dtypes('float').columns
+        null_freqs = df[num_cols].isna().sum() / len(df)
+        df = df.drop(columns = num_cols[null_freqs
+                                        > params['null_threshold']])
+        for name, op, a, b in DERIVED_COLS:
+            df[name] = df[a] / df[b] if op == '/' else df[a] + df[b]
+        df = df.drop(columns = DERIVED_DROP_COLS)
+
+        # Mask values out of range: [0, 1] for columns that look like
+        # fractions, or the range in `num_col_ranges`.
+        num_cols = df.select_dtypes('float').columns
+        pct_cols = num_cols[df[num_cols].mean().between(0, 1)]
+        bounds = {col: (0, 1) for col in pct_cols}
+        bounds.update({col: col_range
+                       for col, col_range in num_col_ranges.items()
+                       if col in num_cols})
+        for col, (low, high) in bounds.items():
+            df[col] = df[col].mask(df[col].notna()
+                                   & ~df[col].between(low, high))
+
+        # Power transform and scale, then drop low-variance and correlated
+        # columns.
+        pt = PowerTransformer()
+        scaler = MinMaxScaler()
+        df[num_cols] = pt.fit_transform(df[num_cols])
+        df[num_cols] = scaler.fit_transform(df[num_cols])
+        low_var_cols = num_cols[df[num_cols].var()
+                                < params['variance_threshold']]
+        df = df.drop(columns = low_var_cols)
+        corr_cols = df.select_dtypes('float').columns
+        df = df.drop(columns = get_correlated_cols(
+            df[corr_cols], params['correlation_threshold']))
+
+        # One-hot encode object columns with few values; drop the rest.
+        categories = {}
+        for col in df.select_dtypes(['object', 'category']).columns:
+            values = df[col].astype(object)
+            if values.nunique() < params['category_threshold']:
+                levels = values.fillna(NO_CATEGORY).astype('category')
+                categories[col] = list(levels.cat.categories)
+
+        kept = [col for col in df.select_dtypes(exclude = ['object',
+                                                          'category'])]
+        num_kept = [col for col in kept if col in num_cols]
+        index = {col: i for i, col in enumerate(num_cols)}
+        fitted = [index[col] for col in num_kept]
+        self.state = {
+            'columns': ([['num', num_kept.index(col)] if col in num_kept
+                         else ['pass', col] for col in kept]
+                        + [['dummy', col, level]
+                           for col, levels in categories.items()
+                           for level in levels]),
+            'num_cols': num_kept,
+            'bounds': [list(bounds[col]) if col in bounds else None
+                       for col in num_kept],
+            'lambdas': pt.lambdas_[fitted].tolist(),
+            'means': pt._scaler.mean_[fitted].tolist(),
+            'scales': pt._scaler.scale_[fitted].tolist(),
+            'mins': scaler.min_[fitted].tolist(),
+            'ranges': scaler.scale_[fitted].tolist(),
+            'categories': categories}
+        return self
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    # Transforming.
+    def transform(self, df):
+        state = self.state
+        num_cols = state['num_cols']
+        derived = {name for name, _, _, _ in DERIVED_COLS}
+        sources = {a for _, _, a, _ in DERIVED_COLS} \
+            | {b for _, _, _, b in DERIVED_COLS}
+        values = {col: df[col].to_numpy(dtype = float)
+                  for col in sources - derived}
+        add_derived_cols(values)
+
+        # The numeric block, one column at a time straight into an array.
+        X = np.empty((len(df), len(num_cols)))
+        for j, col in enumerate(num_cols):
+            X[:, j] = (values[col] if col in values
+                       else df[col].to_numpy(dtype = float))
+        for j, bounds in enumerate(state['bounds']):
+            if bounds is not None:
+                x = X[:, j]
+                with np.errstate(invalid = 'ignore'):
+                    x[(x < bounds[0]) | (x > bounds[1])] = np.nan
+        yeo_johnson(X, state['lambdas'])
+        X -= state['means']
+        X /= state['scales']
+        X *= state['ranges']
+        X += state['mins']
+
+        out = {}
+        codes = {}
+        for col, levels in state['categories'].items():
+            values = df[col].astype(object).fillna(NO_CATEGORY)
+            codes[col] = pd.Categorical(values, categories = levels).codes
+        for column in state['columns']:
+            kind = column[0]
+            if kind == 'num':
+                name = num_cols[column[1]]
+                out[name] = X[:, column[1]]
+            elif kind == 'pass':
+                name = column[1]
+                out[name] = df[name].to_numpy()
+            else:
+                _, col, level = column
+                name = '{}_{}'.format(col, level)
+                out[name] = (codes[col]
+                             == state['categories'][col].index(level)
+                             ).astype(np.uint8)
+        return pd.DataFrame(out, index = df.index)
+
+    # Saving.
+    def save(self, path = PREPROCESSOR_PATH):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'params': self.params, 'state': self.state}, file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path = PREPROCESSOR_PATH):
+        with open(path) as file:
+            saved = json.load(file)
+        preprocessor = cls(**saved['params'])
+        preprocessor.state = saved['state']
+        return preprocessor
+
+
+# BENCHMARK
+##############################################################################
+# Part 4's cells, as they are in the notebook, to check against.
+def loop_get_correlated_cols(df, threshold = CORRELATION_THRESHOLD):
+    corr_df = df.corr().abs() > threshold
+    mask = np.zeros_like(corr_df)
+    mask[np.triu_indices_from(mask)] = True
+    corr_df = corr_df.mask(mask, False)
+    corr_pairs = [(corr_df.columns[x], corr_df.index[y])
+                  for x, y in zip(*np.where(corr_df))]
+    to_keep = []
+    to_drop = []
+    for (x, y) in corr_pairs:
+        if x not in to_keep:
+            to_keep.append(x)
+        if y not in to_keep:
+            to_keep.append(y)
+    for (x, y) in corr_pairs:
+        if x in to_keep and y in to_keep:
+            to_keep.remove(y)
+            to_drop.append(y)
+    return to_drop
+
+def run_part4(df):
+    df = df.copy()
+    num_cols = df.select_dtypes('float').columns
+    null_freqs = df[num_cols].isna().sum() / len(df)
+    null_cols = num_cols.where(null_freqs > NULL_THRESHOLD).dropna()
+    df = df.drop(columns = null_cols)
+
+    for name, op, a, b in DERIVED_COLS:
+        df[name] = df[a] / df[b] if op == '/' else df[a] + df[b]
+    df = df.drop(columns = DERIVED_DROP_COLS)
+
+    num_cols = df.select_dtypes('float').columns
+    pct_cols = num_cols[df[num_cols].mean().between(0, 1)]
+    invalid_vals_df = pd.DataFrame(index = df.index, columns = df.columns)
+    invalid_vals_df[pct_cols] = (df[pct_cols] < 0) | (df[pct_cols] > 1)
+    for col, col_range in num_col_ranges.items():
+        if col not in df.columns:
+            continue
+        low, high = col_range
+        in_range = df[col].between(low, high)
+        has_vals = df[col].notna()
+        invalid_vals_df[col] = has_vals & ~in_range
+    invalid_vals_df = invalid_vals_df.fillna(False)
+    df = df.mask(invalid_vals_df)
+
+    pt = PowerTransformer()
+    scaler = MinMaxScaler()
+    df[num_cols] = pt.fit_transform(df[num_cols])
+    df[num_cols] = scaler.fit_transform(df[num_cols])
+
+    low_var_cols = num_cols[df[num_cols].var() < VARIANCE_THRESHOLD]
+    df = df.drop(columns = low_var_cols)
+
+    num_cols = df.select_dtypes('float').columns
+    df = df.drop(columns = loop_get_correlated_cols(df[num_cols]))
+
+    for col in df.select_dtypes('object').columns:
+        if df[col].nunique() < CATEGORY_THRESHOLD:
+            df[col] = df[col].fillna('None')
+            df[col] = df[col].astype('category')
+    cat_cols = df.select_dtypes('category').columns
+    df = df.join(pd.get_dummies(df[cat_cols]))
+    df = df.drop(columns = cat_cols)
+    df = df.drop(columns = df.select_dtypes('object'))
+    return df
+
+def get_synthetic_joined(rows = 2000, seed = 0):
+    # A made-up joined frame with the columns part 4 works on: every column
+    # in `num_col_ranges` and DERIVED_COLS, the targets in
+    # `dirty_cols_extract_dict` as fractions, a few mostly empty, constant
+    # and near-duplicate columns, and some text columns.
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(index = pd.RangeIndex(1, rows + 1, name = 'SchoolId'))
+
+    def missing(values, frac = 0.2):
+        return np.where(rng.random(rows) < frac, np.nan, values)
+
+    derived = [name for name, _, _, _ in DERIVED_COLS]
+    for col, (low, high) in num_col_ranges.items():
+        if col in derived:
+            continue
+        values = low + (high - low) * rng.beta(2, 5, rows)
+        # A few values out of range.
+        values[rng.random(rows) < 0.01] = high * 2
+        df[col] = missing(values)
+    for _, _, a, b in DERIVED_COLS:
+        for col in (a, b):
+            if col not in df.columns and col not in derived:
+                df[col] = missing(rng.integers(100, 20000, rows)
+                                  .astype(float))
+    for col in DERIVED_DROP_COLS:
+        if col not in df.columns:
+            df[col] = missing(rng.random(rows))
+    df['Yield Rate (all)'] = missing(rng.beta(2, 3, rows), 0.1)
+    for targets in dirty_cols_extract_dict.values():
+        for col in targets:
+            if col not in df.columns:
+                df[col] = missing(rng.random(rows), rng.random() * 0.9)
+    df['Constant'] = 1.0
+    df['ACT Mean copy'] = df['ACT Mean'] * 2 + 1
+    states = np.array(['PA', 'NY', 'CA', 'TX', 'OH', 'MA', 'IL', 'FL', 'MI',
+                       'NC', 'GA', 'VA'])
+    df['State'] = states[rng.integers(0, len(states), rows)]
+    df['Campus Setting'] = np.array(['Urban', 'Suburban', 'Rural', None],
+                                    dtype = object)[rng.integers(0, 4, rows)]
+    df['Rank Type'] = np.array(['National Universities',
+                                'National Liberal Arts Colleges',
+                                'Unranked School'])[rng.integers(0, 3, rows)]
+    df['Name'] = ['School {}'.format(i) for i in range(rows)]
+    return df
+
+def benchmark_preprocessor(rows = 2000, seed = 0, repeat = 3):
+    # Time part 4's cells against `Preprocessor.transform` with a fitted
+    # preprocessor that has been saved and loaded again, checking the two
+    # give identical frames.
+    df = get_synthetic_joined(rows, seed)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = run_part4(df)
+    notebook_seconds = (time.perf_counter() - start) / repeat
+    fd, path = tempfile.mkstemp(suffix = '.json')
+    os.close(fd)
+    try:
+        Preprocessor().fit(df).save(path)
+        preprocessor = Preprocessor.load(path)
+    finally:
+        os.remove(path)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = preprocessor.transform(df)
+    transform_seconds = (time.perf_counter() - start) / repeat
+    return {'rows': rows,
+            'columns': len(result.columns),
+            'notebook_seconds': notebook_seconds,
+            'transform_seconds': transform_seconds,
+            'speedup': notebook_seconds / transform_seconds,
+            'identical': result.equals(expected)}
+
+def get_wide_frame(rows = 2000, cols = 1000, seed = 0, missing = 0.1):
+    # `cols` made-up numeric columns, each a noisy mix of a few shared
+    # factors so that some are correlated over the threshold, with a
+    # fraction `missing` of values missing.
+    rng = np.random.default_rng(seed)
+    factors = rng.standard_normal((rows, max(cols // 20, 1)))
+    which = rng.integers(0, factors.shape[1], cols)
+    noise = rng.uniform(0.05, 1.5, cols)
+    X = factors[:, which] + noise * rng.standard_normal((rows, cols))
+    X[rng.random((rows, cols)) < missing] = np.nan
+    return pd.DataFrame(X, columns = ['Column {}'.format(i)
+                                      for i in range(cols)])
+
+def benchmark_correlation(cols = (100, 1000, 4000), rows = 2000, seed = 0,
+                          loop_cols = 4000):
+    # Time part 4's correlated-column loop (up to `loop_cols` columns, since
+    # it holds the whole matrix and its pairs in lists) against
+    # `get_correlated_cols`, checking they drop the same columns in the same
+    # order.
+    results = []
+    for k in cols:
+        df = get_wide_frame(rows, k, seed)
+        start = time.perf_counter()
+        dropped = get_correlated_cols(df)
+        row = {'columns': k,
+               'dropped': len(dropped),
+               'blocked_seconds': time.perf_counter() - start}
+        if k <= loop_cols:
+            start = time.perf_counter()
+            expected = loop_get_correlated_cols(df)
+            row['loop_seconds'] = time.perf_counter() - start
+            row['identical'] = dropped == expected
+        results.append(row)
+    return pd.DataFrame(results)
@@ -0,0 +1,230 @@
+# CollegeData append-only record log.
+import json
+import os
+import time
+from os.path import getsize, isfile
+
+import pandas as pd
+
+from collegedata_parse_pool import EMPTY, OK, crawl_and_parse
+from collegedata_scraper import SCHOOL_ID_END, SCHOOL_ID_START
+
+
+# DEFINITIONS
+##############################################################################
+# Appending each school to the raw CSV with its own `to_csv(mode = 'a+')`
+# lets the columns drift from row to row, a crash mid-write corrupts the
+# file, and resuming means reading the whole CSV for `max(SchoolId)`.
+# Instead, every scraped school is appended to a log as a single JSON line
+# and fsync'd before we move on, so a school is either fully committed or not
+# there at all (a torn last line from a crash is cut off on the next open):
+RECORD_LOG_PATH = "data/collegedata_records.jsonl"
+# A small progress index sits next to the log: which ids are done, empty or
+# failed, and how many bytes of the log it covers. Resuming only reads this
+# (plus any log lines written after it, if we crashed between the two):
+PROGRESS_PATH = "data/collegedata_progress.json"
+# Rewriting the whole index after every school would cost more and more as
+# the run goes on, so it is only saved every this many commits or seconds
+# (and on close); the log lines past it are replayed on the next open:
+PROGRESS_EVERY = 100
+PROGRESS_SECONDS = 10.0
+# Compacting the log writes the one wide table the rest of the project uses:
+COLLEGEDATA_RAW_PATH = "data/collegedata_raw.csv"
+
+
+# RECORD LOG
+##############################################################################
+def write_json_atomic(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(obj, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class RecordLog:
+    def __init__(self, path = RECORD_LOG_PATH, progress_path = PROGRESS_PATH,
+                 progress_every = PROGRESS_EVERY,
+                 progress_seconds = PROGRESS_SECONDS):
+        self.path = path
+        self.progress_path = progress_path
+        self.progress_every = progress_every
+        self.progress_seconds = progress_seconds
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        self.recover()
+        self.file = open(path, 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.save_progress()
+
+    # Progress.
+    def reset_progress(self):
+        self.log_bytes = 0
+        self.done = set()
+        self.empty = set()
+        self.failed = {}
+
+    def load_progress(self):
+        if not isfile(self.progress_path):
+            self.reset_progress()
+            return
+        with open(self.progress_path) as file:
+            progress = json.load(file)
+        self.log_bytes = progress['log_bytes']
+        self.done = set(progress['done'])
+        self.empty = set(progress['empty'])
+        self.failed = {int(school_id): error
+                       for school_id, error in progress['failed'].items()}
+
+    def save_progress(self):
+        write_json_atomic({'log_bytes': self.log_bytes,
+                           'done': sorted(self.done),
+                           'empty': sorted(self.empty),
+                           'failed': {str(school_id): error
+                                      for school_id, error
+                                      in sorted(self.failed.items())}},
+                          self.progress_path)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    def track(self, entry):
+        school_id = entry['SchoolId']
+        self.done.discard(school_id)
+        self.empty.discard(school_id)
+        self.failed.pop(school_id, None)
+        if entry['status'] == OK:
+            self.done.add(school_id)
+        elif entry['status'] == EMPTY:
+            self.empty.add(school_id)
+        else:
+            self.failed[school_id] = entry.get('error') or entry['status']
+
+    def recover(self):
+        # Bring the progress index up to date with the log after a crash.
+        self.load_progress()
+        if not isfile(self.path):
+            self.reset_progress()
+            return
+        if getsize(self.path) < self.log_bytes:
+            # The index is ahead of the log; rebuild it from scratch.
+            self.reset_progress()
+        with open(self.path, 'rb+') as file:
+            file.seek(self.log_bytes)
+            offset = self.log_bytes
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                self.track(json.loads(line))
+                offset += len(line)
+            # Cut off a torn last line.
+            file.truncate(offset)
+        self.log_bytes = offset
+        self.save_progress()
+
+    # Writing.
+    def commit(self, parsed):
+        # Durably append a `collegedata_parse_pool.ParsedSchool`.
+        entry = {'SchoolId': parsed.school_id, 'status': parsed.status}
+        if parsed.record is not None:
+            entry['record'] = parsed.record
+        if parsed.error is not None:
+            entry['error'] = parsed.error
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.log_bytes += len(line)
+        self.track(entry)
+        self.unsaved += 1
+        if (self.unsaved >= self.progress_every
+                or time.monotonic() - self.saved_at >= self.progress_seconds):
+            self.save_progress()
+
+    # Resuming.
+    def todo_ids(self, school_ids, retry_failed = True):
+        # The ids in `school_ids` still to scrape: not done or empty, and
+        # (unless `retry_failed` is False) including ids that failed.
+        return [school_id for school_id in school_ids
+                if school_id not in self.done
+                and school_id not in self.empty
+                and (retry_failed or school_id not in self.failed)]
+
+    def failed_ids(self):
+        return sorted(self.failed)
+
+
+# READING AND COMPACTING
+##############################################################################
+def read_log(path = RECORD_LOG_PATH):
+    # Yield each complete entry in the log.
+    if not isfile(path):
+        return
+    with open(path, 'rb') as file:
+        for line in file:
+            if line.endswith(b'\n'):
+                yield json.loads(line)
+
+def get_records_frame(path = RECORD_LOG_PATH):
+    # The latest record of every scraped school as one wide table, with the
+    # columns sorted so they don't depend on which school came first. A
+    # failed retry never replaces an earlier good record.
+    records = {}
+    for entry in read_log(path):
+        if entry['status'] == OK:
+            records[entry['SchoolId']] = entry['record']
+        elif entry['status'] == EMPTY:
+            records.pop(entry['SchoolId'], None)
+    df = pd.DataFrame.from_dict(records, orient = 'index')
+    df = df.drop(columns = 'SchoolId', errors = 'ignore')
+    df = df.sort_index().sort_index(axis = 1)
+    df.index.name = 'SchoolId'
+    return df
+
+def compact_log(path = RECORD_LOG_PATH, out_path = COLLEGEDATA_RAW_PATH):
+    # Write `get_records_frame` to the raw CSV the rest of the project uses.
+    df = get_records_frame(path)
+    tmp_path = out_path + '.tmp'
+    df.to_csv(tmp_path)
+    os.replace(tmp_path, out_path)
+    return df
+
+
+# SCRAPING
+##############################################################################
+def scrape_collegedata(start = SCHOOL_ID_START, stop = SCHOOL_ID_END,
+                       school_ids = None, path = RECORD_LOG_PATH,
+                       progress_path = PROGRESS_PATH, retry_failed = True,
+                       metrics = None, **kwargs):
+    # Crawl, parse and log every school from `start` to `stop` (or
+    # `school_ids`), picking up where the last run left off. Keyword
+    # arguments go on to `collegedata_parse_pool.crawl_and_parse`. With
+    # `metrics` (a `collegedata_metrics.Metrics`), every stage is recorded
+    # in it, down to the time and bytes of each commit to the log, and its
+    # ETA counts the schools left to do.
+    if school_ids is None:
+        school_ids = range(start, stop + 1)
+    with RecordLog(path, progress_path) as log:
+        todo = log.todo_ids(school_ids, retry_failed)
+        commit = log.commit
+        if metrics is not None:
+            metrics.start(len(todo))
+
+            def commit(parsed):
+                log_bytes = log.log_bytes
+                started = time.perf_counter()
+                log.commit(parsed)
+                metrics.school_saved(time.perf_counter() - started,
+                                     log.log_bytes - log_bytes)
+
+        if todo:
+            crawl_and_parse(commit, todo, metrics = metrics, **kwargs)
+        return log.failed_ids()
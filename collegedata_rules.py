@@ -0,0 +1,281 @@
+# Compiled regex extraction rules for cleaning CollegeData columns.
+import random
+import re
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from collegedata_extractor import (FIXTURES_DIR, extract_record,
+                                   load_saved_school)
+from collegedata_names import dirty_cols_extract_dict
+
+
+# DEFINITIONS
+##############################################################################
+# Part 2 runs a separate `str.extract` for every target in
+# `dirty_cols_extract_dict`, so a source column with three targets is gone
+# over three times, each time through pandas' string machinery, and each
+# regex is compiled again on every call. Here the rule table is compiled once,
+# and each source column is gone over once: every distinct value is searched
+# with all of its column's regexes (`re.search`, as `str.extract` does), and
+# the matches are converted straight to numbers with `pd.to_numeric` (so the
+# dtypes come out the same as part 2's, too). Joining a column's regexes into
+# one pattern of lookaheads was tried, but it is slower than separate
+# searches, which can skip ahead to a regex's literal prefix. Where every
+# regex of a column is the same group followed by a different label (say
+# '([\d\.]+) Asian', '([\d\.]+) White', ...), the value is instead gone
+# over once with the group followed by any of the labels, keeping each
+# label's first match: the same as searching for each label, provided no
+# label has a character the group could match (so no match can hide
+# another). Each search otherwise tries the group at every position.
+PERCENT_RE = re.compile(r'([\d\.]+)%')
+NUMBER_RE = re.compile(r'(\d+\.?\d*)')
+# A regex that is a group followed by a literal label:
+GROUP_LABEL_RE = re.compile(r'(\([^()]*\))([^\\()\[\]{}.*+?^$|]+)')
+
+# The targets and their compiled regexes for one source column, and the
+# regex matching any of them in one pass (or None).
+CompiledRule = namedtuple('CompiledRule',
+                          ['source', 'targets', 'regexes', 'combined'])
+
+# 1x is about the number of schools on CollegeData.
+BENCHMARK_ROWS = 2000
+BENCHMARK_SCALES = (1, 10, 100)
+
+
+# COMPILING
+##############################################################################
+def compile_rule(source, extract_dict):
+    regexes = []
+    for target, regex in extract_dict.items():
+        compiled = re.compile(regex)
+        if compiled.groups != 1:
+            raise ValueError("{!r}: regex {!r} needs exactly one "
+                             "group".format(target, regex))
+        regexes.append(compiled)
+    return CompiledRule(source, list(extract_dict), regexes,
+                        combine_regexes(list(extract_dict.values())))
+
+def combine_regexes(regexes):
+    # One regex matching the shared group of `regexes` followed by any of
+    # their labels (the label's position in `regexes` being the match's
+    # `lastindex` - 2), or None if they aren't all a group and a label.
+    parts = [GROUP_LABEL_RE.fullmatch(regex) for regex in regexes]
+    if len(regexes) < 2 or not all(parts):
+        return None
+    group = parts[0].group(1)
+    labels = [part.group(2) for part in parts]
+    if (any(part.group(1) != group for part in parts)
+            or any(re.search(group, label) for label in labels)):
+        return None
+    return re.compile(group + '(?:' + '|'.join('({})'.format(label)
+                                               for label in labels) + ')')
+
+def compile_rules(extract_dict = dirty_cols_extract_dict):
+    # One `CompiledRule` per source column of a `{source: {target: regex}}`
+    # table like `dirty_cols_extract_dict`.
+    return [compile_rule(source, targets)
+            for source, targets in extract_dict.items()]
+
+DIRTY_COLS_RULES = compile_rules()
+
+
+# EXTRACTING
+##############################################################################
+def take_numeric(strings, codes, index, name = None):
+    # Series of `strings[code]` for each of `codes` (-1 or a None string
+    # being missing), converted the way `pd.to_numeric` converts the column.
+    present = [string for string in strings if string is not None]
+    if not present:
+        return pd.Series(np.nan, index = index, name = name, dtype = float)
+    numbers = pd.to_numeric(pd.Series(present, dtype = object)).to_numpy()
+    missing = codes < 0
+    positions = np.full(len(strings) + 1, -1)
+    is_present = np.array([string is not None for string in strings])
+    positions[:-1][is_present] = np.arange(len(present))
+    taken = positions[codes]
+    missing |= taken < 0
+    if missing.any():
+        values = numbers.astype(float)[np.where(missing, 0, taken)]
+        values[missing] = np.nan
+    else:
+        values = numbers[taken]
+    return pd.Series(values, index = index, name = name)
+
+def search_combined(value, rule):
+    # What searching `value` for each of `rule`'s regexes finds, in one pass
+    # of `rule.combined`.
+    found = [None] * len(rule.regexes)
+    for match in rule.combined.finditer(value):
+        i = match.lastindex - 2
+        if found[i] is None:
+            found[i] = match.group(1)
+    return found
+
+def extract_rule(s, rule):
+    # DataFrame of `rule`'s targets extracted from the Series `s`.
+    codes, uniques = pd.factorize(s)
+    if rule.combined is not None:
+        found = [search_combined(value, rule) if isinstance(value, str)
+                 else [None] * len(rule.regexes) for value in uniques]
+    else:
+        found = [[match.group(1) if match else None
+                  for match in (regex.search(value)
+                                for regex in rule.regexes)]
+                 if isinstance(value, str) else [None] * len(rule.regexes)
+                 for value in uniques]
+    return pd.DataFrame({
+        target: take_numeric([strings[i] for strings in found], codes,
+                             s.index, target)
+        for i, target in enumerate(rule.targets)},
+        index = s.index)
+
+def extract_columns(df, rules = DIRTY_COLS_RULES):
+    # What part 2's loop over `dirty_cols_extract_dict` builds as `vals`: every
+    # target as a numeric column. A target named by more than one source takes
+    # the value from the last source, in the position of the first.
+    vals = {}
+    for rule in rules:
+        extracted = extract_rule(df[rule.source], rule)
+        for target in rule.targets:
+            vals[target] = extracted[target]
+    return pd.DataFrame(vals, index = df.index)
+
+def percent_to_decimal(match):
+    return str(float(match.group(1)) / 100)
+
+def convert_percents(df):
+    # Part 2's percent-to-decimal step: in every object column, replace
+    # "12.5%" by "0.125" and make the column numeric if it now can be.
+    df = df.copy()
+    for col in df.select_dtypes('object'):
+        codes, uniques = pd.factorize(df[col])
+        replaced = np.array([PERCENT_RE.sub(percent_to_decimal, value)
+                             if isinstance(value, str) else value
+                             for value in uniques] + [np.nan],
+                            dtype = object)
+        s = pd.Series(replaced[codes], index = df.index, name = col)
+        df[col] = pd.to_numeric(s, errors = 'ignore')
+    return df
+
+def extract_all_numbers(df, cols):
+    # Part 2's `extractall(...).unstack()` step: every number in each of
+    # `cols`, as numeric columns "<col> - 1", "<col> - 2", ...
+    vals = {}
+    for col in cols:
+        codes, uniques = pd.factorize(df[col])
+        found = [NUMBER_RE.findall(value) if isinstance(value, str) else []
+                 for value in uniques]
+        width = max(
+            (len(found[code]) for code in np.unique(codes) if code >= 0),
+            default = 0)
+        for i in range(width):
+            name = col + ' - ' + str(i + 1)
+            vals[name] = take_numeric(
+                [numbers[i] if i < len(numbers) else None
+                 for numbers in found], codes, df.index, name)
+    return pd.DataFrame(vals, index = df.index)
+
+
+# BENCHMARK
+##############################################################################
+# Part 2's code, as it is in the notebook, to check against.
+def loop_extract_columns(df, extract_dict = dirty_cols_extract_dict):
+    vals = pd.DataFrame(index = df.index)
+    for dirty_col, targets in extract_dict.items():
+        for col, regex in targets.items():
+            vals[col] = df[dirty_col].str.extract(regex, expand = False)
+            vals[col] = pd.to_numeric(vals[col])
+    return vals
+
+def loop_convert_percents(df):
+    df = df.copy()
+    for col in df.select_dtypes('object'):
+        repl = lambda m: str(float(m.group(1)) / 100)
+        df[col] = df[col].str.replace(r'([\d\.]+)%', repl, regex = True)
+        df[col] = pd.to_numeric(df[col], errors = 'ignore')
+    return df
+
+def loop_extract_all_numbers(df, cols):
+    clean_df = pd.DataFrame(index = df.index)
+    for col in cols:
+        vals = df[col].str.extractall(r'(\d+\.?\d*)').unstack()
+        vals.columns = [col + ' - ' + str(i)
+                        for i in range(1, vals.shape[1] + 1)]
+        for val_col in vals.columns:
+            clean_df[val_col] = pd.to_numeric(vals[val_col])
+    return clean_df
+
+def vary_numbers(value, rng):
+    # `value` with each run of digits replaced by random digits.
+    def repl(match):
+        digits = match.group(0)
+        first = str(rng.randint(1, 9)) if len(digits) > 1 else ''
+        return first + ''.join(str(rng.randint(0, 9))
+                               for _ in range(len(digits) - len(first)))
+    return re.sub(r'\d+', repl, value)
+
+def get_benchmark_frame(school_ids = (59,), directory = FIXTURES_DIR,
+                        rows = BENCHMARK_ROWS, seed = 0):
+    # A raw frame of `rows` made-up schools, each a saved school with its
+    # numbers varied, as part 2 has it after reading `collegedata_raw.csv`
+    # (lists as strings) and stripping commas and dollar signs.
+    rng = random.Random(seed)
+    records = [extract_record(load_saved_school(school_id, directory),
+                              school_id)
+               for school_id in school_ids]
+    df = pd.DataFrame(records)
+    df = df.loc[[i % len(df) for i in range(rows)]]
+    df.index = pd.RangeIndex(1, rows + 1, name = 'SchoolId')
+    for col in df.select_dtypes('object'):
+        df[col] = [vary_numbers(str(value), rng)
+                   if isinstance(value, (str, list)) else value
+                   for value in df[col]]
+    df = df.replace(r'[,\$]', '', regex = True)
+    # Sources that no saved school has are left empty.
+    for col in dirty_cols_extract_dict:
+        if col not in df:
+            df[col] = pd.Series(np.nan, index = df.index, dtype = object)
+    return df
+
+def time_function(function, *args, repeat = 1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(*args)
+    return result, (time.perf_counter() - start) / repeat
+
+def benchmark_rules(scales = BENCHMARK_SCALES, school_ids = (59,),
+                    directory = FIXTURES_DIR, repeat = 1):
+    # Time part 2's loops against the compiled rules, in part 2's order, on
+    # `scales` times BENCHMARK_ROWS rows, checking the outputs are identical.
+    # Every row has its own made-up numbers, so values rarely repeat. (At
+    # 100x the percent loop alone peaks at about 5 GB.)
+    sources = list(dirty_cols_extract_dict)
+    results = []
+
+    def run(step, old, new, *args):
+        old_df, old_seconds = time_function(old, *args, repeat = repeat)
+        new_df, new_seconds = time_function(new, *args, repeat = repeat)
+        results.append({'step': step,
+                        'scale': scale,
+                        'rows': len(df),
+                        'loop_seconds': old_seconds,
+                        'compiled_seconds': new_seconds,
+                        'speedup': old_seconds / new_seconds,
+                        'identical': old_df.equals(new_df)})
+        return new_df
+
+    for scale in scales:
+        df = get_benchmark_frame(school_ids, directory,
+                                 rows = BENCHMARK_ROWS * scale)
+        converted = run('convert_percents', loop_convert_percents,
+                        convert_percents, df)
+        # The source columns as part 2 has them after converting percents.
+        dirty = converted[sources].astype(object)
+        del converted
+        run('extract_columns', loop_extract_columns, extract_columns, dirty)
+        run('extract_all_numbers', loop_extract_all_numbers,
+            extract_all_numbers, dirty, sources)
+    return pd.DataFrame(results)
@@ -0,0 +1,348 @@
+# Parallel, cached recursive feature elimination for the yield-rate models.
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from os.path import isfile, join
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.feature_selection import RFE, RFECV
+from sklearn.model_selection import KFold
+from sklearn.svm import SVR
+
+from collegedata_imputation import combine, impute
+from collegedata_preprocessing import Preprocessor, get_synthetic_joined
+
+
+# DEFINITIONS
+##############################################################################
+# Part 4 ends by running sklearn's `RFE` around a linear `SVR` on Yield Rate
+# (all): fit on all the features, drop the one with the smallest coefficient,
+# refit, and so on, all over again whenever anything changes. Here the
+# elimination is done step by step the way `RFE` (and, with cross
+# validation, `RFECV`) does it, and every step's fit is kept on disk under a
+# hash of what went into it: the estimator and its parameters, the contents
+# of each of the step's feature columns and of the target, and the rows it
+# was fit on (and scored on). So a repeat experiment costs no fits at all,
+# and after a change only the fits that saw the change are redone (e.g. with
+# one column changed, the steps after it has been eliminated are reused). The
+# steps of one elimination depend on each other, so what runs in parallel,
+# in a pool of processes, is whole eliminations: one for each CV fold of each
+# experiment, then the final one for each experiment.
+TARGET_COL = 'Yield Rate (all)'
+SELECTION_CACHE_DIR = 'data/selection'
+SELECTION_WORKERS = os.cpu_count() or 1
+CV_FOLDS = 5
+
+# A finished experiment: the `features` kept (in `df` order), every
+# candidate feature's `ranking` (1 for kept), the `estimator` fit on the kept
+# features, and, with cross validation, `cv_results` like `RFECV`'s.
+Selection = namedtuple('Selection', ['target', 'features', 'ranking',
+                                     'estimator', 'cv_results'])
+
+def get_estimator():
+    # Part 4's estimator.
+    return SVR(kernel = 'linear', gamma = 'scale')
+
+
+# CACHE
+##############################################################################
+def hash_array(a):
+    a = np.ascontiguousarray(a)
+    sha1 = hashlib.sha1(str((a.dtype.str, a.shape)).encode('utf-8'))
+    sha1.update(a.tobytes())
+    return sha1.hexdigest()
+
+def hash_values(*values):
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+def get_estimator_key(estimator):
+    return hash_values(type(estimator).__module__, type(estimator).__name__,
+                       sorted(estimator.get_params().items()))
+
+class FitCache:
+    # Pickled results on disk, addressed by key. With a `root` of None,
+    # nothing is kept.
+    def __init__(self, root = SELECTION_CACHE_DIR):
+        self.root = root
+
+    def path(self, key):
+        return join(self.root, key[:2], key[2:] + '.pkl')
+
+    def get(self, key):
+        if self.root is None or not isfile(self.path(key)):
+            return None
+        with open(self.path(key), 'rb') as file:
+            return pickle.load(file)
+
+    def put(self, key, value):
+        if self.root is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        # Write then rename, so a crash (or two workers writing the same
+        # result) never leaves a truncated file.
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(value, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+# ELIMINATION
+##############################################################################
+# What a worker needs to know about the data: the feature matrix and target,
+# and their hashes (one per column of `X`).
+SelectionData = namedtuple('SelectionData', ['X', 'y', 'col_keys', 'y_key'])
+
+def get_selection_data(X, y):
+    return SelectionData(X, y, [hash_array(X[:, j])
+                                for j in range(X.shape[1])], hash_array(y))
+
+def get_importances(estimator):
+    # `RFE`'s default importances: squared coefficients (summed over
+    # outputs), or `feature_importances_`.
+    importances = getattr(estimator, 'coef_', None)
+    if importances is None:
+        importances = estimator.feature_importances_
+    importances = np.asarray(importances)
+    if importances.ndim == 1:
+        return importances ** 2
+    return (importances ** 2).sum(axis = 0)
+
+def fit_step(data, estimator, features, train, test, cache, keep_estimator,
+             counts):
+    # A fit of `estimator` on `features` of rows `train`: its importances,
+    # its score on rows `test` (or None), and, if `keep_estimator`, the
+    # fitted estimator. Cached.
+    key = hash_values('step', get_estimator_key(estimator),
+                      [data.col_keys[j] for j in features], data.y_key,
+                      hash_array(train),
+                      None if test is None else hash_array(test))
+    step = cache.get(key)
+    if step is not None and (step['estimator'] is not None
+                             or not keep_estimator):
+        counts['cached'] += 1
+        return step
+    fitted = clone(estimator)
+    fitted.fit(data.X[np.ix_(train, features)], data.y[train])
+    step = {'importances': get_importances(fitted),
+            'score': (None if test is None else
+                      fitted.score(data.X[np.ix_(test, features)],
+                                   data.y[test])),
+            'estimator': fitted if keep_estimator else None}
+    cache.put(key, step)
+    counts['fitted'] += 1
+    return step
+
+def eliminate(data, estimator, n_features_to_select, step = 1, train = None,
+              test = None, root = SELECTION_CACHE_DIR):
+    # Recursive feature elimination on rows `train` (all of them by default)
+    # down to `n_features_to_select` features, step by step as `RFE` does it,
+    # scoring each step on rows `test` if given (as `RFECV` does). Returns a
+    # dict with `support`, `ranking`, each step's `n_features` and `scores`,
+    # the final `estimator` (without `test`), and how many fits were
+    # `fitted` and `cached`. Runs in a worker.
+    cache = FitCache(root)
+    n_features = data.X.shape[1]
+    if train is None:
+        train = np.arange(len(data.y))
+    path_key = hash_values('eliminate', get_estimator_key(estimator),
+                           data.col_keys, data.y_key, hash_array(train),
+                           None if test is None else hash_array(test),
+                           n_features_to_select, step)
+    result = cache.get(path_key)
+    if result is not None:
+        result['cached'] = result['fitted'] + result['cached']
+        result['fitted'] = 0
+        return result
+    if 0 < step < 1:
+        step = int(max(1, step * n_features))
+    counts = {'fitted': 0, 'cached': 0}
+    support = np.ones(n_features, dtype = bool)
+    ranking = np.ones(n_features, dtype = int)
+    steps, scores = [], []
+    while support.sum() > n_features_to_select:
+        features = np.arange(n_features)[support]
+        fitted = fit_step(data, estimator, features, train, test, cache,
+                          False, counts)
+        ranks = np.argsort(fitted['importances'])
+        threshold = min(step, support.sum() - n_features_to_select)
+        steps.append(len(features))
+        scores.append(fitted['score'])
+        support[features[ranks][:threshold]] = False
+        ranking[~support] += 1
+    features = np.arange(n_features)[support]
+    fitted = fit_step(data, estimator, features, train, test, cache,
+                      test is None, counts)
+    steps.append(len(features))
+    scores.append(fitted['score'])
+    result = {'support': support,
+              'ranking': ranking,
+              'n_features': steps,
+              'scores': scores,
+              'estimator': fitted['estimator'],
+              **counts}
+    cache.put(path_key, result)
+    return result
+
+def run_eliminations(tasks, workers = SELECTION_WORKERS):
+    # `eliminate(*args)` for each `args` in `tasks`, in a process pool.
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(workers, len(tasks))) as pool:
+            return list(pool.map(eliminate, *zip(*tasks)))
+    return [eliminate(*args) for args in tasks]
+
+
+# EXPERIMENTS
+##############################################################################
+def get_feature_cols(df, target = TARGET_COL):
+    # Part 4's candidates: every float column but the target.
+    return df.select_dtypes('float').columns.drop(target)
+
+def get_cv_results(paths):
+    # `RFECV`'s `cv_results_` and chosen number of features from the
+    # eliminations on each fold.
+    scores = np.array([path['scores'] for path in paths])
+    n_features = np.array(paths[0]['n_features'])[::-1]
+    scores = scores[:, ::-1]
+    cv_results = {'mean_test_score': np.mean(scores, axis = 0),
+                  'std_test_score': np.std(scores, axis = 0),
+                  **{'split{}_test_score'.format(i): fold_scores
+                     for i, fold_scores in enumerate(scores)},
+                  'n_features': n_features}
+    # Fewest features on a tie.
+    return cv_results, n_features[np.argmax(scores.sum(axis = 0))]
+
+def run_experiments(df, experiments, estimator = None,
+                    n_features_to_select = None, step = 1, cv = None,
+                    min_features_to_select = 1,
+                    workers = SELECTION_WORKERS,
+                    root = SELECTION_CACHE_DIR):
+    # Feature selection for each `(target, features)` in `experiments`
+    # (`features` of None for part 4's candidates), like `RFE` (with `cv` of
+    # None) or `RFECV` (with `cv` folds). Returns a `Selection` for each,
+    # and how many fits were made and how many were cached.
+    if estimator is None:
+        estimator = get_estimator()
+    setups = []
+    for target, features in experiments:
+        if features is None:
+            features = get_feature_cols(df, target)
+        X = df[features].to_numpy(dtype = float)
+        y = df[target].to_numpy(dtype = float)
+        if np.isnan(X).any() or np.isnan(y).any():
+            raise ValueError("{!r}: impute missing values before selecting "
+                             "features".format(target))
+        setups.append((target, list(features), get_selection_data(X, y)))
+
+    # Every fold of every experiment, all at once.
+    folds = {}
+    if cv is not None:
+        tasks, owners = [], []
+        for i, (_, features, data) in enumerate(setups):
+            n_select = min(min_features_to_select, len(features))
+            for train, test in KFold(cv).split(data.X):
+                tasks.append((data, estimator, n_select, step, train, test,
+                              root))
+                owners.append(i)
+        for i, path in zip(owners, run_eliminations(tasks, workers)):
+            folds.setdefault(i, []).append(path)
+
+    # Then each experiment's elimination on all of its rows.
+    tasks, cv_results = [], []
+    for i, (_, features, data) in enumerate(setups):
+        n_select = n_features_to_select
+        results = None
+        if cv is not None:
+            results, n_select = get_cv_results(folds[i])
+        elif n_select is None:
+            n_select = len(features) // 2
+        tasks.append((data, estimator, int(n_select), step, None, None,
+                      root))
+        cv_results.append(results)
+    finals = run_eliminations(tasks, workers)
+
+    selections = []
+    for (target, features, _), path, results in zip(setups, finals,
+                                                      cv_results):
+        selections.append(Selection(
+            target, [col for col, kept in zip(features, path['support'])
+                     if kept],
+            pd.Series(path['ranking'], index = features), path['estimator'],
+            results))
+    paths = finals + [path for paths in folds.values() for path in paths]
+    counts = {'fitted': sum(path['fitted'] for path in paths),
+              'cached': sum(path['cached'] for path in paths)}
+    return selections, counts
+
+def select_features(df, target = TARGET_COL, features = None, **kwargs):
+    # `run_experiments` for one experiment. Returns `(selection, counts)`.
+    selections, counts = run_experiments(df, [(target, features)], **kwargs)
+    return selections[0], counts
+
+
+# BENCHMARK
+##############################################################################
+def run_sklearn(df, target = TARGET_COL, cv = None):
+    # Part 4's cell (or its `RFECV` version), to check against.
+    num_cols = get_feature_cols(df, target)
+    regressor = SVR(kernel = 'linear', gamma = 'scale')
+    selector = RFE(regressor) if cv is None else RFECV(regressor, cv = cv)
+    selector = selector.fit(df[num_cols], df[target])
+    return selector, list(num_cols[selector.support_])
+
+def get_benchmark_frame(rows = 500, seed = 0):
+    # A preprocessed, imputed, made-up joined frame.
+    df = Preprocessor().fit_transform(get_synthetic_joined(rows, seed))
+    imputations, _ = impute(df, m = 1, seed = seed, workers = 1)
+    return combine(imputations)
+
+def benchmark_selection(rows = 500, seed = 0, cv = CV_FOLDS,
+                        workers = SELECTION_WORKERS, root = None):
+    # Time sklearn's `RFECV` against `select_features` with an empty cache,
+    # then again with the same data, and then with one feature column
+    # changed, checking the selections agree with sklearn's. The cache goes
+    # in a temporary directory unless `root` is given.
+    df = get_benchmark_frame(rows, seed)
+    cleanup = root is None
+    if cleanup:
+        root = tempfile.mkdtemp()
+    results = []
+    try:
+        changed = df.copy()
+        col = get_feature_cols(df)[0]
+        changed[col] = changed[col].sample(frac = 1, random_state = seed
+                                           ).to_numpy()
+        for run, run_df in (('empty cache', df), ('same data', df),
+                            ('one column changed', changed)):
+            start = time.perf_counter()
+            expected, features = run_sklearn(run_df, cv = cv)
+            sklearn_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            selection, counts = select_features(run_df, cv = cv,
+                                                workers = workers,
+                                                root = root)
+            seconds = time.perf_counter() - start
+            results.append({
+                'run': run,
+                'sklearn_seconds': sklearn_seconds,
+                'seconds': seconds,
+                'fitted': counts['fitted'],
+                'cached': counts['cached'],
+                'identical': (
+                    selection.features == features
+                    and (selection.ranking.to_numpy()
+                         == expected.ranking_).all()
+                    and np.array_equal(
+                        selection.cv_results['mean_test_score'],
+                        expected.cv_results_['mean_test_score']))})
+    finally:
+        if cleanup:
+            shutil.rmtree(root)
+    return pd.DataFrame(results)
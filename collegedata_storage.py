@@ -0,0 +1,162 @@
+# Typed columnar storage for each stage of the project's data.
+import json
+import os
+from os.path import isfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from collegedata_names import (col_rename_dict, dirty_cols_extract_dict,
+                               num_col_ranges)
+
+
+# DEFINITIONS
+##############################################################################
+# Every stage of the project used to be saved as CSV, so each notebook had to
+# re-parse strings and redo `pd.to_numeric` and the category conversion, and
+# the dtypes were lost in between. Each stage is now written as a compressed
+# Parquet file with its dtypes kept, and can be loaded a few columns at a
+# time without reading the rest of the ~400-column frame:
+STAGE_PATHS = {
+    'collegedata_raw': "data/collegedata_raw.parquet",
+    'collegedata_clean': "data/collegedata_clean.parquet",
+    'usnews_raw': "data/usnews_raw.parquet",
+    'usnews_clean': "data/usnews_clean.parquet",
+    'joined': "data/joined.parquet"
+}
+COMPRESSION = 'zstd'
+# Columns we expect to be numeric: everything `collegedata_names` renames,
+# extracts or range-checks.
+NUMERIC_COLS = (
+    {col for col in col_rename_dict.values() if col != '*delete*'}
+    | {col for extract_dict in dirty_cols_extract_dict.values()
+       for col in extract_dict}
+    | set(num_col_ranges))
+# Other string columns with fewer unique values than this are stored as
+# categories (the same cut-off part 2 uses):
+CATEGORY_MAX_UNIQUE = 60
+# Once a column's dtype has been chosen for a stage, it is recorded here and
+# kept on later writes, so a stage's schema doesn't drift from run to run:
+SCHEMA_REGISTRY_PATH = "data/schema_registry.json"
+
+
+# SCHEMA REGISTRY
+##############################################################################
+def load_registry(path = SCHEMA_REGISTRY_PATH):
+    if not isfile(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def save_registry(registry, path = SCHEMA_REGISTRY_PATH):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(registry, file, indent = 1, sort_keys = True)
+    os.replace(tmp_path, path)
+
+def infer_dtype(s):
+    # The dtype a column should be stored as, if not already registered.
+    if pd.api.types.is_float_dtype(s):
+        return 'float64'
+    if s.name in NUMERIC_COLS and not pd.api.types.is_bool_dtype(s):
+        # Only if every value really is a number; part 2 leaves a column
+        # alone when `pd.to_numeric` fails, and so do we.
+        numeric = pd.to_numeric(s, errors = 'coerce')
+        if numeric.notna().sum() == s.notna().sum():
+            return 'float64'
+    if pd.api.types.is_integer_dtype(s) or pd.api.types.is_bool_dtype(s):
+        return str(s.dtype)
+    if pd.api.types.is_categorical_dtype(s):
+        return 'category'
+    values = s.dropna()
+    if len(values) and isinstance(values.iloc[0], (list, tuple)):
+        return 'list'
+    if s.nunique() < CATEGORY_MAX_UNIQUE:
+        return 'category'
+    return 'string'
+
+def get_stage_schema(stage, df, registry):
+    # `{column: dtype}` for `df`, taking registered dtypes first.
+    schema = dict(registry.get(stage, {}))
+    for col in df.columns:
+        if col not in schema:
+            schema[col] = infer_dtype(df[col])
+    return {col: schema[col] for col in df.columns}
+
+def to_numeric(s, dtype):
+    # `s` as the registered numeric `dtype`. Integer columns are kept as
+    # pandas' nullable integers (e.g. 'int64' as 'Int64'), so a later run
+    # with missing values doesn't fail, while a value that isn't a number
+    # (or a whole number, for an integer column) where one is registered is
+    # schema drift and raises.
+    numeric = pd.to_numeric(s, errors = 'coerce')
+    drifted = numeric.isna() & s.notna()
+    kind = 'non-numeric'
+    if not drifted.any() and dtype != 'float64':
+        drifted = (numeric % 1 != 0) & numeric.notna()
+        kind = 'non-integer'
+    if drifted.any():
+        raise ValueError("Schema drift in column {!r}: registered as {} but "
+                         "has {} {} values, e.g. {!r}".format(
+                             s.name, dtype, drifted.sum(), kind,
+                             s[drifted].iloc[0]))
+    if dtype == 'float64':
+        return numeric.astype('float64')
+    return numeric.astype(dtype.replace('uint', 'UInt').replace('int', 'Int'))
+
+def apply_schema(df, schema):
+    df = df.copy()
+    for col, dtype in schema.items():
+        if dtype == 'float64' or 'int' in dtype.lower():
+            df[col] = to_numeric(df[col], dtype)
+        elif dtype == 'category':
+            df[col] = df[col].astype('category')
+        elif dtype == 'string':
+            df[col] = df[col].astype('string')
+        elif dtype != 'list':
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+# READING AND WRITING STAGES
+##############################################################################
+def write_stage(df, stage, path = None, registry_path = SCHEMA_REGISTRY_PATH):
+    # Write a stage's frame (index included) with its registered dtypes.
+    if path is None:
+        path = STAGE_PATHS[stage]
+    registry = load_registry(registry_path)
+    schema = get_stage_schema(stage, df, registry)
+    df = apply_schema(df, schema)
+    registry[stage] = {**registry.get(stage, {}), **schema}
+    save_registry(registry, registry_path)
+
+    table = pa.Table.from_pandas(df, preserve_index = True)
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, compression = COMPRESSION)
+    os.replace(tmp_path, path)
+    return df
+
+def load_stage(stage, columns = None, path = None):
+    # Load a stage, or just `columns` of it (the index always comes along).
+    # Only the requested columns are read from disk.
+    if path is None:
+        path = STAGE_PATHS[stage]
+    return pd.read_parquet(path, columns = columns)
+
+def stage_columns(stage, path = None):
+    # The columns in a stage, read from the file's footer only.
+    if path is None:
+        path = STAGE_PATHS[stage]
+    schema = pq.read_schema(path)
+    index_cols = set(json.loads(schema.metadata[b'pandas'])['index_columns']
+                     if schema.metadata and b'pandas' in schema.metadata
+                     else [])
+    return [name for name in schema.names if name not in index_cols]
+
+def csv_to_stage(csv_path, stage, path = None,
+                 registry_path = SCHEMA_REGISTRY_PATH, **read_csv_kwargs):
+    # Convert one of the existing CSVs, e.g.
+    # `csv_to_stage('data/usnews_clean.csv', 'usnews_clean')`.
+    df = pd.read_csv(csv_path, **read_csv_kwargs)
+    return write_stage(df, stage, path, registry_path)
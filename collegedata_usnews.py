@@ -0,0 +1,187 @@
+# Streaming parser for saved USNews ranking pages.
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+import pandas as pd
+from bs4 import BeautifulSoup
+from lxml import etree
+
+
+# DEFINITIONS
+##############################################################################
+# Part 1 reads the whole of `usnews.html` into a BeautifulSoup tree to pick
+# out the ranking rows, and part 2 then splits `Location` and pulls the rank
+# out of `Rank Info` with more passes over the columns. Here the page is read
+# a chunk at a time and scanned for ranking rows; each row is parsed on its
+# own as soon as its </tr> has been read and turned straight into a typed
+# record, and the bytes before it are dropped. So memory stays flat however
+# long the page is (several lists or years saved into one file, say).
+# (lxml's own pull parser isn't used: it frees the tree as we go, but its HTML
+# push parser holds on to all of the input it has been fed.)
+USNEWS_HTML_PATH = 'data/usnews.html'
+USNEWS_CLEAN_CSV_PATH = 'data/usnews_clean.csv'
+ROW_ID_ATTR = {"data-view":"colleges-search-results-table-row"}
+ROW_START_RE = re.compile(
+    rb'<tr\b[^>]*\bdata-view="colleges-search-results-table-row"[^>]*>')
+ROW_END = b'</tr>'
+ROW_PARSER = etree.HTMLParser(encoding = 'utf-8')
+CHUNK_BYTES = 65536
+# A row's start tag is never longer than this, so when a chunk ends with no
+# row in progress only this much of it is kept in case a start tag was cut:
+MAX_TAG_BYTES = 1024
+# Part 2's rules: rows without a rank are left out, and the rest are
+# "#<rank> in <rank type>", maybe with a "(tie)" after it.
+UNRANKED_RE = re.compile('Unranked|N/A')
+RANK_INFO_RE = re.compile(r'^#(\d+).*in (.*)$')
+
+# A school's entry. `rank` is an int.
+USNewsSchool = namedtuple('USNewsSchool',
+                          ['name', 'city', 'state', 'rank', 'rank_type'])
+USNEWS_COLS = ['Name', 'City', 'State', 'Rank', 'Rank Type']
+
+
+# PARSING
+##############################################################################
+def get_row_values(row):
+    # Part 1's values for a row: its stripped strings, less '(tie)' and '1'.
+    vals = [string.strip() for string in row.itertext()]
+    vals = [string for string in vals if string]
+    if '(tie)' in vals:
+        vals.remove('(tie)')
+    if '1' in vals:
+        vals.remove('1')
+    return vals[0:3]
+
+def parse_row(row):
+    # The `USNewsSchool` in a ranking row, or None if it isn't ranked.
+    vals = get_row_values(row)
+    if len(vals) < 3 or UNRANKED_RE.search(vals[2]):
+        return None
+    location = vals[1].split(', ')
+    match = RANK_INFO_RE.search(vals[2])
+    if len(location) != 2 or not match:
+        return None
+    city, state = location
+    return USNewsSchool(vals[0], city, state, int(match.group(1)),
+                        match.group(2))
+
+def iter_row_html(path = USNEWS_HTML_PATH, chunk_bytes = CHUNK_BYTES):
+    # Yield the HTML (bytes) of each ranking row on a saved page.
+    buffer = b''
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_bytes), b''):
+            buffer += chunk
+            pos = 0
+            while True:
+                start = ROW_START_RE.search(buffer, pos)
+                if not start:
+                    buffer = buffer[max(pos, len(buffer) - MAX_TAG_BYTES):]
+                    break
+                end = buffer.find(ROW_END, start.end())
+                if end < 0:
+                    buffer = buffer[start.start():]
+                    break
+                pos = end + len(ROW_END)
+                yield buffer[start.start():pos]
+
+def iter_usnews_schools(path = USNEWS_HTML_PATH, chunk_bytes = CHUNK_BYTES):
+    # Yield a `USNewsSchool` for every ranked school on a saved page, in page
+    # order.
+    for html in iter_row_html(path, chunk_bytes):
+        row = etree.fromstring(b'<table>' + html + b'</table>', ROW_PARSER)
+        school = parse_row(row)
+        if school is not None:
+            yield school
+
+def read_usnews(path = USNEWS_HTML_PATH):
+    # The schools on a saved page, as part 2 leaves `usnews_clean.csv`.
+    return pd.DataFrame(list(iter_usnews_schools(path)),
+                        columns = USNEWS_COLS)
+
+
+# BENCHMARK
+##############################################################################
+def read_usnews_with_soup(path = USNEWS_HTML_PATH):
+    # Parts 1 and 2's code, as it is in the notebooks, to check against.
+    scraped = []
+    with open(path, 'r') as file:
+        page = BeautifulSoup(file.read(), "lxml")
+        for row in page('tr', attrs = ROW_ID_ATTR):
+            vals = "---".join(row.stripped_strings).split('---')
+            if '(tie)' in vals:
+                vals.remove('(tie)')
+            if '1' in vals:
+                vals.remove('1')
+            scraped.append(vals[0:3])
+    ranks_df = pd.DataFrame(scraped, columns = ['Name','Location','Rank Info'])
+    mask = ranks_df['Rank Info'].str.contains('Unranked|N/A', na = True)
+    ranks_df.drop(ranks_df[mask].index, inplace = True)
+    vals = ranks_df['Location'].str.split(', ', expand = True)
+    vals.columns = ['City', 'State']
+    ranks_df.drop(columns = 'Location', inplace = True)
+    ranks_df = ranks_df.join(vals)
+    vals = ranks_df['Rank Info'].str.extract(r'^#(\d+).*in (.*)$')
+    vals.columns = ['Rank', 'Rank Type']
+    ranks_df.drop(columns = 'Rank Info', inplace = True)
+    ranks_df = ranks_df.join(vals)
+    ranks_df['Rank'] = pd.to_numeric(ranks_df['Rank'])
+    return ranks_df[USNEWS_COLS].reset_index(drop = True)
+
+def write_repeated_page(copies, path = USNEWS_HTML_PATH):
+    # A temporary file holding `copies` copies of a saved page back to back,
+    # standing in for a much longer page. Returns its path.
+    with open(path, 'rb') as file:
+        page = file.read()
+    fd, out_path = tempfile.mkstemp(suffix = '.html')
+    with os.fdopen(fd, 'wb') as file:
+        for _ in range(copies):
+            file.write(page)
+    return out_path
+
+def count_schools(path):
+    return sum(1 for _ in iter_usnews_schools(path))
+
+def time_reader(reader, path):
+    # The result, seconds, and peak traced memory in bytes for one read of
+    # `path`.
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = reader(path)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+def benchmark_usnews(copies = (1, 10, 100), path = USNEWS_HTML_PATH,
+                     soup_copies = 10):
+    # Throughput and peak memory of the streaming parser on `copies` copies
+    # of the saved page, next to parts 1 and 2's soup (up to `soup_copies`
+    # copies, since it holds the whole page in memory), checking the two
+    # agree. Peak memory is what Python allocates while the schools are
+    # parsed (and, for the soup, kept).
+    results = []
+    for n in copies:
+        big_path = write_repeated_page(n, path)
+        try:
+            megabytes = os.path.getsize(big_path) / 1e6
+            readers = [('streaming', count_schools)]
+            if n <= soup_copies:
+                readers.append(('soup', read_usnews_with_soup))
+            for name, reader in readers:
+                result, seconds, peak = time_reader(reader, big_path)
+                row = {'parser': name,
+                       'copies': n,
+                       'megabytes': megabytes,
+                       'seconds': seconds,
+                       'mb_per_second': megabytes / seconds,
+                       'peak_bytes': peak}
+                if name == 'soup':
+                    row['identical'] = result.equals(read_usnews(big_path))
+                results.append(row)
+        finally:
+            os.remove(big_path)
+    return pd.DataFrame(results)